@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import os
+import re
+import tempfile
 from pathlib import Path
 
 from environs import Env
@@ -36,6 +38,174 @@ SAVED_IMAGES_MAX_SIZE: int = env.int(
     "SAVED_IMAGES_MAX_SIZE", default=int(128e6), validate=[Range(1)]
 )
 SAVED_IMAGES_CACHE_DIR: Path = env.path("SAVED_IMAGES_CACHE_DIR", default=_img_cache)
+# The memory index only sees what its own process saves, so it's for single worker
+# servers. gunicorn switches to sqlite when there are more workers.
+SAVED_IMAGES_INDEX: str = env(
+    "SAVED_IMAGES_INDEX", default="sqlite", validate=[OneOf(["memory", "sqlite"])]
+)
+SAVED_IMAGES_INDEX_PATH: Path | None = env.path("SAVED_IMAGES_INDEX_PATH", default=None)
+SAVED_IMAGES_SHARD_DEPTH: int = env.int(
+    "SAVED_IMAGES_SHARD_DEPTH", default=2, validate=[Range(0, 16)]
+)
+# Store identical images once, with the cached paths linking to them.
+SAVED_IMAGES_DEDUPE: bool = env.bool("SAVED_IMAGES_DEDUPE", default=True)
+SAVED_IMAGES_EVICTION_POLICY: str = env(
+    "SAVED_IMAGES_EVICTION_POLICY",
+    default="lru",
+    validate=[OneOf(["lru", "lfu", "gdsf"])],
+)
+SAVED_IMAGES_HIGH_WATERMARK: float = env.float(
+    "SAVED_IMAGES_HIGH_WATERMARK", default=1.0, validate=[Range(0, 1)]
+)
+SAVED_IMAGES_LOW_WATERMARK: float = env.float(
+    "SAVED_IMAGES_LOW_WATERMARK", default=0.8, validate=[Range(0, 1)]
+)
+
+EVICTION_BATCH_SIZE: int = env.int(
+    "EVICTION_BATCH_SIZE", default=64, validate=[Range(1)]
+)
+EVICTION_BATCH_TIME: float = env.float(
+    "EVICTION_BATCH_TIME", default=0.05, validate=[Range(0)]
+)
+EVICTION_MIN_AGE: float = env.float(
+    "EVICTION_MIN_AGE", default=10.0, validate=[Range(0)]
+)
+EVICTION_INTERVAL: float = env.float(
+    "EVICTION_INTERVAL", default=60.0, validate=[Range(0, min_inclusive=False)]
+)
+# Evicted files are only deleted once they've been in the trash this long.
+EVICTION_TRASH_GRACE: float = env.float(
+    "EVICTION_TRASH_GRACE", default=60.0, validate=[Range(0)]
+)
+# Cache hits are written to the index in batches, this often.
+ACCESS_FLUSH_INTERVAL: float = env.float(
+    "ACCESS_FLUSH_INTERVAL", default=5.0, validate=[Range(0, min_inclusive=False)]
+)
+# Cache stats are added to the totals in Redis in batches, this often.
+STATS_FLUSH_INTERVAL: float = env.float(
+    "STATS_FLUSH_INTERVAL", default=5.0, validate=[Range(0, min_inclusive=False)]
+)
+
+MEMORY_CACHE_MAX_SIZE: int = env.int(
+    "MEMORY_CACHE_MAX_SIZE", default=int(32e6), validate=[Range(0)]
+)
+MEMORY_CACHE_MAX_ITEM_SIZE: int = env.int(
+    "MEMORY_CACHE_MAX_ITEM_SIZE", default=int(2e6), validate=[Range(0)]
+)
+# Decoded RGBA images, so about four bytes per pixel. Off by default; it only pays
+# off when the same image is requested in several formats or resolutions.
+RASTER_CACHE_MAX_SIZE: int = env.int(
+    "RASTER_CACHE_MAX_SIZE", default=0, validate=[Range(0)]
+)
+
+# Snap sizes to a grid (and `rand` colors to SNAP_PALETTE when SNAP_COLORS is on),
+# for every request or, with `?snap=1`, only the requests that ask for it.
+SNAP_DEFAULT: bool = env.bool("SNAP_DEFAULT", default=False)
+SNAP_GRID: int = env.int("SNAP_GRID", default=8, validate=[Range(1)])
+SNAP_COLORS: bool = env.bool("SNAP_COLORS", default=True)
+# Comma separated hex colors, empty for the built in 16 color palette.
+SNAP_PALETTE: list[str] = env.list(
+    "SNAP_PALETTE",
+    default=[],
+    validate=lambda colors: all(re.fullmatch(color_re, c) for c in colors),
+)
+
+# Answer image URLs that aren't in their canonical form with a 301 to it, which
+# edge caches can keep for CANONICAL_REDIRECT_MAX_AGE seconds.
+CANONICAL_REDIRECTS: bool = env.bool("CANONICAL_REDIRECTS", default=False)
+CANONICAL_REDIRECT_MAX_AGE: int = env.int(
+    "CANONICAL_REDIRECT_MAX_AGE", default=24 * 60**2, validate=[Range(0)]
+)
+
+# With "tinylfu", new images over ADMISSION_MIN_PIXELS are only saved once they've
+# been requested ADMISSION_MIN_FREQUENCY times. "always" saves everything.
+ADMISSION_POLICY: str = env(
+    "ADMISSION_POLICY", default="tinylfu", validate=[OneOf(["always", "tinylfu"])]
+)
+ADMISSION_MIN_PIXELS: int = env.int(
+    "ADMISSION_MIN_PIXELS", default=4_000_000, validate=[Range(0)]
+)
+ADMISSION_MIN_FREQUENCY: int = env.int(
+    "ADMISSION_MIN_FREQUENCY", default=2, validate=[Range(1, 15)]
+)
+ADMISSION_SKETCH_WIDTH: int = env.int(
+    "ADMISSION_SKETCH_WIDTH", default=1 << 16, validate=[Range(1)]
+)
+
+# Encoded images in an mmap'd file shared by every worker. Zero turns it off, and
+# when it's on it takes the place of the per-worker memory cache.
+_shm_dir = (
+    Path("/dev/shm") if Path("/dev/shm").is_dir() else Path(tempfile.gettempdir())
+)
+SHM_CACHE_SIZE: int = env.int("SHM_CACHE_SIZE", default=0, validate=[Range(0)])
+SHM_CACHE_PATH: Path = env.path("SHM_CACHE_PATH", default=_shm_dir / "holdmypics.cache")
+SHM_CACHE_SLOTS: int = env.int("SHM_CACHE_SLOTS", default=4096, validate=[Range(1)])
+SHM_CACHE_MAX_ITEM_SIZE: int = env.int(
+    "SHM_CACHE_MAX_ITEM_SIZE", default=int(2e6), validate=[Range(0)]
+)
+
+# Redis should be run with `maxmemory` and `maxmemory-policy volatile-lru` set, so
+# that only images (which always get `SHARED_CACHE_TTL`) are evicted, never the
+# counters; or use a separate instance. The size limit only applies to the
+# in-process stand-in used without `REDIS_URL`.
+SHARED_CACHE: bool = env.bool("SHARED_CACHE", default=False)
+SHARED_CACHE_TTL: int = env.int("SHARED_CACHE_TTL", default=86400, validate=[Range(1)])
+SHARED_CACHE_MAX_SIZE: int = env.int(
+    "SHARED_CACHE_MAX_SIZE", default=int(64e6), validate=[Range(0)]
+)
+SHARED_CACHE_MAX_ITEM_SIZE: int = env.int(
+    "SHARED_CACHE_MAX_ITEM_SIZE", default=int(2e6), validate=[Range(0)]
+)
+SHARED_CACHE_LOCK_TIMEOUT: float = env.float(
+    "SHARED_CACHE_LOCK_TIMEOUT", default=10.0, validate=[Range(0, min_inclusive=False)]
+)
+
+# Keep every rendered image somewhere that outlives the local cache folder, and
+# fill local misses from it: "fs" (STORAGE_PATH), "s3" (needs boto3) or "memory".
+# "none" keeps images only in the local cache folder.
+STORAGE_BACKEND: str = env(
+    "STORAGE_BACKEND",
+    default="none",
+    validate=[OneOf(["none", "fs", "s3", "memory"])],
+)
+STORAGE_PATH: Path | None = env.path("STORAGE_PATH", default=None)
+STORAGE_S3_BUCKET: str = env("STORAGE_S3_BUCKET", default="")
+STORAGE_S3_PREFIX: str = env("STORAGE_S3_PREFIX", default="")
+# For S3 compatible stores, like MinIO. Credentials are read by boto3.
+STORAGE_S3_ENDPOINT_URL: str | None = env("STORAGE_S3_ENDPOINT_URL", default=None)
+
+# Share rendered images between nodes without a central store. PEERS lists every
+# node's base URL, including this one's (PEER_SELF). Each image is owned by one of
+# them, picked by consistent hashing, which is asked for it before rendering.
+PEERS: list[str] = env.list("PEERS", default=[])
+PEER_SELF: str = env("PEER_SELF", default="")
+# Sent with every peer request, and required by the peer endpoint. PEERS are
+# ignored without one.
+PEER_SECRET: str = env("PEER_SECRET", default="")
+PEER_VNODES: int = env.int("PEER_VNODES", default=64, validate=[Range(1)])
+PEER_TIMEOUT: float = env.float(
+    "PEER_TIMEOUT", default=1.0, validate=[Range(0, min_inclusive=False)]
+)
+# How long to stop asking a peer that failed to answer.
+PEER_RETRY_AFTER: float = env.float(
+    "PEER_RETRY_AFTER", default=30.0, validate=[Range(0)]
+)
+PEER_MAX_ITEM_SIZE: int = env.int(
+    "PEER_MAX_ITEM_SIZE", default=int(2e6), validate=[Range(0)]
+)
+
+# Let the front proxy send cached images: "x-accel-redirect" (nginx) or "x-sendfile".
+SEND_FILE_OFFLOAD: str = env(
+    "SEND_FILE_OFFLOAD",
+    default="",
+    validate=[OneOf(["", "x-accel-redirect", "x-sendfile"])],
+)
+# The nginx location that is aliased to SAVED_IMAGES_CACHE_DIR.
+SEND_FILE_OFFLOAD_PREFIX: str = env(
+    "SEND_FILE_OFFLOAD_PREFIX", default="/_cached-images/"
+)
+# Serve offloaded files from the app itself, for running without a proxy.
+SEND_FILE_OFFLOAD_PROXY: bool = env.bool("SEND_FILE_OFFLOAD_PROXY", default=False)
 
 SESSION_COOKIE_SECURE: bool = env.bool("SESSION_COOKIE_SECURE", default=False)
 SESSION_COOKIE_SAMESITE: bool | None = env.bool("SESSION_COOKIE_SAMESITE", default=None)
@@ -103,6 +273,10 @@ WEBP_LOSSLESS: bool = env.bool("WEBP_LOSSLESS", default=False)
 
 GIF_OPTIMIZE: bool = env.bool("GIT_OPTIMIZE", default=True)
 
+# Write single color images (like text images without text) straight to PNG, GIF
+# or lossless WebP, without drawing them first.
+SOLID_ENCODER: bool = env.bool("SOLID_ENCODER", default=True)
+
 
 def rel_to_root(p: os.PathLike) -> str:
     return os.path.relpath(p, BASE_PATH)
@@ -24,3 +24,20 @@ accesslog = "-"
 errorlog = "-"
 
 timeout = env.int("GUNICORN_TIMEOUT", default=30)
+
+
+def on_starting(server) -> None:
+    """Check the config, and create the shared memory cache, before forking."""
+    import config
+    from holdmypics.api.shm import create_arena
+
+    if config.SAVED_IMAGES_INDEX == "memory" and server.cfg.workers > 1:
+        # Each worker would only see its own images, and allow its own maximum.
+        server.log.warning(
+            "SAVED_IMAGES_INDEX=memory only works with one worker, using sqlite"
+        )
+        config.SAVED_IMAGES_INDEX = "sqlite"
+    if config.SHM_CACHE_SIZE:
+        create_arena(
+            config.SHM_CACHE_PATH, config.SHM_CACHE_SIZE, config.SHM_CACHE_SLOTS
+        )
@@ -12,6 +12,7 @@ from flask import Flask, Response, g, request, send_from_directory
 from loguru import logger
 from whitenoise import WhiteNoise
 
+from .constants import CACHE_CONTROL_MAX
 from .converters import ColorConverter, DimensionConverter
 from .log_config import config_logging, log_request, log_static_file
 from .wrapped_redis import WrappedRedis
@@ -29,7 +30,6 @@ HERE = Path(__file__).resolve().parent
 
 REQUEST_TIMER = time.perf_counter
 
-CACHE_CONTROL_MAX = "max-age=315360000, public, immutable"
 
 _exts = ("woff", "woff2", "js", "css")
 _exts_group = "|".join(f"{e[::-1]}." for e in _exts)
@@ -150,6 +150,15 @@ def create_app(cfg: str | ModuleType = "config") -> Holdmypics:
     app.wsgi_app.add_files(str(HERE / "static"), prefix="static/")
     app.wsgi_app.add_files(str(base_path / "static"), prefix="static/")
 
+    if app.config.get("SEND_FILE_OFFLOAD_PROXY"):
+        from .api.offload import OffloadProxy
+
+        app.wsgi_app = OffloadProxy(
+            app.wsgi_app,
+            app.config["SAVED_IMAGES_CACHE_DIR"],
+            app.config["SEND_FILE_OFFLOAD_PREFIX"],
+        )
+
     if debug:
         from werkzeug.debug import DebuggedApplication
 
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import atexit
+import os
+import threading
+import time
+from collections.abc import Callable
+
+from attrs import define, field
+from loguru import logger
+
+Access = tuple[str, float, int]
+
+
+@define(repr=False)
+class AccessTracker:
+    """Collects cache hits in memory and writes them out in batches.
+
+    Recording a hit only updates a dict, so serving a cached image doesn't write
+    anything. A background thread passes what was collected to ``sink`` every
+    ``interval`` seconds, as the name, the last access time and the number of
+    hits for each file. Hits from the last interval are lost if a worker is
+    killed before it can flush them, which only makes those files look a little
+    older to the eviction policy.
+    """
+
+    sink: Callable[[list[Access]], object]
+    interval: float = 5.0
+    flushes: int = field(default=0, init=False)
+
+    _pending: dict[str, tuple[float, int]] = field(factory=dict, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+    _wake: threading.Event = field(factory=threading.Event, init=False)
+    _thread: threading.Thread | None = field(default=None, init=False)
+    _pid: int | None = field(default=None, init=False)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def record(self, name: str, atime: float | None = None) -> None:
+        atime = time.time() if atime is None else atime
+        self.start()
+        with self._lock:
+            hits = self._pending.get(name, (0.0, 0))[1]
+            self._pending[name] = (atime, hits + 1)
+
+    def take(self) -> list[Access]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return [(name, atime, hits) for name, (atime, hits) in pending.items()]
+
+    def flush(self) -> int:
+        """Write out everything that was recorded, returning how many files."""
+        accesses = self.take()
+        if accesses:
+            self.sink(accesses)
+            self.flushes += 1
+        return len(accesses)
+
+    def start(self) -> None:
+        pid = os.getpid()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == pid:
+            return
+        if self._pid != pid:
+            if self._pid is not None:
+                # Whatever was pending belongs to the parent, which will flush it.
+                self._pending, self._lock = {}, threading.Lock()
+            atexit.register(self.flush)
+        self._pid, self._wake = pid, threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="holdmypics-access", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing accesses failed")
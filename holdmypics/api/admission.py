@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import threading
+from array import array
+from typing import Any
+
+from attrs import define, field
+
+from ..utils import config_value
+from .index import key_digest
+
+SKETCH_DEPTH = 4
+# Counters saturate here, which is plenty to tell one-off requests apart.
+MAX_COUNT = 15
+
+
+@define(repr=False)
+class FrequencySketch:
+    """A count-min sketch of how often keys were seen, which ages over time.
+
+    Every ``10 * width`` increments all of the counters are halved, so keys that
+    were popular a long time ago don't stay admitted forever.
+    """
+
+    width: int = 1 << 16
+    additions: int = field(default=0, init=False)
+
+    _counters: array = field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        self._counters = array("B", bytes(self.width * SKETCH_DEPTH))
+
+    def _slots(self, key: str) -> list[int]:
+        digest = key_digest(key)
+        h1, h2 = digest & 0xFFFFFFFF, (digest >> 32) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(SKETCH_DEPTH)]
+
+    def estimate(self, key: str) -> int:
+        counters = self._counters
+        return min(counters[i] for i in self._slots(key))
+
+    def increment(self, key: str) -> int:
+        counters, slots = self._counters, self._slots(key)
+        count = min(counters[i] for i in slots)
+        # Only the smallest counters are incremented, which keeps overestimates down.
+        if count < MAX_COUNT:
+            for i in slots:
+                if counters[i] == count:
+                    counters[i] += 1
+        self.additions += 1
+        if self.additions >= 10 * self.width:
+            self.reset()
+        return min(count + 1, MAX_COUNT)
+
+    def reset(self) -> None:
+        self._counters = array("B", (c >> 1 for c in self._counters))
+        self.additions //= 2
+
+
+@define(repr=False)
+class Admission:
+    """Decides which newly rendered images are worth keeping in the caches.
+
+    With the ``tinylfu`` policy, an image that's larger than
+    `ADMISSION_MIN_PIXELS` is only saved once it has been requested
+    `ADMISSION_MIN_FREQUENCY` times. Until then it's rendered for the request and
+    thrown away, so crawlers asking for random huge sizes don't push popular
+    images out. Smaller images are cheap to keep and are always saved.
+    Frequencies are counted in each worker.
+    """
+
+    admitted: int = field(default=0, init=False)
+    rejected: int = field(default=0, init=False)
+
+    _policy: str | None = field(default=None, init=False)
+    _min_pixels: int | None = field(default=None, init=False)
+    _min_frequency: int | None = field(default=None, init=False)
+    _sketch: FrequencySketch | None = field(default=None, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+
+    @property
+    def policy(self) -> str:
+        if self._policy is None:
+            self._policy = config_value("ADMISSION_POLICY", "always", cast_as=str)
+        return self._policy
+
+    @property
+    def min_pixels(self) -> int:
+        if self._min_pixels is None:
+            self._min_pixels = config_value("ADMISSION_MIN_PIXELS", 0, cast_as=int)
+        return self._min_pixels
+
+    @property
+    def min_frequency(self) -> int:
+        if self._min_frequency is None:
+            freq = config_value("ADMISSION_MIN_FREQUENCY", 2, cast_as=int)
+            self._min_frequency = min(freq, MAX_COUNT)
+        return self._min_frequency
+
+    @property
+    def sketch(self) -> FrequencySketch:
+        if self._sketch is None:
+            width = config_value("ADMISSION_SKETCH_WIDTH", 1 << 16, cast_as=int)
+            self._sketch = FrequencySketch(width)
+        return self._sketch
+
+    def admit(self, key: str, size: tuple[int, int]) -> bool:
+        """Count a miss for ``key``, and decide whether to keep the result."""
+        if self.policy == "always":
+            self.admitted += 1
+            return True
+        with self._lock:
+            frequency = self.sketch.increment(key)
+            ok = size[0] * size[1] <= self.min_pixels or (
+                frequency >= self.min_frequency
+            )
+            if ok:
+                self.admitted += 1
+            else:
+                self.rejected += 1
+        return ok
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "min_pixels": self.min_pixels,
+            "min_frequency": self.min_frequency,
+        }
+
+
+admission = Admission()
@@ -4,7 +4,7 @@ from collections.abc import Mapping, Sequence
 from typing import Any, cast
 
 import marshmallow as ma
-from attrs import astuple, define, evolve, field
+from attrs import define, evolve, field
 from flask import request
 from marshmallow import fields
 from marshmallow.validate import Range, Regexp
@@ -60,9 +60,6 @@ class BaseImageArgs:
     seed: str | None = None
     debug: bool = False
 
-    def to_seq(self) -> tuple[Any, ...]:
-        return astuple(self)
-
 
 @define(frozen=True)
 class TextImageArgs(BaseImageArgs):
@@ -101,9 +98,6 @@ class TiledImageArgs(BaseImageArgs):
         args = parser.parse(tiled_schema, request, location="query")
         return cast(TiledImageArgs, args)
 
-    def to_seq(self) -> tuple[Any, ...]:
-        return astuple(evolve(self, colors="-".join(self.colors)))
-
 
 @define(frozen=True)
 class AnimArgs:
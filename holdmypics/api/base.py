@@ -1,20 +1,32 @@
 from __future__ import annotations
 
+import inspect
 import os
+import time
 from abc import ABC, abstractmethod
 from collections.abc import Callable
-from functools import partial
+from functools import cache, partial
 from types import MappingProxyType
 from typing import Any, ClassVar, Generic, Literal, TypeVar
 
+import PIL
 from attrs import define, field
 from loguru import logger
 from PIL import Image
 
 from .. import redisw
+from ..constants import IMG_FORMATS
 from ..utils import config_value, get_size, natsize
+from .admission import admission
 from .args import BaseImageArgs
 from .files import files
+from .locks import atomic_write
+from .peers import peer_cache
+from .raster import raster_cache
+from .shared import shared_cache
+from .solid import ENCODER_VERSION, Color, encode_solid
+from .stats import CacheStatus
+from .storage import image_store
 from .utils import normalize_fmt, resolve_color
 
 _Args = TypeVar("_Args", bound=BaseImageArgs)
@@ -61,13 +73,42 @@ SAVE_KW = MappingProxyType[str, Callable[[BaseImageArgs], dict[str, Any]]](
 )
 
 
+# Only these formats are saved with the requested DPI.
+DPI_FORMATS = frozenset(("jpeg", "png"))
+
+# These only change how an image is encoded, not how it looks.
+ENCODING_PARAMS = frozenset(("fmt", "dpi"))
+
+GENERATORS: dict[str, type[BaseGeneratedImage]] = {}
+
+
 def _default_kw(*args: object, **kwargs: object) -> dict[str, Any]:
     return {}
 
 
+@cache
+def code_fingerprint(func: Callable[..., Any]) -> str:
+    try:
+        return files.hash_strings(inspect.getsource(func))
+    except (OSError, TypeError):
+        return func.__qualname__
+
+
+def solid_encoder_enabled() -> bool:
+    return config_value("SOLID_ENCODER", True, cast_as=bool)
+
+
+def live_namespaces() -> set[str]:
+    """Get the namespace of every generator and format, as currently configured."""
+    formats = {normalize_fmt(fmt) for fmt in IMG_FORMATS}
+    return {gen.namespace(fmt) for gen in GENERATORS.values() for fmt in formats}
+
+
 @define()
 class BaseGeneratedImage(Generic[_Args], ABC):
     mode: ClassVar[Literal["RGBA"]] = "RGBA"
+    # Bump this when a change to `make` changes what an image looks like.
+    renderer_version: ClassVar[int] = 1
 
     size: tuple[int, int]
     fmt: str = field(converter=normalize_fmt)
@@ -75,6 +116,37 @@ class BaseGeneratedImage(Generic[_Args], ABC):
     fg_color: str = field(converter=resolve_color)
     args: _Args
 
+    _img_path: str | None = field(default=None, init=False, repr=False)
+    cache_status: CacheStatus | None = field(default=None, init=False, repr=False)
+    # Set when the image wasn't admitted to the cache, see `render_transient`.
+    transient: bool = field(default=False, init=False, repr=False)
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        if not inspect.isabstract(cls):
+            GENERATORS[cls.__qualname__] = cls
+
+    @classmethod
+    def renderer_inputs(cls, fmt: str) -> dict[str, Any]:
+        """Get what, besides the parameters, determines this generator's output.
+
+        Images are saved in a namespace derived from these, so a deploy only
+        invalidates the images whose generator or encoder settings changed.
+        """
+        save_kw = SAVE_KW.get(fmt, _default_kw)
+        return {
+            "generator": f"{cls.__name__}-{cls.renderer_version}",
+            "fmt": fmt,
+            "pillow": PIL.__version__,
+            "save_kw": sorted(save_kw(BaseImageArgs()).items()),
+            "save_code": code_fingerprint(save_kw),
+            "solid": ENCODER_VERSION if solid_encoder_enabled() else 0,
+        }
+
+    @classmethod
+    def namespace(cls, fmt: str) -> str:
+        return files.namespace_for(cls.renderer_inputs(fmt))
+
     def new_image(
         self,
         size: tuple[int, int] | None = None,
@@ -88,31 +160,191 @@ class BaseGeneratedImage(Generic[_Args], ABC):
     @abstractmethod
     def make(self) -> Image.Image: ...
 
-    def get_file_name_extra(self) -> tuple[Any, ...]:
-        return ()
+    def solid_color(self) -> Color | None:
+        """Get the one color `make` would fill the image with, if it's solid."""
+        return None
 
-    def get_img_path(self) -> str:
-        extra = self.get_file_name_extra()
-        return files.get_file_name(
-            self.size, self.bg_color, self.fg_color, self.fmt, self.args, *extra
+    def get_cache_params(self) -> dict[str, Any]:
+        """Get the parameters that determine the output, in a canonical form.
+
+        Anything that doesn't change the output for this type of image and format
+        is left out, so that equivalent requests share a cache entry. Colors are
+        already normalized to 8 digit hex, and random colors and text have been
+        resolved by now, so the seed never matters.
+        """
+        params: dict[str, Any] = {
+            "size": "x".join(map(str, self.size)),
+            "fmt": self.fmt,
+            "bg": self.bg_color.lstrip("#"),
+        }
+        if self.fmt in DPI_FORMATS:
+            params["dpi"] = self.args.dpi
+        return params
+
+    def get_raster_key(self) -> str:
+        params = self.get_cache_params()
+        return files.params_hash(
+            {k: v for k, v in params.items() if k not in ENCODING_PARAMS}
         )
 
-    def save_img(self, im: Image.Image, path: str) -> None:
+    def get_raster(self, keep: bool = True) -> Image.Image:
+        """Make the image, or reuse one made for another format.
+
+        Unless ``keep`` is false, a new image is kept for other formats.
+        """
+        key = self.get_raster_key()
+        im = raster_cache.get(key)
+        if im is None:
+            im = self.make()
+            if keep:
+                raster_cache.put(key, im)
+        return im
+
+    def get_etag(self) -> str:
+        """Get a strong ETag, derived from the parameters rather than the file.
+
+        This means conditional requests can be answered without rendering, or
+        even looking for, the image.
+        """
+        params = {**self.get_cache_params(), "renderer": self.namespace(self.fmt)}
+        return files.params_hash(params)
+
+    def get_img_path(self) -> str:
+        if self._img_path is None:
+            namespace = self.namespace(self.fmt)
+            self._img_path = files.get_file_name(self.get_cache_params(), namespace)
+        return self._img_path
+
+    def save_img(
+        self,
+        im: Image.Image,
+        path: str,
+        started: float | None = None,
+        store: bool = True,
+    ) -> None:
+        """Save ``im`` to ``path``.
+
+        The time since ``started`` (or since saving started) is recorded as the
+        cost of the image, for the eviction policy. If ``store`` is false, the
+        file isn't added to the cache.
+        """
+        if started is None:
+            started = time.perf_counter()
         if self.fmt == "jpeg":
             im = im.convert("RGB")
         save_kw = self.get_save_kw()
-        im.save(path, **save_kw)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as tmp_path:
+            im.save(tmp_path, format=self.fmt, **save_kw)
         im.close()
-        size = get_size(path)
+        self._saved(path, get_size(path), started, store)
+
+    def save_solid(
+        self, path: str, started: float | None = None, store: bool = True
+    ) -> bool:
+        """Save this image without drawing it, if it's a single color.
+
+        Returns false if it has to be drawn, see `save_img`.
+        """
+        if started is None:
+            started = time.perf_counter()
+        color = self.solid_color()
+        if color is None or not solid_encoder_enabled():
+            return False
+        data = encode_solid(self.fmt, self.size, color, self.get_save_kw())
+        if data is None:
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as tmp_path, open(tmp_path, "wb") as f:
+            f.write(data)
+        self._saved(path, len(data), started, store)
+        return True
+
+    def _saved(self, path: str, size: int, started: float, store: bool) -> None:
+        if store:
+            files.store(path, size, cost=time.perf_counter() - started)
         logger.info("Created {0!r} ({1})", os.path.basename(path), get_nat(size))
         redisw.incr_count()
         redisw.incr_size(size)
 
-    def get_path(self) -> str:
+    def save_fetched(self, path: str, data: bytes | None, source: str) -> bool:
+        if data is None:
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as tmp_path, open(tmp_path, "wb") as f:
+            f.write(data)
+        files.store(path, len(data))
+        logger.debug("Fetched {0!r} from {1}", os.path.basename(path), source)
+        return True
+
+    def fetch_shared(self, path: str, wait: bool = False) -> bool:
+        """Copy this image from the shared cache into ``path``, if it's there."""
+        name = os.path.basename(path)
+        data = shared_cache.wait_for(name) if wait else shared_cache.get(name)
+        return self.save_fetched(path, data, "the shared cache")
+
+    def fetch_peer(self, path: str) -> bool:
+        """Copy this image from the peer that owns it into ``path``, if it has it."""
+        return self.save_fetched(path, peer_cache.get(path), "its owner")
+
+    def use_existing(self, path: str) -> bool:
+        if not os.path.isfile(path):
+            return False
+        files.record_access(path)
+        logger.debug("Already existed: {0!r}", os.path.basename(path))
+        return True
+
+    def fetch_remote(self, path: str) -> bool:
+        """Copy this image into ``path`` from wherever else it's already saved."""
+        return (
+            self.fetch_shared(path) or self.fetch_peer(path) or image_store.fetch(path)
+        )
+
+    def render(self, path: str) -> CacheStatus:
+        with shared_cache.render_lock(os.path.basename(path)) as owner:
+            # Whoever held the lock may have finished in the meantime.
+            if self.fetch_shared(path, wait=not owner):
+                return CacheStatus.HIT if owner else CacheStatus.COALESCED
+            started = time.perf_counter()
+            if not self.save_solid(path, started):
+                self.save_img(self.get_raster(), path, started)
+            shared_cache.put_file(path)
+            peer_cache.put_file(path)
+            image_store.upload(path)
+            return CacheStatus.MISS
+
+    def render_transient(self) -> str:
+        """Render this image to a scratch file, leaving the caches alone.
+
+        The caller should delete the file once it's been opened.
+        """
+        path = files.scratch_path(os.path.basename(self.get_img_path()))
+        if not self.save_solid(path, store=False):
+            self.save_img(self.get_raster(keep=False), path, store=False)
+        self.transient = True
+        return path
+
+    def get_path(self, admit: bool = False) -> str:
+        """Get the path to this image, rendering it if needed.
+
+        How it was found is recorded in `cache_status`. Images that are saved
+        elsewhere are always copied here, since that costs no rendering. New
+        images are only saved if the admission policy (or ``admit``) lets them
+        in, otherwise the path is to a scratch file, and `transient` is set.
+        """
         path = self.get_img_path()
-        if os.path.isfile(path):
-            os.utime(path)
-            logger.debug("Already existed: {0!r}", os.path.basename(path))
-        else:
-            self.save_img(self.make(), path)
+        if self.use_existing(path):
+            self.cache_status = CacheStatus.HIT
+            return path
+        # Only one request renders a new image, the rest wait for it.
+        with files.render_lock(path):
+            if self.use_existing(path):
+                self.cache_status = CacheStatus.COALESCED
+            elif self.fetch_remote(path):
+                self.cache_status = CacheStatus.HIT
+            elif admit or admission.admit(os.path.basename(path), self.size):
+                self.cache_status = self.render(path)
+            else:
+                self.cache_status = CacheStatus.MISS
+                return self.render_transient()
         return path
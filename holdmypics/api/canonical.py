@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from operator import itemgetter
+from typing import Any
+from urllib.parse import urlencode
+
+from flask import current_app, redirect, request
+from marshmallow import fields
+
+from .._types import ResObject
+from ..constants import DEFAULT_DPI, DEFAULT_FONT
+from ..fonts import fonts
+from ..utils import config_value
+from .args import truthy
+from .base import DPI_FORMATS
+from .snap import Snap
+from .utils import RAND_COLOR, get_color, normalize_fmt
+
+Query = list[tuple[str, str]]
+
+
+def enabled() -> bool:
+    return config_value("CANONICAL_REDIRECTS", False, cast_as=bool)
+
+
+def canonical_color(color: str) -> str:
+    """Get ``color`` as lowercase hex, with 6 digits unless it's transparent."""
+    if color.casefold() == RAND_COLOR:
+        return RAND_COLOR
+    color = get_color(color).lstrip("#")
+    return color[:6] if color.endswith("ff") else color
+
+
+def flag(value: str | None) -> bool:
+    if value is None or value in fields.Boolean.falsy:
+        return False
+    if value in truthy:
+        return True
+    raise ValueError(f"Not a boolean: {value!r}")
+
+
+def common_query(fmt: str, randomized: bool) -> Query:
+    args, query = request.args, []
+    dpi = int(args.get("dpi", DEFAULT_DPI))
+    if fmt in DPI_FORMATS and dpi != DEFAULT_DPI:
+        query.append(("dpi", str(dpi)))
+    if randomized and "seed" in args:
+        query.append(("seed", args["seed"]))
+    snap = Snap.requested()
+    if snap != config_value("SNAP_DEFAULT", False, cast_as=bool):
+        query.append(("snap", "1" if snap else "0"))
+    return query
+
+
+def redirect_if_needed(
+    endpoint: str, values: dict[str, Any], query: Query
+) -> ResObject | None:
+    """Redirect to the canonical URL, unless that's what was requested.
+
+    Parameters are sorted by name, keeping the order of repeated ones. Flags are
+    sent without a value, as the web form does.
+    """
+    # `url_for` would pick a shorter rule when a value matches its default.
+    rule = next(r for r in current_app.url_map.iter_rules(endpoint) if not r.defaults)
+    built = rule.build(values, append_unknown=False)
+    assert built is not None
+    path = request.script_root + built[1]
+    query_string = urlencode(sorted(query, key=itemgetter(0)))
+    requested = request.script_root + request.path
+    if path == requested and query_string.encode() == request.query_string:
+        return None
+    res = redirect(f"{path}?{query_string}" if query_string else path, 301)
+    max_age = config_value("CANONICAL_REDIRECT_MAX_AGE", 0, cast_as=int)
+    res.headers["Cache-Control"] = f"max-age={max_age}, public"
+    return res
+
+
+def image_redirect(
+    size: tuple[int, int], bg_color: str, fg_color: str, fmt: str
+) -> ResObject | None:
+    """Get a redirect to the canonical URL for a text image, if it isn't one.
+
+    Parameters that can't change the image (like the font when there's no text,
+    or the seed when nothing is random) are left out.
+    """
+    if not enabled():
+        return None
+    args, fmt = request.args, normalize_fmt(fmt)
+    bg_color, fg_color = canonical_color(bg_color), canonical_color(fg_color)
+    try:
+        random_text = flag(args.get("random_text"))
+        randomized = random_text or RAND_COLOR in {bg_color, fg_color}
+        query = common_query(fmt, randomized)
+        debug = flag(args.get("debug"))
+    except ValueError:
+        return None
+    if random_text:
+        query.append(("random_text", ""))
+    elif "text" in args:
+        query.append(("text", args["text"]))
+    if random_text or "text" in args:
+        font = args.get("font", DEFAULT_FONT).lower()
+        if font not in fonts.font_names:
+            return None
+        if font != DEFAULT_FONT:
+            query.append(("font", font))
+        if debug:
+            query.append(("debug", ""))
+    values = {"size": size, "bg_color": bg_color, "fg_color": fg_color, "fmt": fmt}
+    return redirect_if_needed("api.image_route", values, query)
+
+
+def tiled_redirect(
+    size: tuple[int, int], cols: int, rows: int, fmt: str
+) -> ResObject | None:
+    """Get a redirect to the canonical URL for a tiled image, if it isn't one."""
+    if not enabled():
+        return None
+    fmt = normalize_fmt(fmt)
+    try:
+        colors = [canonical_color(c) for c in request.args.getlist("colors")]
+        query = common_query(fmt, RAND_COLOR in colors)
+    except ValueError:
+        return None
+    query.extend(("colors", c) for c in colors)
+    values = {"size": size, "cols": cols, "rows": rows, "fmt": fmt}
+    return redirect_if_needed("api.tiled_route", values, query)
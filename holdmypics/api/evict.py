@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from attrs import define, field, frozen
+from loguru import logger
+
+from ..utils import config_value
+from .base import live_namespaces
+from .files import GeneratedFiles, ScanResult, files
+from .locks import file_lock
+from .stats import cache_stats
+
+LOCK_NAME = ".evict.lock"
+BATCH_PAUSE = 0.01
+STALE_BATCHES = 16
+
+
+@frozen()
+class EvictionSettings:
+    batch_size: int
+    batch_time: float
+    min_age: float
+    interval: float
+    trash_grace: float
+
+    @classmethod
+    def from_config(cls) -> EvictionSettings:
+        return cls(
+            batch_size=config_value("EVICTION_BATCH_SIZE", 64, cast_as=int),
+            batch_time=config_value("EVICTION_BATCH_TIME", 0.05, cast_as=float),
+            min_age=config_value("EVICTION_MIN_AGE", 10.0, cast_as=float),
+            interval=config_value("EVICTION_INTERVAL", 60.0, cast_as=float),
+            trash_grace=config_value("EVICTION_TRASH_GRACE", 60.0, cast_as=float),
+        )
+
+
+@define(repr=False)
+class Evictor:
+    """Evicts saved images from a background thread.
+
+    Once the cache grows past the high watermark, files are deleted in small, time
+    bounded batches, in the order the eviction policy picks, until it is back under
+    the low watermark. Unless the index can be queried for that order, work is
+    done one shard at a time, largest first, so a pass never has to list the whole
+    cache. A lock file in the cache folder makes sure only one process evicts at a
+    time.
+    """
+
+    files: GeneratedFiles
+    evictions: int = field(default=0, init=False)
+    passes: int = field(default=0, init=False)
+
+    _settings: EvictionSettings | None = field(default=None, init=False)
+    _wake: threading.Event = field(factory=threading.Event, init=False)
+    _thread: threading.Thread | None = field(default=None, init=False)
+    _pid: int | None = field(default=None, init=False)
+    _live: set[str] | None = field(default=None, init=False)
+    _stale_done: bool = field(default=False, init=False)
+
+    @property
+    def settings(self) -> EvictionSettings:
+        if self._settings is None:
+            self._settings = EvictionSettings.from_config()
+        return self._settings
+
+    def wake(self) -> None:
+        """Ask the background thread to run a pass, starting it if needed."""
+        self.ensure_running()
+        self._wake.set()
+
+    def ensure_running(self) -> None:
+        """Start the background thread if it isn't running.
+
+        Must be called with an app context, so that settings can be resolved.
+        """
+        self.settings
+        self.files.low_watermark
+        if self._live is None:
+            self._live = live_namespaces()
+        self.start()
+
+    def start(self) -> None:
+        pid = os.getpid()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == pid:
+            return
+        # Threads don't survive a fork, so each gunicorn worker gets its own.
+        self._pid, self._wake = pid, threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="holdmypics-evictor", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.settings.interval)
+            self._wake.clear()
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Eviction pass failed")
+
+    def run_once(self) -> int:
+        # Policies need to see recent hits, which are only written in batches.
+        self.files.flush_accesses()
+        self.files.reclaim_trash(self.settings.trash_grace)
+        need_to_clean = self.files.need_to_clean
+        if not need_to_clean and (self._live is None or self._stale_done):
+            return 0
+        with file_lock(self.files.images_folder / LOCK_NAME, blocking=False) as ok:
+            if not ok:
+                logger.debug("Another process is evicting")
+                return 0
+            self.collect_stale()
+            num_deleted = 0
+            for shard, candidates in self.files.eviction_candidates():
+                num_deleted += self.evict(candidates, shard)
+                if self.files.index.total_size <= self.files.low_watermark:
+                    break
+        self.passes += 1
+        if num_deleted:
+            s = "" if num_deleted == 1 else "s"
+            logger.info("Evicted {0} file{1}", num_deleted, s)
+        return num_deleted
+
+    def collect_stale(self) -> int:
+        """Evict a few batches of images from namespaces that aren't live.
+
+        Nothing can request those images anymore, so they're removed whether or
+        not the cache is full, but a little at a time, so that a deploy doesn't
+        cause a burst of deletes.
+        """
+        live = self._live
+        if live is None or self._stale_done:
+            return 0
+        batch_size = self.settings.batch_size
+        stale = self.files.stale_files(live)
+        num_deleted = 0
+        for _ in range(STALE_BATCHES):
+            batch = list(islice(stale, batch_size))
+            for path in batch:
+                self.files.evict(path)
+            num_deleted += len(batch)
+            if len(batch) < batch_size:
+                self.files.remove_empty_namespaces(live)
+                self._stale_done = True
+                break
+            time.sleep(BATCH_PAUSE)
+        if num_deleted:
+            cache_stats.record_evictions(num_deleted)
+            logger.info(
+                "Removed {0} stale file{1}",
+                num_deleted,
+                "" if num_deleted == 1 else "s",
+            )
+        return num_deleted
+
+    def evict(self, candidates: ScanResult, shard: int | None = None) -> int:
+        """Delete ``candidates`` in order until under the low watermark.
+
+        Shards are hashed evenly, so once ``shard`` is down to its share of the
+        low watermark the rest of the work is left to other shards.
+        """
+        settings, index = self.settings, self.files.index
+        low_watermark = self.files.low_watermark
+        shard_target = low_watermark // self.files.num_shards
+
+        def over() -> bool:
+            if index.total_size <= low_watermark:
+                return False
+            return shard is None or index.shard_size(shard) > shard_target
+
+        # Recently used files may be about to be sent, so leave them alone.
+        cutoff = time.time() - settings.min_age
+        queue = deque(c for c in candidates if c[2] <= cutoff)
+        num_deleted = 0
+        while queue and over():
+            if num_deleted:
+                time.sleep(BATCH_PAUSE)
+            deadline = time.monotonic() + settings.batch_time
+            for _ in range(settings.batch_size):
+                self.files.evict(queue.popleft()[0])
+                num_deleted += 1
+                if not queue or not over():
+                    break
+                if time.monotonic() > deadline:
+                    break
+        self.evictions += num_deleted
+        if num_deleted:
+            cache_stats.record_evictions(num_deleted)
+        return num_deleted
+
+
+evictor = Evictor(files)
@@ -3,32 +3,64 @@ from __future__ import annotations
 import hashlib
 import os
 import re
-from collections.abc import Callable
+import shutil
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from functools import partial
 from itertools import chain
-from operator import itemgetter
 from pathlib import Path
 from typing import Any, ClassVar
 
 import attrs
 from loguru import logger
 
-from ..utils import config_value, get_size, natsize
-from .args import BaseImageArgs, TextImageArgs
+from ..utils import config_value, natsize
+from .access import Access, AccessTracker
+from .index import NUM_SHARDS, CacheIndex, Index
+from .locks import KeyedLocks, file_lock
+from .policy import get_policy
+from .sqlindex import SQLiteIndex
 
 FNAME_TBL = str.maketrans({"#": "", " ": "-", ".": "", "/": "-", "\\": "-"})
 _extensions: tuple[str, ...] = ("png", "webp", "jpg", "jpeg", "gif")
 
+ScanResult = list[tuple[str, int, float]]
+BLOB_PERSON = b"holdmypics-blob"
+INDEX_NAME = ".index.sqlite3"
+LAYOUT_KEY = "layout"
+BLOBS_DIR = "blobs"
+LOCKS_DIR = ".locks"
+TRASH_DIR = ".trash"
+SCRATCH_DIR = ".scratch"
+
 
 @attrs.define(repr=False)
 class GeneratedFiles:
-    hash_function: ClassVar[Callable[..., hashlib._Hash]] = hashlib.md5
+    hash_function: ClassVar[Callable[..., Any]] = partial(
+        hashlib.blake2b, digest_size=16
+    )
     fmt_re: ClassVar[re.Pattern[str]] = re.compile(f"\\.({'|'.join(_extensions)})$")
+    # What a saved image can be called, which keeps names from peers in bounds.
+    name_re: ClassVar[re.Pattern[str]] = re.compile(
+        f"^[^./\\\\][^/\\\\]*\\.({'|'.join(_extensions)})$"
+    )
+    hex_re: ClassVar[re.Pattern[str]] = re.compile(r"^[0-9a-f]{32}$")
+    shard_re: ClassVar[re.Pattern[str]] = re.compile(r"^[0-9a-f]{2}$")
+    namespace_re: ClassVar[re.Pattern[str]] = re.compile(r"^r[0-9a-f]{12}$")
 
-    files: set[str] = attrs.field(factory=set)
+    _index: Index | None = attrs.field(init=False, default=None)
+    _accesses: AccessTracker | None = attrs.field(init=False, default=None)
+    _flights: KeyedLocks = attrs.field(init=False, factory=KeyedLocks)
     _done_setup: bool = attrs.field(init=False, default=False)
     _images_folder: Path | None = attrs.field(init=False, default=None)
     _max_size: int | None = attrs.field(init=False, default=None)
+    _high_watermark: int | None = attrs.field(init=False, default=None)
+    _low_watermark: int | None = attrs.field(init=False, default=None)
     _hash_file_names: bool | None = attrs.field(init=False, default=None)
+    _shard_depth: int | None = attrs.field(init=False, default=None)
+    _dedupe: bool | None = attrs.field(init=False, default=None)
 
     @classmethod
     def hash_strings(cls, *strings: str) -> str:
@@ -37,36 +69,287 @@ class GeneratedFiles:
         return hasher.hexdigest()
 
     @classmethod
-    def params_hash(cls, *params: Any) -> str:
-        return cls.hash_strings(*map(repr, params))
+    def params_hash(cls, params: Mapping[str, Any]) -> str:
+        """Hash canonical parameters.
+
+        Each value is prefixed by its name and length, so that the result doesn't
+        depend on how the parameters were ordered or spelled.
+        """
+        hasher = cls.hash_function()
+        for name in sorted(params):
+            value = str(params[name]).encode("utf-8", errors="replace")
+            hasher.update(b"%s:%d:%s;" % (name.encode(), len(value), value))
+        return hasher.hexdigest()
 
     def setup(self) -> None:
         folder = self.images_folder
-        if not folder.is_dir():
-            folder.mkdir(parents=True, exist_ok=True)
-        self.find_current()
+        (folder / LOCKS_DIR).mkdir(parents=True, exist_ok=True)
+        (folder / TRASH_DIR).mkdir(parents=True, exist_ok=True)
+        (folder / SCRATCH_DIR).mkdir(parents=True, exist_ok=True)
+        index = self.index
+        layout = f"depth={self.shard_depth};policy={index.policy.name};namespaced"
+        if isinstance(index, SQLiteIndex) and index.get_meta(LAYOUT_KEY) == layout:
+            logger.debug("Attached to {0!r}", index)
+        else:
+            self.find_current()
+            if isinstance(index, SQLiteIndex):
+                index.set_meta(LAYOUT_KEY, layout)
         self._done_setup = True
 
-    def get_current_files(self) -> list[str]:
-        folder = self.images_folder
-        files = filter(self.fmt_re.search, os.listdir(folder))
-        return [os.path.join(folder, f) for f in files]
+    def ensure_setup(self) -> None:
+        if not self._done_setup:
+            self.setup()
+
+    @property
+    def index(self) -> Index:
+        if self._index is None:
+            kind = config_value("SAVED_IMAGES_INDEX", "memory", cast_as=str)
+            name = config_value("SAVED_IMAGES_EVICTION_POLICY", "lru", cast_as=str)
+            policy = get_policy(name)
+            if kind == "sqlite":
+                path = config_value("SAVED_IMAGES_INDEX_PATH", None)
+                path = path or self.images_folder / INDEX_NAME
+                self._index = SQLiteIndex(path, policy)
+            else:
+                self._index = CacheIndex(policy)
+        return self._index
+
+    @classmethod
+    def namespace_for(cls, inputs: Mapping[str, Any]) -> str:
+        """Get the name of the folder for images rendered with ``inputs``.
+
+        See `BaseGeneratedImage.renderer_inputs`.
+        """
+        return f"r{cls.params_hash(inputs)[:12]}"
+
+    def namespace_of(self, path: str) -> str:
+        parts = Path(path).relative_to(self.images_folder).parts
+        top = parts[0] if len(parts) > 1 else ""
+        return top if top == BLOBS_DIR or self.namespace_re.match(top) else ""
+
+    def key_for(self, path: str) -> str:
+        """Get a name for ``path`` that's the same on every node."""
+        return f"{self.namespace_of(path)}/{os.path.basename(path)}"
+
+    def namespaces(self) -> list[str]:
+        try:
+            it = os.scandir(self.images_folder)
+        except FileNotFoundError:
+            return []
+        with it as entries:
+            return [e.name for e in entries if self.namespace_re.match(e.name)]
 
     def find_current(self) -> None:
-        self.files.update(self.get_current_files())
+        current = self.scan()
+        if any(
+            p != self.path_for(os.path.basename(p), self.namespace_of(p))
+            for p, _, _ in current
+        ):
+            moved = self.migrate()
+            logger.info(
+                "Moved {0} file{1} into place", moved, "" if moved == 1 else "s"
+            )
+            current = self.scan()
+        self.sync(current)
+
+    def _walk(self, folder: str | Path) -> Iterator[os.DirEntry[str]]:
+        try:
+            it = os.scandir(folder)
+        except FileNotFoundError:
+            return
+        with it as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if self._walks_into(entry.name):
+                        yield from self._walk(entry.path)
+                elif self.fmt_re.search(entry.name) and (
+                    entry.is_file() or entry.is_symlink()
+                ):
+                    yield entry
+
+    def _walks_into(self, name: str) -> bool:
+        return bool(
+            self.shard_re.match(name)
+            or self.namespace_re.match(name)
+            or name == BLOBS_DIR
+        )
+
+    def scan(self, shard: int | None = None) -> ScanResult:
+        """List the saved images with their sizes and last access times.
+
+        Only the files in ``shard`` are listed, if it's given. Access times come
+        from the index when it knows about a file, since `st_atime` isn't updated
+        on file systems mounted with `noatime`.
+        """
+        folders = [self.images_folder] if shard is None else self.shard_folders(shard)
+        files: ScanResult = []
+        for entry in chain.from_iterable(map(self._walk, folders)):
+            if entry.is_symlink():
+                # Links to deduplicated images take no space, unless they're stale.
+                if not os.path.exists(entry.path):
+                    os.unlink(entry.path)
+                continue
+            st = entry.stat()
+            known = self.index.get(entry.name)
+            atime = known[1] if known is not None else st.st_atime
+            files.append((entry.path, st.st_size, atime))
+        return files
+
+    def sync(self, files: Iterable[tuple[str, int, float]], shard: int | None = None):
+        """Replace the contents of the index (or one shard) with a scan."""
+        entries = (
+            (name, size, atime, self.shard_of(name), file)
+            for file, size, atime in files
+            for name in (os.path.basename(file),)
+        )
+        self.index.replace(entries, shard)
+
+    def migrate(self) -> int:
+        """Move saved images into the folders the current layout expects.
+
+        This handles caches from before sharding was added, as well as changes to
+        `SAVED_IMAGES_SHARD_DEPTH`.
+        """
+        num_moved = 0
+        for entry in list(self._walk(self.images_folder)):
+            dest = self.path_for(entry.name, self.namespace_of(entry.path))
+            if entry.path == dest:
+                continue
+            if entry.is_symlink():
+                # Relative links would break when moved, so let them be made again.
+                os.unlink(entry.path)
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                os.replace(entry.path, dest)
+            except FileNotFoundError:
+                continue  # Another worker got to it first.
+            num_moved += 1
+        return num_moved
 
     def get_current_size(self) -> int:
-        files = self.get_current_files()
-        size = sum(map(get_size, files))
+        size = self.index.total_size
         logger.debug("Total: {0}, Max: {1}", *map(natsize, (size, self.max_size)))
         return size
 
+    def add(
+        self,
+        path: str,
+        size: int,
+        atime: float | None = None,
+        cost: float | None = None,
+    ) -> None:
+        """Record a saved image, along with how long it took to render."""
+        name = os.path.basename(path)
+        self.index.add(name, size, atime, self.shard_of(name), path, cost)
+
+    def store(self, path: str, size: int, cost: float | None = None) -> bool:
+        """Record a newly saved image, keeping only one copy of its bytes.
+
+        With `SAVED_IMAGES_DEDUPE`, the image is moved to a file named after a
+        hash of its contents, and ``path`` is replaced with a symlink to it. That
+        file is what's indexed, counted against the size limit and evicted, and
+        images with the same bytes share it. Returns whether it was shared.
+        """
+        if not self.dedupe:
+            self.add(path, size, cost=cost)
+            return False
+        blob = self.blob_path(path)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            shared = True
+        else:
+            shared = False
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.lnk"
+        os.symlink(os.path.relpath(blob, os.path.dirname(path)), tmp_path)
+        os.replace(tmp_path, path)
+        name = os.path.basename(blob)
+        if not shared or not self.index.touch(name):
+            self.add(blob, size, cost=cost)
+        return shared
+
+    def blob_path(self, path: str) -> str:
+        hasher = hashlib.blake2b(digest_size=16, person=BLOB_PERSON)
+        with open(path, "rb") as f:
+            for chunk in iter(partial(f.read, 1 << 16), b""):
+                hasher.update(chunk)
+        ext = path.rpartition(".")[2]
+        return self.path_for(f"{hasher.hexdigest()}.{ext}", BLOBS_DIR)
+
+    def entry_name(self, path: str) -> str:
+        """Get the name ``path`` is indexed under, following a dedupe link."""
+        try:
+            return os.path.basename(os.readlink(path))
+        except OSError:
+            return os.path.basename(path)
+
+    def touch(self, path: str) -> None:
+        self.index.touch(self.entry_name(path))
+
+    @property
+    def accesses(self) -> AccessTracker:
+        if self._accesses is None:
+            interval = config_value("ACCESS_FLUSH_INTERVAL", 5.0, cast_as=float)
+            self._accesses = AccessTracker(self._write_accesses, interval)
+        return self._accesses
+
+    def record_access(self, path: str) -> None:
+        """Note that ``path`` was used, to be written to the index later.
+
+        Dedupe links are only followed when the accesses are written, so that
+        a hit doesn't touch the file system.
+        """
+        self.accesses.record(path)
+
+    def _write_accesses(self, accesses: list[Access]) -> int:
+        merged: dict[str, tuple[float, int]] = {}
+        for path, atime, hits in accesses:
+            name = self.entry_name(path)
+            last, total = merged.get(name, (0.0, 0))
+            merged[name] = (max(last, atime), total + hits)
+        return self.index.touch_many(
+            (name, atime, hits) for name, (atime, hits) in merged.items()
+        )
+
+    def flush_accesses(self) -> int:
+        return self._accesses.flush() if self._accesses is not None else 0
+
+    @contextmanager
+    def render_lock(self, path: str) -> Iterator[None]:
+        """Hold the lock for rendering ``path``, in this process and across workers.
+
+        Threads wait on a lock of their own for each file. Workers share one of
+        256 lock files, picked by the file's hash, so that the folder doesn't
+        fill up with them.
+        """
+        name = os.path.basename(path)
+        stripe = self.hash_strings(name)[:2]
+        lock_path = self.images_folder / LOCKS_DIR / f"{stripe}.lock"
+        with self._flights.hold(name), file_lock(lock_path):
+            yield
+
     @property
     def max_size(self) -> int:
         if self._max_size is None:
             self._max_size = config_value("SAVED_IMAGES_MAX_SIZE", assert_is=int)
         return self._max_size
 
+    @property
+    def high_watermark(self) -> int:
+        if self._high_watermark is None:
+            frac = config_value("SAVED_IMAGES_HIGH_WATERMARK", 1.0, cast_as=float)
+            self._high_watermark = int(self.max_size * frac)
+        return self._high_watermark
+
+    @property
+    def low_watermark(self) -> int:
+        if self._low_watermark is None:
+            frac = config_value("SAVED_IMAGES_LOW_WATERMARK", 0.8, cast_as=float)
+            self._low_watermark = min(int(self.max_size * frac), self.high_watermark)
+        return self._low_watermark
+
     @property
     def images_folder(self) -> Path:
         if self._images_folder is None:
@@ -79,49 +362,182 @@ class GeneratedFiles:
             self._hash_file_names = config_value("HASH_IMG_FILE_NAMES", assert_is=bool)
         return self._hash_file_names
 
+    @property
+    def shard_depth(self) -> int:
+        if self._shard_depth is None:
+            self._shard_depth = config_value("SAVED_IMAGES_SHARD_DEPTH", 0, cast_as=int)
+        return self._shard_depth
+
+    @property
+    def dedupe(self) -> bool:
+        if self._dedupe is None:
+            self._dedupe = config_value("SAVED_IMAGES_DEDUPE", False, cast_as=bool)
+        return self._dedupe
+
+    @property
+    def num_shards(self) -> int:
+        return NUM_SHARDS if self.shard_depth else 1
+
+    def shard_parts(self, name: str) -> tuple[str, ...]:
+        """Get the sub-folders that a file called ``name`` is stored under.
+
+        Each level of sharding is two hex digits from the file's hash, i.e.,
+        ``ab/cd/abcdef....png``.
+        """
+        depth = self.shard_depth
+        if not depth:
+            return ()
+        stem = name.partition(".")[0]
+        digest = stem if self.hex_re.match(stem) else self.hash_strings(stem)
+        return tuple(digest[i : i + 2] for i in range(0, depth * 2, 2))
+
+    def shard_of(self, name: str) -> int:
+        parts = self.shard_parts(name)
+        return int(parts[0], 16) if parts else 0
+
+    def shard_folders(self, shard: int) -> list[Path]:
+        if not self.shard_depth:
+            return [self.images_folder]
+        prefixes = [
+            self.images_folder / ns for ns in ("", BLOBS_DIR, *self.namespaces())
+        ]
+        return [prefix / f"{shard:02x}" for prefix in prefixes]
+
+    def path_for(self, name: str, namespace: str = "") -> str:
+        parts = self.shard_parts(name)
+        return os.path.join(self.images_folder, namespace, *parts, name)
+
     @property
     def need_to_clean(self) -> bool:
-        return self.get_current_size() > self.max_size
+        return self.get_current_size() > self.high_watermark
 
-    def get_file_name(
-        self,
-        size: tuple[int, int],
-        bg: str,
-        fg: str,
-        fmt: str,
-        args: BaseImageArgs,
-        *extra: Any,
-    ) -> str:
-        if not self._done_setup:
-            self.setup()
-        if isinstance(args, TextImageArgs) and args.text:
-            args = attrs.evolve(args, text=self.hash_strings(args.text))
-        params = chain(("x".join(map(str, size)), bg, fg, fmt), args.to_seq(), extra)
+    def get_file_name(self, params: Mapping[str, Any], namespace: str = "") -> str:
+        """Get the path for an image made from canonical ``params``.
+
+        See `BaseGeneratedImage.get_cache_params`. The file goes in the
+        ``namespace`` folder, and since names are indexed without their folder,
+        the namespace is part of the name too.
+        """
+        self.ensure_setup()
         base_name: str
         if not self.hash_file_names:
-            base_name = "-".join(map(str, params)).translate(FNAME_TBL)
+            values = (
+                self.hash_strings(value) if name == "text" else str(value)
+                for name, value in sorted(params.items())
+            )
+            base_name = "-".join((namespace, *values)).translate(FNAME_TBL)
         else:
-            base_name = self.params_hash(*params)
-        path = os.path.join(self.images_folder, f"{base_name}.{fmt}")
-        self.files.add(path)
-        return path
+            base_name = self.params_hash({**params, "namespace": namespace})
+        return self.path_for(f"{base_name}.{params['fmt']}", namespace)
+
+    def collect_for_cleaning(self, shard: int | None = None) -> ScanResult:
+        """Scan (and sync) the saved images, sorted by eviction priority."""
+        files = self.scan(shard)
+        self.sync(files, shard)
+        index = self.index
+
+        def priority(file: tuple[str, int, float]) -> tuple[float, float]:
+            prio = index.priority(os.path.basename(file[0]))
+            return (file[2] if prio is None else prio), file[2]
+
+        return sorted(files, key=priority)
+
+    def eviction_candidates(self) -> Iterator[tuple[int | None, ScanResult]]:
+        """Get batches of files to evict, lowest priority first.
+
+        When the index knows where every file is, a single query gives the files
+        to evict across the whole cache. Otherwise each shard is scanned in turn,
+        largest first. Batches are only made as they're needed.
+        """
+        index = self.index
+        if isinstance(index, SQLiteIndex):
+            yield None, index.lowest_priority(index.total_size - self.low_watermark)
+            return
+        largest = index.largest_shards()
+        known = set(largest)
+        # Shards this process hasn't written to may still hold other workers' files.
+        rest = (s for s in range(self.num_shards) if s not in known)
+        for shard in chain(largest, rest):
+            yield shard, self.collect_for_cleaning(shard)
 
-    def collect_for_cleaning(self) -> list[tuple[str, int, float]]:
-        stats = ((f, f.stat()) for f in self.images_folder.iterdir() if f.is_file())
-        files = ((str(f), st.st_size, st.st_atime) for f, st in stats)
-        return sorted(files, key=itemgetter(2))
+    def evict(self, path: str) -> int:
+        """Remove ``path`` from the cache, moving it to the trash.
+
+        Requests that already opened the file can still send it. It's deleted
+        for good by `reclaim_trash`.
+        """
+        name = os.path.basename(path)
+        trash = self.images_folder / TRASH_DIR / f"{name}.{time.time_ns()}"
+        try:
+            os.rename(path, trash)
+        except FileNotFoundError:
+            pass
+        return self.index.remove(name)
+
+    def stale_files(self, live: set[str]) -> Iterator[str]:
+        """List the saved images that don't belong to a namespace in ``live``.
+
+        That includes images saved before there were namespaces.
+        """
+        folder = self.images_folder
+        for ns in self.namespaces():
+            if ns not in live:
+                yield from (e.path for e in self._walk(folder / ns))
+        for entry in os.scandir(folder):
+            if entry.is_dir(follow_symlinks=False):
+                if self.shard_re.match(entry.name):
+                    yield from (e.path for e in self._walk(entry.path))
+            elif self.fmt_re.search(entry.name):
+                yield entry.path
+
+    def remove_empty_namespaces(self, live: set[str]) -> int:
+        num_removed = 0
+        for ns in self.namespaces():
+            if (
+                ns not in live
+                and next(self._walk(self.images_folder / ns), None) is None
+            ):
+                shutil.rmtree(self.images_folder / ns, ignore_errors=True)
+                num_removed += 1
+        return num_removed
+
+    def scratch_path(self, name: str) -> str:
+        """Get a unique path for an image that won't be kept."""
+        unique = f"{os.getpid()}-{threading.get_ident()}-{time.time_ns()}"
+        return str(self.images_folder / SCRATCH_DIR / f"{unique}-{name}")
+
+    def reclaim_trash(self, grace: float) -> int:
+        """Delete evicted files that have been in the trash for ``grace`` seconds.
+
+        Scratch files that were left behind are deleted too.
+        """
+        cutoff = time.time() - grace
+        num_deleted = 0
+        for folder in (TRASH_DIR, SCRATCH_DIR):
+            try:
+                it = os.scandir(self.images_folder / folder)
+            except FileNotFoundError:
+                continue
+            with it as entries:
+                for entry in entries:
+                    try:
+                        if entry.stat(follow_symlinks=False).st_ctime > cutoff:
+                            continue
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        continue  # Another worker got to it first.
+                    num_deleted += 1
+        return num_deleted
 
     def clean(self) -> int:
-        files = self.collect_for_cleaning()[::-1]
-        total_size = sum(map(itemgetter(1), files))
-        num_deleted, max_size = 0, self.max_size // 2
-        while files and total_size > max_size:
-            file, size, _ = files.pop()
-            os.unlink(file)
+        """Synchronously delete files until under the low watermark."""
+        files = self.collect_for_cleaning()
+        num_deleted = 0
+        for file, _, _ in files:
+            if self.index.total_size <= self.low_watermark:
+                break
+            self.evict(file)
             num_deleted += 1
-            total_size -= size
-        self.files.clear()
-        self.find_current()
         return num_deleted
 
 
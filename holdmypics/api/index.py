@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import threading
+import time
+from array import array
+from collections.abc import Iterable
+from hashlib import blake2b
+from typing import Protocol
+
+from attrs import define, field
+
+from ..utils import natsize
+from .policy import EvictionPolicy, LRUPolicy
+
+INITIAL_CAPACITY = 1 << 10
+MAX_LOAD = 0.75
+NUM_SHARDS = 1 << 8
+
+
+def key_digest(key: str) -> int:
+    """Get a non-zero 64 bit digest for ``key``. Zero marks an empty slot."""
+    digest = blake2b(key.encode("utf-8", errors="replace"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def _zeros(typecode: str, n: int) -> array:
+    return array(typecode, bytes(array(typecode).itemsize * n))
+
+
+class Index(Protocol):
+    policy: EvictionPolicy
+
+    @property
+    def total_size(self) -> int: ...
+
+    @property
+    def clock(self) -> float: ...
+
+    def shard_size(self, shard: int) -> int: ...
+
+    def largest_shards(self) -> list[int]: ...
+
+    def add(
+        self,
+        key: str,
+        size: int,
+        atime: float | None = None,
+        shard: int = 0,
+        path: str = "",
+        cost: float | None = None,
+    ) -> None: ...
+
+    def touch(self, key: str, atime: float | None = None, hits: int = 1) -> bool: ...
+
+    def touch_many(self, accesses: Iterable[tuple[str, float, int]]) -> int: ...
+
+    def get(self, key: str) -> tuple[int, float] | None: ...
+
+    def priority(self, key: str) -> float | None: ...
+
+    def remove(self, key: str) -> int: ...
+
+    def replace(
+        self,
+        entries: Iterable[tuple[str, int, float, int, str]],
+        shard: int | None = None,
+    ) -> None: ...
+
+    def clear(self) -> None: ...
+
+    def __contains__(self, key: str) -> bool: ...
+
+    def __len__(self) -> int: ...
+
+
+@define(repr=False)
+class CacheIndex:
+    """A compact index of cached files.
+
+    Each entry is a 64 bit digest of its key, its size in bytes, the last time
+    (in whole seconds) that it was accessed, the shard it's stored in, how long it
+    took to render, how many hits it's had and its eviction priority. Entries
+    live in parallel arrays that are used as an open addressed hash table, so there
+    is no per entry Python object. The total size, and the size of each shard, are
+    kept up to date as entries are added and removed, which makes them free to
+    check. It's private to a process, so with several workers, each would count
+    (and limit) only what it saved; `SQLiteIndex` is shared.
+    """
+
+    policy: EvictionPolicy = field(factory=LRUPolicy)
+    total_size: int = field(default=0, init=False)
+    shard_sizes: array = field(factory=lambda: _zeros("Q", NUM_SHARDS), init=False)
+    clock: float = field(default=0.0, init=False)
+
+    _count: int = field(default=0, init=False)
+    _digests: array = field(init=False)
+    _sizes: array = field(init=False)
+    _atimes: array = field(init=False)
+    _shards: array = field(init=False)
+    _costs: array = field(init=False)
+    _hits: array = field(init=False)
+    _priorities: array = field(init=False)
+    _lock: threading.RLock = field(factory=threading.RLock, init=False)
+
+    def __attrs_post_init__(self) -> None:
+        self._allocate(INITIAL_CAPACITY)
+
+    def _allocate(self, capacity: int) -> None:
+        self._digests = _zeros("Q", capacity)
+        self._sizes = _zeros("I", capacity)
+        self._atimes = _zeros("I", capacity)
+        self._shards = _zeros("B", capacity)
+        self._costs = _zeros("f", capacity)
+        self._hits = _zeros("I", capacity)
+        self._priorities = _zeros("d", capacity)
+
+    @property
+    def _columns(self) -> tuple[array, ...]:
+        return (
+            self._digests,
+            self._sizes,
+            self._atimes,
+            self._shards,
+            self._costs,
+            self._hits,
+            self._priorities,
+        )
+
+    def _move(self, src: tuple[array, ...], i: int, j: int) -> None:
+        for dest_col, src_col in zip(self._columns, src):
+            dest_col[j] = src_col[i]
+
+    @property
+    def capacity(self) -> int:
+        return len(self._digests)
+
+    def _find(self, digest: int) -> int:
+        """Find the slot holding ``digest``, or the empty slot where it would go."""
+        digests, mask = self._digests, self.capacity - 1
+        i = digest & mask
+        while True:
+            found = digests[i]
+            if found == digest or found == 0:
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self) -> None:
+        old = self._columns
+        self._allocate(self.capacity * 2)
+        for i, digest in enumerate(old[0]):
+            if digest:
+                self._move(old, i, self._find(digest))
+
+    def _prioritize(self, i: int) -> None:
+        self._priorities[i] = self.policy.priority(
+            self._sizes[i], self._costs[i], self._hits[i], self._atimes[i], self.clock
+        )
+
+    def add(
+        self,
+        key: str,
+        size: int,
+        atime: float | None = None,
+        shard: int = 0,
+        path: str = "",
+        cost: float | None = None,
+    ) -> None:
+        """Add or update an entry.
+
+        If ``cost`` isn't given, an existing entry keeps its cost and hit count.
+        """
+        digest = key_digest(key)
+        with self._lock:
+            if (self._count + 1) > self.capacity * MAX_LOAD:
+                self._grow()
+            i = self._find(digest)
+            if self._digests[i]:
+                self._account(self._shards[i], -self._sizes[i])
+            else:
+                self._digests[i] = digest
+                self._costs[i], self._hits[i] = 0.0, 0
+                self._count += 1
+            if cost is not None:
+                self._costs[i], self._hits[i] = cost, 0
+            self._sizes[i] = size
+            self._atimes[i] = int(time.time() if atime is None else atime)
+            self._shards[i] = shard
+            self._prioritize(i)
+            self._account(shard, size)
+
+    def _account(self, shard: int, size: int) -> None:
+        self.total_size += size
+        self.shard_sizes[shard] += size
+
+    def touch(self, key: str, atime: float | None = None, hits: int = 1) -> bool:
+        with self._lock:
+            return self._touch(key, time.time() if atime is None else atime, hits)
+
+    def touch_many(self, accesses: Iterable[tuple[str, float, int]]) -> int:
+        with self._lock:
+            return sum(self._touch(*access) for access in accesses)
+
+    def _touch(self, key: str, atime: float, hits: int) -> bool:
+        i = self._find(key_digest(key))
+        if not self._digests[i]:
+            return False
+        self._atimes[i] = int(atime)
+        self._hits[i] += hits
+        self._prioritize(i)
+        return True
+
+    def get(self, key: str) -> tuple[int, int] | None:
+        with self._lock:
+            i = self._find(key_digest(key))
+            if not self._digests[i]:
+                return None
+            return self._sizes[i], self._atimes[i]
+
+    def priority(self, key: str) -> float | None:
+        with self._lock:
+            i = self._find(key_digest(key))
+            if not self._digests[i]:
+                return None
+            return self._priorities[i]
+
+    def remove(self, key: str) -> int:
+        """Remove ``key`` from the index, returning the size that was freed.
+
+        The clock moves up to the removed entry's priority.
+        """
+        with self._lock:
+            i = self._find(key_digest(key))
+            if not self._digests[i]:
+                return 0
+            self.clock = max(self.clock, self._priorities[i])
+            return self._remove_slot(i)
+
+    def replace(
+        self,
+        entries: Iterable[tuple[str, int, float, int, str]],
+        shard: int | None = None,
+    ) -> None:
+        """Replace every entry (or every entry in ``shard``).
+
+        Entries that are already known keep their cost and hit count.
+        """
+        with self._lock:
+            seen: set[int] = set()
+            for entry in entries:
+                self.add(*entry)
+                seen.add(key_digest(entry[0]))
+            shards = self._shards
+            stale = [
+                d
+                for i, d in enumerate(self._digests)
+                if d and d not in seen and (shard is None or shards[i] == shard)
+            ]
+            for digest in stale:
+                self._remove_slot(self._find(digest))
+
+    def shard_size(self, shard: int) -> int:
+        return self.shard_sizes[shard]
+
+    def largest_shards(self) -> list[int]:
+        """Get the non-empty shards, largest first."""
+        sizes = self.shard_sizes
+        shards = (i for i in range(NUM_SHARDS) if sizes[i])
+        return sorted(shards, key=sizes.__getitem__, reverse=True)
+
+    def _remove_slot(self, i: int) -> int:
+        size = self._sizes[i]
+        self._account(self._shards[i], -size)
+        self._delete_slot(i)
+        self._count -= 1
+        return size
+
+    def _delete_slot(self, i: int) -> None:
+        # Backward shift deletion, so that probe sequences stay unbroken.
+        columns = self._columns
+        digests, mask = self._digests, self.capacity - 1
+        j = i
+        while True:
+            j = (j + 1) & mask
+            digest = digests[j]
+            if not digest:
+                break
+            home = digest & mask
+            if (i <= j and i < home <= j) or (i > j and (home > i or home <= j)):
+                continue
+            self._move(columns, j, i)
+            i = j
+        for col in columns:
+            col[i] = 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._allocate(INITIAL_CAPACITY)
+            self._count = 0
+            self.total_size = 0
+            self.shard_sizes = _zeros("Q", NUM_SHARDS)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __repr__(self) -> str:
+        size = natsize(self.total_size)
+        return f"CacheIndex(entries={len(self)}, size={size}, capacity={self.capacity})"
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import fcntl
+import os
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from attrs import define, field
+
+
+@contextmanager
+def file_lock(path: Path | str, blocking: bool = True) -> Iterator[bool]:
+    """Hold an exclusive ``flock`` on ``path`` for the duration of the block.
+
+    The lock is shared between processes, so it can be used to coordinate
+    gunicorn workers. When ``blocking`` is false, this yields `False` straight
+    away if another process already holds the lock.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+@define(repr=False)
+class KeyedLocks:
+    """In-process locks, one per key, for single-flight work.
+
+    A key's lock only exists while some thread holds or waits on it.
+    """
+
+    _locks: dict[str, tuple[threading.Lock, int]] = field(factory=dict, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+
+    @contextmanager
+    def hold(self, key: str) -> Iterator[None]:
+        with self._lock:
+            lock, waiters = self._locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._locks[key] = (lock, waiters + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                waiters = self._locks[key][1] - 1
+                if waiters:
+                    self._locks[key] = (lock, waiters)
+                else:
+                    del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+@contextmanager
+def atomic_write(path: str) -> Iterator[str]:
+    """Yield a temporary path to write to, which then replaces ``path``.
+
+    Readers either see the old file or the complete new one, never a partial one.
+    """
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
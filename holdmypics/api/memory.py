@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, BinaryIO
+
+from attrs import define, field
+from loguru import logger
+
+from ..utils import config_value, natsize
+
+
+@define(frozen=True)
+class CachedImage:
+    data: bytes = field(repr=False)
+    mimetype: str | None
+    last_modified: float
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+@define(repr=False)
+class MemoryCache:
+    """A bounded, in-process LRU cache of encoded image bytes.
+
+    Entries are keyed by the path that `GeneratedFiles.get_file_name` produces so
+    that a hit can be served without touching the file system at all.
+    """
+
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    current_size: int = field(default=0, init=False)
+
+    _entries: OrderedDict[str, CachedImage] = field(factory=OrderedDict, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+    _max_size: int | None = field(default=None, init=False)
+    _max_item_size: int | None = field(default=None, init=False)
+
+    @property
+    def max_size(self) -> int:
+        if self._max_size is None:
+            self._max_size = config_value("MEMORY_CACHE_MAX_SIZE", 0, cast_as=int)
+        return self._max_size
+
+    @property
+    def max_item_size(self) -> int:
+        if self._max_item_size is None:
+            max_item = config_value("MEMORY_CACHE_MAX_ITEM_SIZE", 0, cast_as=int)
+            self._max_item_size = min(max_item or self.max_size, self.max_size)
+        return self._max_item_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> CachedImage | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CachedImage) -> bool:
+        if not self.enabled or entry.size > self.max_item_size:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_size -= old.size
+            self._entries[key] = entry
+            self.current_size += entry.size
+            while self.current_size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_size -= evicted.size
+                self.evictions += 1
+        return True
+
+    def load(self, path: str, fp: BinaryIO | None = None) -> CachedImage | None:
+        """Read ``path`` into the cache, returning `None` if it won't fit.
+
+        If it's already open, ``fp`` is read instead.
+        """
+        if not self.enabled:
+            return None
+        st = os.stat(path) if fp is None else os.fstat(fp.fileno())
+        if st.st_size > self.max_item_size:
+            return None
+        if fp is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            data = fp.read()
+        mime = mimetypes.guess_type(path)[0]
+        entry = CachedImage(data, mime, st.st_mtime)
+        if self.put(path, entry):
+            logger.debug("Cached {0!r} in memory", os.path.basename(path))
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_size = 0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size": self.current_size,
+            "max_size": self.max_size,
+        }
+
+    def __repr__(self) -> str:
+        size, max_size = map(natsize, (self.current_size, self.max_size))
+        return f"MemoryCache(entries={len(self)}, size={size}, max_size={max_size})"
+
+
+memory_cache = MemoryCache()
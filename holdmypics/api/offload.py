@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import os
+from collections.abc import Callable, Iterable
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+from urllib.parse import quote, unquote
+
+from attrs import define
+from flask import current_app
+from werkzeug.datastructures import Headers
+
+from ..utils import config_value
+
+if TYPE_CHECKING:
+    from _typeshed.wsgi import StartResponse, WSGIApplication, WSGIEnvironment
+
+    from .._types import ResObject
+
+X_ACCEL_REDIRECT = "x-accel-redirect"
+X_SENDFILE = "x-sendfile"
+OFFLOAD_MODES = (X_ACCEL_REDIRECT, X_SENDFILE)
+OFFLOAD_HEADERS = {X_ACCEL_REDIRECT: "X-Accel-Redirect", X_SENDFILE: "X-Sendfile"}
+
+
+def offload_mode() -> str | None:
+    return config_value("SEND_FILE_OFFLOAD", None) or None
+
+
+def offload_response(path: str, mimetype: str | None, etag: str | bool) -> ResObject:
+    """Hand sending ``path`` off to the front proxy.
+
+    With ``x-accel-redirect``, the header holds the path under
+    `SEND_FILE_OFFLOAD_PREFIX`, which nginx should map to an ``internal``
+    location aliased to `SAVED_IMAGES_CACHE_DIR`. With ``x-sendfile`` it's the
+    absolute path. Either way, the body is left for the proxy to fill in.
+    """
+    mode = offload_mode()
+    if mode == X_ACCEL_REDIRECT:
+        folder = config_value("SAVED_IMAGES_CACHE_DIR", assert_is=Path)
+        prefix = config_value("SEND_FILE_OFFLOAD_PREFIX", "/_cached-images/")
+        rel_path = Path(path).relative_to(folder).as_posix()
+        value = prefix.rstrip("/") + "/" + quote(rel_path)
+    else:
+        value = os.path.abspath(path)
+    res = current_app.response_class(mimetype=mimetype)
+    res.headers[OFFLOAD_HEADERS[mode or X_SENDFILE]] = value
+    res.content_length = os.path.getsize(path)
+    if etag:
+        res.set_etag(etag)
+    return res
+
+
+@define()
+class OffloadProxy:
+    """WSGI middleware that does what the front proxy does with offloaded files.
+
+    This is for running locally or in tests without nginx: the offload header is
+    removed, and the file it points at is sent as the body.
+    """
+
+    app: WSGIApplication
+    folder: Path
+    prefix: str = "/_cached-images/"
+
+    def resolve(self, headers: Headers) -> str | None:
+        accel = headers.pop("X-Accel-Redirect", None)
+        if accel is not None:
+            prefix = self.prefix.rstrip("/") + "/"
+            if not accel.startswith(prefix):
+                return None
+            rel_path = unquote(accel[len(prefix) :])
+            path = os.path.abspath(os.path.join(self.folder, rel_path))
+            # Like an nginx alias, nothing outside of the folder can be reached.
+            inside = os.path.commonpath([path, os.path.abspath(self.folder)])
+            return path if inside == os.path.abspath(self.folder) else None
+        return headers.pop("X-Sendfile", None)
+
+    def __call__(
+        self, environ: WSGIEnvironment, start_response: StartResponse
+    ) -> Iterable[bytes]:
+        captured: dict[str, Any] = {}
+
+        def capture(
+            status: str, headers: list[tuple[str, str]], exc_info: Any = None
+        ) -> Callable[[bytes], object]:
+            captured.update(status=status, headers=headers, exc_info=exc_info)
+            return lambda data: None
+
+        body = self.app(environ, capture)
+        headers = Headers(captured["headers"])
+        if not any(name in headers for name in OFFLOAD_HEADERS.values()):
+            start_response(captured["status"], captured["headers"])
+            return body
+        if hasattr(body, "close"):
+            body.close()  # type: ignore[attr-defined]
+        path = self.resolve(headers)
+        try:
+            with open(path or "", "rb") as f:
+                data = f.read()
+        except OSError:
+            start_response("404 NOT FOUND", [("Content-Length", "0")])
+            return [b""]
+        headers["Content-Length"] = str(len(data))
+        start_response(captured["status"], headers.to_wsgi_list())
+        return [data]
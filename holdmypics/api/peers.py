@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import bisect
+import hmac
+import os
+import time
+import urllib.error
+import urllib.request
+from io import BytesIO
+from typing import Any, Protocol
+
+from attrs import define, field
+from loguru import logger
+from PIL import Image
+
+from ..utils import config_value
+from .files import GeneratedFiles, files
+from .index import key_digest
+from .locks import atomic_write
+from .utils import normalize_fmt
+
+SECRET_HEADER = "X-Holdmypics-Peer"
+PEER_PATH = "/api/peer/"
+
+
+class Transport(Protocol):
+    def __call__(
+        self,
+        method: str,
+        url: str,
+        headers: dict[str, str],
+        data: bytes | None,
+        timeout: float,
+    ) -> tuple[int, bytes]:
+        """Make a request, returning the status code and body.
+
+        Should raise `OSError` if the peer couldn't be reached.
+        """
+        ...
+
+
+def urllib_transport(
+    method: str,
+    url: str,
+    headers: dict[str, str],
+    data: bytes | None,
+    timeout: float,
+) -> tuple[int, bytes]:
+    req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return res.status, res.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, b""
+
+
+@define(repr=False)
+class HashRing:
+    """Consistent hashing over ``nodes``, each placed at ``replicas`` points.
+
+    Adding or removing a node only moves the keys next to its points.
+    """
+
+    nodes: list[str]
+    replicas: int = 64
+    _points: list[int] = field(init=False, factory=list)
+    _owners: list[str] = field(init=False, factory=list)
+
+    def __attrs_post_init__(self) -> None:
+        ring = sorted(
+            (key_digest(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(self.replicas)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    def owner(self, key: str) -> str | None:
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, key_digest(key)) % len(self._points)
+        return self._owners[i]
+
+
+@define(repr=False)
+class PeerCache:
+    """Fetches images from the node that owns them, before rendering them.
+
+    Every image is owned by one of the `PEERS`, picked by consistent hashing of
+    its name. On a miss, a node asks the owner for the image, and if the owner
+    doesn't have it either, renders it and sends it to the owner. The next node
+    to miss it can then get it from the owner. Peers only answer with what they
+    have on disk, so a request is never passed along.
+
+    A peer that can't be reached is skipped for `PEER_RETRY_AFTER` seconds,
+    which leaves its images to be rendered locally. Peers are only enabled with a
+    `PEER_SECRET`, since they save what other nodes send them.
+    """
+
+    files: GeneratedFiles = field(default=files)
+    transport: Transport = field(default=urllib_transport)
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    errors: int = field(default=0, init=False)
+    served: int = field(default=0, init=False)
+    filled: int = field(default=0, init=False)
+
+    _ring: HashRing | None = field(default=None, init=False)
+    _self_url: str | None = field(default=None, init=False)
+    _secret: str | None = field(default=None, init=False)
+    _timeout: float | None = field(default=None, init=False)
+    _retry_after: float | None = field(default=None, init=False)
+    _max_item_size: int | None = field(default=None, init=False)
+    _down: dict[str, float] = field(factory=dict, init=False)
+    _warned: bool = field(default=False, init=False)
+
+    @property
+    def ring(self) -> HashRing:
+        if self._ring is None:
+            peers = config_value("PEERS", None) or []
+            vnodes = config_value("PEER_VNODES", 64, cast_as=int)
+            self._ring = HashRing([p.rstrip("/") for p in peers], vnodes)
+        return self._ring
+
+    @property
+    def self_url(self) -> str:
+        if self._self_url is None:
+            self._self_url = config_value("PEER_SELF", "", cast_as=str).rstrip("/")
+        return self._self_url
+
+    @property
+    def configured(self) -> bool:
+        return len(self.ring.nodes) > 1 and self.self_url in self.ring.nodes
+
+    @property
+    def enabled(self) -> bool:
+        if not self.configured:
+            return False
+        if not self.secret:
+            if not self._warned:
+                self._warned = True
+                logger.warning("PEERS are ignored without a PEER_SECRET")
+            return False
+        return True
+
+    @property
+    def secret(self) -> str:
+        if self._secret is None:
+            self._secret = config_value("PEER_SECRET", "", cast_as=str)
+        return self._secret
+
+    @property
+    def timeout(self) -> float:
+        if self._timeout is None:
+            self._timeout = config_value("PEER_TIMEOUT", 1.0, cast_as=float)
+        return self._timeout
+
+    @property
+    def retry_after(self) -> float:
+        if self._retry_after is None:
+            retry = config_value("PEER_RETRY_AFTER", 30.0, cast_as=float)
+            self._retry_after = retry
+        return self._retry_after
+
+    @property
+    def max_item_size(self) -> int:
+        if self._max_item_size is None:
+            size = config_value("PEER_MAX_ITEM_SIZE", int(2e6), cast_as=int)
+            self._max_item_size = size
+        return self._max_item_size
+
+    def owner(self, key: str) -> str | None:
+        """Get the node to ask for ``key``, or `None` if it's this one."""
+        owner = self.ring.owner(key)
+        if owner is None or owner == self.self_url:
+            return None
+        if self._down.get(owner, 0.0) > time.monotonic():
+            return None
+        return owner
+
+    def authorized(self, secret: str | None) -> bool:
+        # Without a secret, nothing is authorized.
+        return bool(self.secret) and hmac.compare_digest(secret or "", self.secret)
+
+    def _request(
+        self, owner: str, method: str, key: str, data: bytes | None = None
+    ) -> tuple[int, bytes] | None:
+        headers = {SECRET_HEADER: self.secret}
+        url = f"{owner}{PEER_PATH}{key}"
+        try:
+            return self.transport(method, url, headers, data, self.timeout)
+        except OSError as exc:
+            self.errors += 1
+            self._down[owner] = time.monotonic() + self.retry_after
+            logger.warning("Peer {0} is unavailable: {1}", owner, exc)
+            return None
+
+    def get(self, path: str) -> bytes | None:
+        """Ask the owner of ``path`` for it."""
+        if not self.enabled:
+            return None
+        key = self.files.key_for(path)
+        owner = self.owner(key)
+        if owner is None:
+            return None
+        res = self._request(owner, "GET", key)
+        if res is None or res[0] != 200:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return res[1]
+
+    def put_file(self, path: str) -> bool:
+        """Send a newly rendered image to its owner."""
+        if not self.enabled:
+            return False
+        key = self.files.key_for(path)
+        owner = self.owner(key)
+        if owner is None or os.path.getsize(path) > self.max_item_size:
+            return False
+        with open(path, "rb") as f:
+            res = self._request(owner, "PUT", key, f.read())
+        return res is not None and res[0] < 300
+
+    def local_path(self, namespace: str, name: str) -> str | None:
+        """Get the path to a saved image that a peer asked for, if it's here."""
+        self.files.ensure_setup()
+        path = self.files.path_for(name, namespace)
+        if not os.path.isfile(path):
+            return None
+        self.served += 1
+        self.files.record_access(path)
+        return path
+
+    def valid_image(self, name: str, data: bytes) -> bool:
+        """Check that ``data`` decodes as an image in the format ``name`` is for."""
+        fmt = normalize_fmt(os.path.splitext(name)[1].lstrip(".").lower())
+        try:
+            with Image.open(BytesIO(data)) as im:
+                if (im.format or "").lower() != fmt:
+                    return False
+                # This checks the file's structure (and checksums, for PNG),
+                # but leaves the image unusable, so it's opened again to decode.
+                im.verify()
+            with Image.open(BytesIO(data)) as im:
+                im.load()
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+            return False
+        return True
+
+    def fill(self, namespace: str, name: str, data: bytes) -> bool:
+        """Save an image that a peer rendered, if it isn't here already.
+
+        Returns false if it's too large, or isn't a valid image.
+        """
+        if len(data) > self.max_item_size or not self.valid_image(name, data):
+            return False
+        self.files.ensure_setup()
+        path = self.files.path_for(name, namespace)
+        with self.files.render_lock(path):
+            if os.path.isfile(path):
+                return True
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_write(path) as tmp_path, open(tmp_path, "wb") as f:
+                f.write(data)
+            self.files.store(path, len(data))
+        self.filled += 1
+        return True
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "peers": len(self.ring.nodes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "served": self.served,
+            "filled": self.filled,
+        }
+
+
+peer_cache = PeerCache()
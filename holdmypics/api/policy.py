@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import ClassVar
+
+from attrs import frozen
+
+# Keeps entries that were free to make from all having the same priority.
+MIN_COST = 1e-6
+# Access times are scaled to less than one, to break ties between hit counts.
+ATIME_SCALE = float(1 << 32)
+
+
+class EvictionPolicy(ABC):
+    """Decides which cached files are evicted first.
+
+    Each entry gets a priority when it's added or accessed, and the entries with
+    the lowest priority are evicted first. The ``clock`` is the priority of the
+    most recently evicted entry, which policies can use to age old entries out.
+    """
+
+    name: ClassVar[str]
+
+    @abstractmethod
+    def priority(
+        self, size: int, cost: float, hits: int, atime: float, clock: float
+    ) -> float: ...
+
+
+@frozen()
+class LRUPolicy(EvictionPolicy):
+    """Evict the least recently used entries."""
+
+    name: ClassVar[str] = "lru"
+
+    def priority(
+        self, size: int, cost: float, hits: int, atime: float, clock: float
+    ) -> float:
+        return atime
+
+
+@frozen()
+class LFUPolicy(EvictionPolicy):
+    """Evict the least frequently used entries, ties going to the least recent.
+
+    The priority is the hit count, plus the access time as a fraction.
+    """
+
+    name: ClassVar[str] = "lfu"
+
+    def priority(
+        self, size: int, cost: float, hits: int, atime: float, clock: float
+    ) -> float:
+        return hits + atime / ATIME_SCALE
+
+
+@frozen()
+class GDSFPolicy(EvictionPolicy):
+    """GreedyDual-Size-Frequency.
+
+    Entries are worth their hit count times the time it took to render them, per
+    byte. Starting from the clock means that entries which haven't been used
+    since it moved past them are evicted before newer ones.
+    """
+
+    name: ClassVar[str] = "gdsf"
+
+    def priority(
+        self, size: int, cost: float, hits: int, atime: float, clock: float
+    ) -> float:
+        return clock + (hits + 1) * max(cost, MIN_COST) / max(size, 1)
+
+
+POLICIES: dict[str, EvictionPolicy] = {
+    policy.name: policy for policy in (LRUPolicy(), LFUPolicy(), GDSFPolicy())
+}
+
+
+def get_policy(name: str) -> EvictionPolicy:
+    try:
+        return POLICIES[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown eviction policy: {name!r}") from None
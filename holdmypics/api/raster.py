@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from attrs import define, field
+from PIL import Image
+
+from ..utils import config_value, natsize
+
+
+def raster_size(im: Image.Image) -> int:
+    return im.width * im.height * len(im.getbands())
+
+
+@define(repr=False)
+class RasterCache:
+    """A bounded, in-process LRU cache of rendered, not yet encoded, images.
+
+    Entries are keyed by the parameters that don't depend on the format, so that
+    requesting an image in a second format only has to encode it again. Images
+    are copied on the way in and out, since saving an image closes it.
+    """
+
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    current_size: int = field(default=0, init=False)
+
+    _entries: OrderedDict[str, Image.Image] = field(factory=OrderedDict, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+    _max_size: int | None = field(default=None, init=False)
+
+    @property
+    def max_size(self) -> int:
+        if self._max_size is None:
+            self._max_size = config_value("RASTER_CACHE_MAX_SIZE", 0, cast_as=int)
+        return self._max_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Image.Image | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            im = self._entries.get(key)
+            if im is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return im.copy()
+
+    def put(self, key: str, im: Image.Image) -> bool:
+        size = raster_size(im)
+        if not self.enabled or size > self.max_size:
+            return False
+        im = im.copy()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_size -= raster_size(old)
+            self._entries[key] = im
+            self.current_size += size
+            while self.current_size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_size -= raster_size(evicted)
+                self.evictions += 1
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_size = 0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size": self.current_size,
+            "max_size": self.max_size,
+        }
+
+    def __repr__(self) -> str:
+        size, max_size = map(natsize, (self.current_size, self.max_size))
+        return f"RasterCache(entries={len(self)}, size={size}, max_size={max_size})"
+
+
+raster_cache = RasterCache()
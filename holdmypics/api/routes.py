@@ -1,15 +1,17 @@
 from __future__ import annotations
 
+import io
 import mimetypes
+import os
 import random
+import time
 from collections.abc import Callable
-from typing import Any
+from typing import Any, BinaryIO
 from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 
+from attrs import evolve
 from flask import (
-    Response,
     abort,
-    after_this_request,
     current_app,
     redirect,
     request,
@@ -17,23 +19,37 @@ from flask import (
 )
 from loguru import logger
 from PIL import features
+from werkzeug.wsgi import wrap_file
 
 from holdmypics.api.base import BaseGeneratedImage
 from .. import redisw
 from .._types import ResObject, ResponseType
-from ..constants import IMG_FORMATS, IMG_FORMATS_STR, NO_CACHE
+from ..constants import CACHE_CONTROL_MAX, IMG_FORMATS, IMG_FORMATS_STR, NO_CACHE
 from ..fonts import fonts
 from ..utils import make_rules
 from . import bp
+from .admission import admission
 from .anim import make_anim
 from .args import TextImageArgs, TiledImageArgs
+from .canonical import image_redirect, tiled_redirect
+from .evict import evictor
 from .files import files
+from .memory import CachedImage, memory_cache
+from .offload import offload_mode, offload_response
+from .peers import SECRET_HEADER, peer_cache
+from .raster import raster_cache
+from .shared import shared_cache
+from .shm import ShmEntry, shm_cache
+from .snap import Snap
+from .stats import CacheStatus, cache_stats
+from .storage import image_store
 from .text import GeneratedTextImage
 from .tiled import GeneratedTiledImage
 from .utils import RAND_COLOR
 
 WEBP_ANIM = features.check_feature("webp_anim")
 ANIM_FMTS = {"gif"}.union({"webp"} if WEBP_ANIM else set())
+OPEN_ATTEMPTS = 3
 
 
 def make_route(prefix: str = "") -> Callable:
@@ -51,13 +67,6 @@ def make_route(prefix: str = "") -> Callable:
     return func
 
 
-def do_cleanup(res: Response) -> Response:
-    n = files.clean()
-    if n > 0:
-        logger.info("Removed {0} file{1}", n, "" if n == 1 else "s")
-    return res
-
-
 def font_redirect(font_name: str) -> ResponseType:
     if font_name.lower() in fonts.font_names:
         parts = urlsplit(request.url)
@@ -84,9 +93,26 @@ def check_format(fmt: str) -> str:
     return fmt
 
 
-def get_send_file_kwargs(path: str) -> dict[str, Any]:
+def get_send_file_kwargs(path: str, etag: str | bool) -> dict[str, Any]:
     mime = mimetypes.guess_type(path)[0]
-    return {"mimetype": mime, "etag": not current_app.debug, "conditional": True}
+    return {"mimetype": mime, "etag": etag, "conditional": True}
+
+
+def get_cached_send_file_kwargs(
+    cached: CachedImage, etag: str | bool
+) -> dict[str, Any]:
+    return {
+        "mimetype": cached.mimetype,
+        "etag": etag,
+        "last_modified": cached.last_modified,
+        "conditional": True,
+    }
+
+
+def not_modified(etag: str) -> ResObject:
+    res = current_app.response_class(status=304)
+    res.set_etag(etag)
+    return res
 
 
 @bp.route("/count/")
@@ -94,17 +120,179 @@ def count_route():
     return {"count": redisw.get_count()}
 
 
+@bp.route("/peer/<namespace>/<name>", methods=["GET", "PUT"])
+def peer_route(namespace: str, name: str) -> ResponseType:
+    """Send (or save) a saved image for another node, see `PeerCache`."""
+    if not peer_cache.configured:
+        abort(404)
+    if not peer_cache.authorized(request.headers.get(SECRET_HEADER)):
+        abort(403)
+    if not files.namespace_re.match(namespace) or not files.name_re.match(name):
+        abort(400)
+    if request.method == "PUT":
+        data = request.get_data()
+        if len(data) > peer_cache.max_item_size:
+            abort(413)
+        if not peer_cache.fill(namespace, name, data):
+            abort(400)
+        return "", 204
+    path = peer_cache.local_path(namespace, name)
+    if path is None:
+        abort(404)
+    try:
+        fp = open(path, "rb")  # noqa: SIM115
+    except FileNotFoundError:
+        abort(404)
+    return send_file_from_disk(path, fp, False, offload=False)
+
+
 @bp.route("/stats/")
 def stats_route():
-    return {"count": redisw.get_count(), "size": redisw.get_size()}
+    cache_size = files.get_current_size()
+    return {
+        "count": redisw.get_count(),
+        "size": redisw.get_size(),
+        "memory": memory_cache.stats(),
+        "raster": raster_cache.stats(),
+        "shared": shared_cache.stats(),
+        "admission": admission.stats(),
+        "shm": shm_cache.stats(),
+        "peers": peer_cache.stats(),
+        "storage": image_store.stats(),
+        "cache": {
+            "worker": {**cache_stats.worker(), "entries": len(files.index)},
+            "total": cache_stats.total(),
+            "size": cache_size,
+            "max_size": files.max_size,
+        },
+    }
+
+
+def add_cache_headers(
+    res: ResObject, status: CacheStatus, last_modified: float
+) -> ResObject:
+    age = 0 if status is CacheStatus.MISS else time.time() - last_modified
+    res.headers["X-Cache"] = status.value
+    res.headers["Age"] = str(max(int(age), 0))
+    return res
+
+
+def get_img_response(img: BaseGeneratedImage, deterministic: bool = True) -> ResObject:
+    """Send ``img``, rendering it if it isn't cached.
+
+    Images that will always look the same for a URL are sent as immutable, and
+    conditional requests for them are answered before anything else.
+    """
+    etag = img.get_etag() if not current_app.debug else False
+    if etag and deterministic and request.if_none_match.contains(etag):
+        cache_stats.record(CacheStatus.HIT, 0)
+        res = not_modified(etag)
+        res.headers["X-Cache"] = CacheStatus.HIT.value
+        res.headers["Cache-Control"] = CACHE_CONTROL_MAX
+        return res
+    res = send_img(img, etag)
+    res.headers["Cache-Control"] = CACHE_CONTROL_MAX if deterministic else NO_CACHE
+    return res
+
+
+def open_img(img: BaseGeneratedImage) -> tuple[str, BinaryIO, CacheStatus]:
+    """Get the path to ``img``, rendering it if needed, and open it.
+
+    An open file can still be sent after it's evicted, so the only race left is
+    between finding the file and opening it, which is retried.
+    """
+    for attempt in range(1, OPEN_ATTEMPTS + 1):
+        path = img.get_path()
+        status = img.cache_status or CacheStatus.MISS
+        if files.need_to_clean:
+            evictor.wake()
+        else:
+            evictor.ensure_running()
+        try:
+            fp = open(path, "rb")  # noqa: SIM115
+        except FileNotFoundError:
+            if attempt == OPEN_ATTEMPTS:
+                raise
+            name = os.path.basename(path)
+            logger.info("{0!r} was evicted before it could be opened", name)
+            continue
+        if img.transient:
+            # Nothing else will use it, and it can still be read now that it's open.
+            os.unlink(path)
+        return path, fp, status
+    raise AssertionError("unreachable")
+
+
+def send_file_from_disk(
+    path: str, fp: BinaryIO, etag: str | bool, offload: bool = True
+) -> ResObject:
+    if offload and offload_mode() is not None:
+        fp.close()
+        mimetype = mimetypes.guess_type(path)[0]
+        return offload_response(path, mimetype, etag)
+    st = os.fstat(fp.fileno())
+    kw = get_send_file_kwargs(path, etag)
+    res = send_file(fp, last_modified=st.st_mtime, **kw)
+    if res.status_code == 200:
+        res.content_length = st.st_size
+    return res
 
 
-def get_img_response(img: BaseGeneratedImage) -> ResObject:
-    path = img.get_path()
-    if files.need_to_clean:
-        after_this_request(do_cleanup)
-    kw = get_send_file_kwargs(path)
-    return send_file(path, **kw)
+def send_shm_entry(entry: ShmEntry, path: str, etag: str | bool) -> ResObject:
+    # The body is read from the shared pages, and checked as it's read.
+    body = wrap_file(request.environ, shm_cache.open(entry))
+    mime = mimetypes.guess_type(path)[0]
+    res = current_app.response_class(body, mimetype=mime, direct_passthrough=True)
+    res.content_length = entry.length
+    res.last_modified = entry.mtime  # type: ignore[assignment]
+    if etag:
+        res.set_etag(etag)
+    return res.make_conditional(request)
+
+
+def send_img_from_shm(img: BaseGeneratedImage, etag: str | bool) -> ResObject:
+    path = img.get_img_path()
+    entry = shm_cache.lookup(path)
+    if entry is None:
+        path, fp, status = open_img(img)
+        entry = None if img.transient else shm_cache.load(path, fp)
+        if entry is None:
+            st = os.fstat(fp.fileno())
+            cache_stats.record(status, st.st_size)
+            res = send_file_from_disk(path, fp, etag)
+            return add_cache_headers(res, status, st.st_mtime)
+        fp.close()
+    else:
+        status = CacheStatus.HIT
+        files.record_access(path)
+    cache_stats.record(status, entry.length)
+    res = send_shm_entry(entry, path, etag)
+    return add_cache_headers(res, status, entry.mtime)
+
+
+def send_img(img: BaseGeneratedImage, etag: str | bool) -> ResObject:
+    # When the proxy sends files, there's no point in keeping them in memory.
+    use_memory = offload_mode() is None
+    if use_memory and shm_cache.enabled:
+        return send_img_from_shm(img, etag)
+    cached = memory_cache.get(img.get_img_path()) if use_memory else None
+    if cached is None:
+        path, fp, status = open_img(img)
+        keep = use_memory and not img.transient
+        cached = memory_cache.load(path, fp) if keep else None
+        if cached is None:
+            st = os.fstat(fp.fileno())
+            cache_stats.record(status, st.st_size)
+            res = send_file_from_disk(path, fp, etag, offload=not img.transient)
+            return add_cache_headers(res, status, st.st_mtime)
+        fp.close()
+    else:
+        status = CacheStatus.HIT
+        files.record_access(img.get_img_path())
+    cache_stats.record(status, cached.size)
+    kw = get_cached_send_file_kwargs(cached, etag)
+    res = send_file(io.BytesIO(cached.data), **kw)
+    return add_cache_headers(res, status, cached.last_modified)
 
 
 @make_route()
@@ -114,6 +302,12 @@ def image_route(
     check_size(size)
     fmt = check_format(fmt)
     args = TextImageArgs.from_request()
+    snap = Snap.from_request()
+    if snap is not None:
+        size = snap.size(size)
+    canonical = image_redirect(size, bg_color, fg_color, fmt)
+    if canonical is not None:
+        return canonical
     if args.font_name not in fonts.font_names:
         return font_redirect(args.font_name)
 
@@ -121,12 +315,15 @@ def image_route(
     if RAND_COLOR in {bg_lower, fg_lower}:
         random.seed(args.seed)
 
+    if snap is not None:
+        bg_color, fg_color = snap.color(bg_color), snap.color(fg_color)
     img = GeneratedTextImage(size, fmt, bg_color, fg_color, args)
-    res = get_img_response(img)
-    if args.random_text or RAND_COLOR in {bg_lower, fg_lower}:
-        res.headers["Cache-Control"] = NO_CACHE
+    random_img = args.random_text or RAND_COLOR in {bg_lower, fg_lower}
+    res = get_img_response(img, deterministic=not random_img)
     if args.random_text and args.text:
         res.headers["X-Random-Text"] = args.text
+    if snap is not None:
+        res.headers["X-Image-Size"] = "x".join(map(str, size))
 
     return res
 
@@ -154,8 +351,19 @@ def tiled_route(size: tuple[int, int], cols: int, rows: int, fmt: str) -> Respon
     check_size(size)
     fmt = check_format(fmt)
     args = TiledImageArgs.from_request()
+    requested = request.args.getlist("colors")
+    snap = Snap.from_request()
+    if snap is not None:
+        size = snap.size(size)
+    canonical = tiled_redirect(size, cols, rows, fmt)
+    if canonical is not None:
+        return canonical
+    if snap is not None:
+        args = evolve(args, colors=snap.colors(requested, args.colors))
     img = GeneratedTiledImage(size, fmt, "0000", "0000", args, cols, rows)
-    res = get_img_response(img)
-    res.headers["Cache-Control"] = NO_CACHE
+    random_img = RAND_COLOR in map(str.casefold, requested)
+    res = get_img_response(img, deterministic=not random_img)
+    if snap is not None:
+        res.headers["X-Image-Size"] = "x".join(map(str, size))
 
     return res
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import os
+import secrets
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from attrs import define, field
+from loguru import logger
+
+from .. import redisw
+from ..utils import config_value
+
+KEY_PREFIX = "holdmypics:img:"
+LOCK_PREFIX = "holdmypics:lock:"
+POLL_INTERVAL = 0.05
+
+
+@define(repr=False)
+class SharedCache:
+    """An optional cache of encoded images that is shared by every node.
+
+    Images are stored in Redis under their file names, which are already
+    canonical, with a TTL. Redis bounds the total size itself, so the server
+    should be run with ``maxmemory`` and ``maxmemory-policy volatile-lru`` set
+    (or be a separate instance): only the images have a TTL, not the counters.
+    Without `REDIS_URL`, `FakeRedis` stands in, bounded by
+    `SHARED_CACHE_MAX_SIZE`.
+
+    A render lock makes sure that only one node renders a missing image, while
+    the others wait for it to show up.
+    """
+
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    waits: int = field(default=0, init=False)
+
+    _enabled: bool | None = field(default=None, init=False)
+    _ttl: int | None = field(default=None, init=False)
+    _max_item_size: int | None = field(default=None, init=False)
+    _lock_timeout: float | None = field(default=None, init=False)
+
+    @property
+    def enabled(self) -> bool:
+        if self._enabled is None:
+            self._enabled = config_value("SHARED_CACHE", False, cast_as=bool)
+        return self._enabled
+
+    @property
+    def ttl(self) -> int:
+        if self._ttl is None:
+            self._ttl = config_value("SHARED_CACHE_TTL", 86400, cast_as=int)
+        return self._ttl
+
+    @property
+    def max_item_size(self) -> int:
+        if self._max_item_size is None:
+            size = config_value("SHARED_CACHE_MAX_ITEM_SIZE", int(2e6), cast_as=int)
+            self._max_item_size = size
+        return self._max_item_size
+
+    @property
+    def lock_timeout(self) -> float:
+        if self._lock_timeout is None:
+            timeout = config_value("SHARED_CACHE_LOCK_TIMEOUT", 10.0, cast_as=float)
+            self._lock_timeout = timeout
+        return self._lock_timeout
+
+    def get(self, name: str) -> bytes | None:
+        if not self.enabled:
+            return None
+        data = redisw.client.get(KEY_PREFIX + name)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, name: str, data: bytes) -> bool:
+        if not self.enabled or len(data) > self.max_item_size:
+            return False
+        redisw.client.set(KEY_PREFIX + name, data, ex=self.ttl)
+        return True
+
+    def put_file(self, path: str) -> bool:
+        if not self.enabled or os.path.getsize(path) > self.max_item_size:
+            return False
+        with open(path, "rb") as f:
+            return self.put(os.path.basename(path), f.read())
+
+    def wait_for(self, name: str) -> bytes | None:
+        """Poll for ``name`` while another node renders it."""
+        self.waits += 1
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            data = redisw.client.get(KEY_PREFIX + name)
+            if data is not None:
+                self.hits += 1
+                return data
+            time.sleep(POLL_INTERVAL)
+        logger.warning("Gave up waiting for {0!r}", name)
+        return None
+
+    @contextmanager
+    def render_lock(self, name: str) -> Iterator[bool]:
+        """Try to become the node that renders ``name``.
+
+        Yields `True` if the lock was acquired (or the cache is disabled). The
+        lock expires after `SHARED_CACHE_LOCK_TIMEOUT`, so a crashed node can
+        only hold up the others for that long.
+        """
+        if not self.enabled:
+            yield True
+            return
+        key, token = LOCK_PREFIX + name, secrets.token_hex(8)
+        timeout_ms = int(self.lock_timeout * 1000)
+        acquired = bool(redisw.client.set(key, token, px=timeout_ms, nx=True))
+        try:
+            yield acquired
+        finally:
+            # Don't release a lock that expired and was taken by another node.
+            if acquired:
+                redisw.delete_if_equal(key, token)
+
+    def stats(self) -> dict[str, int | bool]:
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "waits": self.waits,
+        }
+
+
+shared_cache = SharedCache()
@@ -0,0 +1,323 @@
+from __future__ import annotations
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from attrs import define, field, frozen
+from loguru import logger
+
+from ..utils import config_value, natsize
+from .index import key_digest
+
+MAGIC = b"HMPSHM01"
+# Magic, number of slots, padding, size of the data region, write cursor.
+HEADER = struct.Struct("<8sIIQQ")
+HEADER_SIZE = 64
+CURSOR = struct.Struct("<Q")
+CURSOR_OFFSET = 24
+# Sequence number, length, key digest, position in the data region, mtime.
+SLOT = struct.Struct("<IIQQd")
+SEQ = struct.Struct("<I")
+# Every record in the data region starts with its key digest and length.
+RECORD = struct.Struct("<QI4x")
+PROBES = 8
+READ_RETRIES = 4
+
+
+def data_offset(slots: int) -> int:
+    end = HEADER_SIZE + slots * SLOT.size
+    return -(-end // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+def _init_arena(fd: int, size: int, slots: int) -> None:
+    os.ftruncate(fd, 0)
+    os.ftruncate(fd, data_offset(slots) + size)
+    os.pwrite(fd, HEADER.pack(MAGIC, slots, 0, size, 0), 0)
+
+
+def create_arena(path: str | Path, size: int, slots: int) -> None:
+    """Create (or reset) the arena at ``path``.
+
+    This is meant to be run by the gunicorn master before it forks any workers,
+    so that they all attach to the same, empty arena.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        _init_arena(fd, size, slots)
+    finally:
+        os.close(fd)
+    logger.info("Created a {0} shared memory cache at {1}", natsize(size), path)
+
+
+class OverwrittenError(OSError):
+    """An entry was overwritten while it was being read."""
+
+
+@frozen()
+class ShmEntry:
+    offset: int
+    length: int
+    mtime: float
+    # Where the entry's record starts in the ring buffer, before wrapping.
+    pos: int = 0
+
+
+@define(repr=False)
+class ArenaFile:
+    """A file-like view of one entry in the arena, read in chunks.
+
+    Every chunk is checked against the write cursor once it's been copied, and
+    `OverwrittenError` is raised if a writer has wrapped over the entry since,
+    which aborts the response rather than sending corrupt bytes. There's
+    deliberately no ``fileno``, since a ``sendfile`` couldn't be checked.
+    """
+
+    cache: SharedMemoryCache
+    entry: ShmEntry
+    _read: int = field(default=0, init=False)
+
+    @property
+    def remaining(self) -> int:
+        return self.entry.length - self._read
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        if not size:
+            return b""
+        start = self.entry.offset + self._read
+        data = self.cache.arena.mm[start : start + size]
+        if not self.cache.intact(self.entry):
+            logger.warning("A shared memory cache entry was overwritten mid-send")
+            raise OverwrittenError("The entry was overwritten while it was read")
+        self._read += len(data)
+        return data
+
+    def close(self) -> None:
+        pass
+
+
+@define(repr=False)
+class _Arena:
+    fd: int
+    mm: mmap.mmap
+    slots: int
+    size: int
+    data_offset: int
+
+
+@define(repr=False)
+class SharedMemoryCache:
+    """A cache of encoded images in an mmap'd file shared by every worker.
+
+    The arena is a table of slots followed by a ring buffer of image data. Writes
+    append to the ring buffer under a lock, so the oldest images are overwritten
+    first, then point a slot at the new data. Reads take no locks: each slot has
+    a sequence number that is odd while it's being written, and a read is retried
+    if it changes. An entry is only served while it's at least a quarter of the
+    arena away from being overwritten, and a response is aborted if it's
+    overwritten anyway, see `ArenaFile`.
+    """
+
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    puts: int = field(default=0, init=False)
+
+    _arena: _Arena | None = field(default=None, init=False)
+    _pid: int | None = field(default=None, init=False)
+    _path: str | None = field(default=None, init=False)
+    _size: int | None = field(default=None, init=False)
+    _max_item_size: int | None = field(default=None, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = config_value("SHM_CACHE_SIZE", 0, cast_as=int)
+        return self._size
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            self._path = str(config_value("SHM_CACHE_PATH", assert_is=Path))
+        return self._path
+
+    @property
+    def max_item_size(self) -> int:
+        if self._max_item_size is None:
+            max_item = config_value("SHM_CACHE_MAX_ITEM_SIZE", 0, cast_as=int)
+            # Leave room for an item to be written without breaking the guard.
+            self._max_item_size = min(max_item or self.size, self.size // 8)
+        return self._max_item_size
+
+    @property
+    def arena(self) -> _Arena:
+        if self._arena is None or self._pid != os.getpid():
+            self._arena, self._pid = self._open(), os.getpid()
+        return self._arena
+
+    def _open(self) -> _Arena:
+        # Every process needs its own descriptor, since flock locks are shared
+        # by descriptors that were inherited across a fork.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            valid = len(header) == HEADER.size and header.startswith(MAGIC)
+            if valid:
+                _, slots, _, size, _ = HEADER.unpack(header)
+                valid = os.fstat(fd).st_size >= data_offset(slots) + size
+            if not valid:
+                slots = config_value("SHM_CACHE_SLOTS", 4096, cast_as=int)
+                size = self.size
+                _init_arena(fd, size, slots)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        offset = data_offset(slots)
+        mm = mmap.mmap(fd, offset + size)
+        return _Arena(fd, mm, slots, size, offset)
+
+    @contextmanager
+    def _write_lock(self, arena: _Arena) -> Iterator[None]:
+        with self._lock:
+            fcntl.flock(arena.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(arena.fd, fcntl.LOCK_UN)
+
+    def _probe(self, arena: _Arena, digest: int) -> Iterator[int]:
+        start = digest % arena.slots
+        for i in range(PROBES):
+            yield HEADER_SIZE + ((start + i) % arena.slots) * SLOT.size
+
+    def _read_slot(
+        self, arena: _Arena, offset: int
+    ) -> tuple[int, int, int, int, float] | None:
+        for _ in range(READ_RETRIES):
+            slot = SLOT.unpack_from(arena.mm, offset)
+            if not slot[0] & 1 and SEQ.unpack_from(arena.mm, offset)[0] == slot[0]:
+                return slot
+        return None
+
+    def _servable(self, arena: _Arena, pos: int) -> bool:
+        cursor = CURSOR.unpack_from(arena.mm, CURSOR_OFFSET)[0]
+        return pos + arena.size - cursor >= arena.size // 4
+
+    def intact(self, entry: ShmEntry) -> bool:
+        """Check that nothing has been written over ``entry`` yet.
+
+        Writers move the cursor before writing, so this holds for whatever was
+        read before it's checked.
+        """
+        arena = self.arena
+        cursor = CURSOR.unpack_from(arena.mm, CURSOR_OFFSET)[0]
+        return cursor <= entry.pos + arena.size
+
+    def lookup(self, key: str) -> ShmEntry | None:
+        if not self.enabled:
+            return None
+        arena, digest = self.arena, key_digest(key)
+        for offset in self._probe(arena, digest):
+            slot = self._read_slot(arena, offset)
+            if slot is None or slot[2] == 0:
+                break
+            _, length, found, pos, mtime = slot
+            if found != digest:
+                continue
+            if self._servable(arena, pos):
+                record = arena.data_offset + pos % arena.size
+                if RECORD.unpack_from(arena.mm, record) == (digest, length):
+                    self.hits += 1
+                    return ShmEntry(record + RECORD.size, length, mtime, pos)
+            break
+        self.misses += 1
+        return None
+
+    def open(self, entry: ShmEntry) -> ArenaFile:
+        return ArenaFile(self, entry)
+
+    def put(self, key: str, data: bytes, mtime: float) -> bool:
+        if not self.enabled or len(data) > self.max_item_size:
+            return False
+        arena, digest = self.arena, key_digest(key)
+        need = -(-(RECORD.size + len(data)) // 8) * 8
+        mm = arena.mm
+        with self._write_lock(arena):
+            start = CURSOR.unpack_from(mm, CURSOR_OFFSET)[0]
+            wrapped = start % arena.size
+            if wrapped + need > arena.size:
+                start += arena.size - wrapped
+            # Move the cursor first, so readers stop trusting what's overwritten.
+            CURSOR.pack_into(mm, CURSOR_OFFSET, start + need)
+            record = arena.data_offset + start % arena.size
+            RECORD.pack_into(mm, record, digest, len(data))
+            mm[record + RECORD.size : record + RECORD.size + len(data)] = data
+            self._write_slot(arena, digest, (len(data), digest, start, mtime))
+        self.puts += 1
+        return True
+
+    def _write_slot(
+        self, arena: _Arena, digest: int, values: tuple[int, int, int, float]
+    ) -> None:
+        mm, target, oldest = arena.mm, None, None
+        for offset in self._probe(arena, digest):
+            seq, _, found, pos, _ = SLOT.unpack_from(mm, offset)
+            if found in (0, digest):
+                target = offset
+                break
+            if oldest is None or pos < oldest[1]:
+                oldest = (offset, pos)
+        if target is None:
+            assert oldest is not None
+            target = oldest[0]
+        seq = SEQ.unpack_from(mm, target)[0]
+        SEQ.pack_into(mm, target, seq + 1)
+        SLOT.pack_into(mm, target, seq + 1, *values)
+        SEQ.pack_into(mm, target, seq + 2)
+
+    def load(self, path: str, fp: BinaryIO | None = None) -> ShmEntry | None:
+        """Copy ``path`` into the arena, returning `None` if it won't fit.
+
+        If it's already open, ``fp`` is read instead.
+        """
+        if not self.enabled:
+            return None
+        st = os.stat(path) if fp is None else os.fstat(fp.fileno())
+        if st.st_size > self.max_item_size:
+            return None
+        if fp is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            data = fp.read()
+        if not self.put(path, data, st.st_mtime):
+            return None
+        return self.lookup(path)
+
+    def stats(self) -> dict[str, Any]:
+        stats: dict[str, Any] = {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "puts": self.puts,
+        }
+        if self.enabled:
+            arena = self.arena
+            written = CURSOR.unpack_from(arena.mm, CURSOR_OFFSET)[0]
+            stats.update(size=arena.size, slots=arena.slots, written=written)
+        return stats
+
+
+shm_cache = SharedMemoryCache()
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import random
+
+from attrs import frozen
+from flask import request
+
+from ..constants import SNAP_PALETTE
+from ..utils import config_value
+from .utils import RAND_COLOR
+
+FALSY = frozenset(("0", "false", "no", "off"))
+
+
+@frozen()
+class Snap:
+    """Rounds requested sizes to a grid, and picks `rand` colors from a palette.
+
+    Consumers that don't need exact sizes can opt in with ``?snap=1`` (or a
+    deployment can snap every request with `SNAP_DEFAULT`), so that nearby sizes
+    share one cached image.
+    """
+
+    grid: int
+    palette: tuple[str, ...]
+
+    @staticmethod
+    def requested() -> bool:
+        value = request.args.get("snap")
+        if value is None:
+            return config_value("SNAP_DEFAULT", False, cast_as=bool)
+        return value.casefold() not in FALSY
+
+    @classmethod
+    def from_request(cls) -> Snap | None:
+        if not cls.requested():
+            return None
+        grid = config_value("SNAP_GRID", 8, cast_as=int)
+        palette: tuple[str, ...] = ()
+        if config_value("SNAP_COLORS", True, cast_as=bool):
+            palette = tuple(config_value("SNAP_PALETTE", None) or SNAP_PALETTE)
+        return cls(grid, palette)
+
+    def size(self, size: tuple[int, int]) -> tuple[int, int]:
+        grid = self.grid
+        # Halfway sizes always round up, unlike `round`.
+        width, height = (max(grid, (n + grid // 2) // grid * grid) for n in size)
+        return width, height
+
+    def color(self, color: str) -> str:
+        if not self.palette or color.casefold() != RAND_COLOR:
+            return color
+        return random.choice(self.palette)
+
+    def colors(self, requested: list[str], resolved: list[str]) -> list[str]:
+        """Replace the colors that were resolved from `rand` ones."""
+        if not self.palette:
+            return resolved
+        return [
+            self.color(req) if req.casefold() == RAND_COLOR else res
+            for req, res in zip(requested, resolved)
+        ]
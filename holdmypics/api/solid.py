@@ -0,0 +1,292 @@
+"""Encoders for images that are a single color, which never draw a canvas.
+
+Solid images are common (colored blocks, text images without text), and their
+encoded form is so regular that it can be written directly, in time that barely
+depends on the size of the image.
+"""
+
+from __future__ import annotations
+
+import functools
+import struct
+import zlib
+from collections.abc import Callable
+from io import BytesIO
+from typing import Any
+
+from PIL import Image
+
+# Bump this when a change here changes the bytes an image is encoded as.
+ENCODER_VERSION = 1
+
+Color = tuple[int, int, int, int]
+
+# Images this small are encoded once per color, size and options.
+TINY_PIXELS = 64
+TINY_CACHE_SIZE = 1024
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG rows are compressed this many bytes at a time.
+PNG_BLOCK_SIZE = 1 << 20
+ADLER_BASE = 65521
+
+GIF_MAX_SIZE = 0xFFFF
+LZW_MIN_CODE_SIZE = 2
+LZW_CLEAR = 1 << LZW_MIN_CODE_SIZE
+LZW_FIRST = LZW_CLEAR + 2
+# Leave room for the last code before the table is full.
+LZW_MAX_RUN = 4096 - LZW_FIRST - 1
+
+WEBP_MAX_SIZE = 1 << 14
+VP8L_SIGNATURE = 0x2F
+
+
+class BitWriter:
+    """Packs values of any number of bits, least significant bit first."""
+
+    def __init__(self) -> None:
+        self.out = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value: int, bits: int) -> None:
+        self._acc |= value << self._bits
+        self._bits += bits
+        whole = self._bits >> 3
+        if whole:
+            self.out += (self._acc & ((1 << (whole << 3)) - 1)).to_bytes(
+                whole, "little"
+            )
+            self._acc >>= whole << 3
+            self._bits &= 7
+
+    @property
+    def bits(self) -> int:
+        return len(self.out) * 8 + self._bits
+
+    def getvalue(self) -> bytes:
+        if self._bits:
+            return bytes(self.out + self._acc.to_bytes(1, "little"))
+        return bytes(self.out)
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    header = struct.pack(">I", len(data)) + kind
+    return header + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)))
+
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    """Get the Adler-32 of two strings from theirs, as zlib's C library does."""
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER_BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem
+    sum1 %= ADLER_BASE
+    sum2 %= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def _deflate(data: bytes, level: int, final: bool = False) -> bytes:
+    """Compress ``data`` on its own, as raw deflate blocks that end on a byte.
+
+    Blocks made like this don't refer back to anything before them, so they can
+    be repeated to compress repeated data.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    flush = zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH
+    return compressor.compress(data) + compressor.flush(flush)
+
+
+def encode_png(size: tuple[int, int], color: Color, kw: dict[str, Any]) -> bytes:
+    """Every row after the first is filtered as "up", which makes it all zeros.
+
+    A block of those rows is compressed once, and repeated.
+    """
+    width, height = size
+    alpha = color[3] != 0xFF
+    pixel = bytes(color if alpha else color[:3])
+    row_size = 1 + width * len(pixel)
+    level = kw.get("compress_level", 6)
+    # The first row is filtered as "sub", so only its first pixel isn't zero.
+    first = b"\x01" + pixel + bytes(row_size - 1 - len(pixel))
+    up_row = b"\x02" + bytes(row_size - 1)
+    rows_per_block = max(1, PNG_BLOCK_SIZE // row_size)
+    full_blocks, rest = divmod(height - 1, rows_per_block)
+    block = up_row * rows_per_block if full_blocks else b""
+    tail = up_row * rest
+
+    parts = [zlib.compress(b"", level)[:2], _deflate(first, level)]
+    adler = zlib.adler32(first)
+    if full_blocks:
+        parts.append(_deflate(block, level) * full_blocks)
+        block_adler = zlib.adler32(block)
+        for _ in range(full_blocks):
+            adler = adler32_combine(adler, block_adler, len(block))
+    parts.append(_deflate(tail, level, final=True))
+    adler = adler32_combine(adler, zlib.adler32(tail), len(tail))
+    parts.append(struct.pack(">I", adler))
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 6 if alpha else 2, 0, 0, 0)
+    chunks = [PNG_SIGNATURE, _chunk(b"IHDR", ihdr)]
+    dpi = kw.get("dpi")
+    if dpi:
+        # Pixels per meter, rounded the way Pillow does.
+        ppm = [int(d / 0.0254 + 0.5) for d in dpi]
+        chunks.append(_chunk(b"pHYs", struct.pack(">IIB", *ppm, 1)))
+    chunks += [_chunk(b"IDAT", b"".join(parts)), _chunk(b"IEND", b"")]
+    return b"".join(chunks)
+
+
+def _lzw_run_code(run: int) -> int:
+    # The table only ever holds runs of the one color.
+    return 0 if run == 1 else LZW_FIRST + run - 2
+
+
+def _lzw_block(writer: BitWriter, pixels: int) -> tuple[int, int]:
+    """Write up to a table's worth of ``pixels``, after a clear code.
+
+    Codes are for runs of 1, 2, 3... pixels, each of which is the entry the
+    decoder is about to add. Returns how many pixels were written, and the code
+    size the decoder ends up with.
+    """
+    width, next_code = LZW_MIN_CODE_SIZE + 1, LZW_FIRST
+    written, run = 0, 1
+    while written < pixels and run <= LZW_MAX_RUN:
+        take = min(run, pixels - written)
+        writer.write(_lzw_run_code(take), width)
+        written += take
+        if run > 1:
+            # The decoder adds an entry for every code after the first.
+            next_code += 1
+            if next_code == 1 << width and width < 12:
+                width += 1
+        run += 1
+    return written, width
+
+
+@functools.cache
+def _full_lzw_block() -> tuple[int, int, int, int]:
+    """Get the bits of a block that fills the table, which is always the same."""
+    writer = BitWriter()
+    pixels, width = _lzw_block(writer, 1 << 32)
+    value = int.from_bytes(writer.getvalue(), "little")
+    return value, writer.bits, pixels, width
+
+
+def encode_gif(size: tuple[int, int], color: Color, kw: dict[str, Any]) -> bytes | None:
+    """A two color palette, and LZW codes for ever longer runs of the one color.
+
+    GIF has no partial transparency, so only opaque or invisible colors are
+    encoded here.
+    """
+    width, height = size
+    alpha = color[3]
+    if alpha not in (0, 0xFF) or width > GIF_MAX_SIZE or height > GIF_MAX_SIZE:
+        return None
+    # Pillow's encoder doesn't keep the color of invisible pixels either.
+    rgb = bytes(color[:3]) if alpha else bytes(3)
+    header = b"GIF89a" + struct.pack("<HHBBB", width, height, 0x80, 0, 0)
+    parts = [header, rgb + bytes(3)]
+    if not alpha:
+        parts.append(b"\x21\xf9\x04\x01\x00\x00\x00\x00")
+    parts.append(b"\x2c" + struct.pack("<HHHHB", 0, 0, width, height, 0))
+
+    writer, remaining = BitWriter(), width * height
+    full_value, full_bits, full_pixels, full_width = _full_lzw_block()
+    # Clear codes are written with the code size the decoder is at.
+    code_size = LZW_MIN_CODE_SIZE + 1
+    while remaining > full_pixels:
+        writer.write(LZW_CLEAR, code_size)
+        writer.write(full_value, full_bits)
+        remaining -= full_pixels
+        code_size = full_width
+    writer.write(LZW_CLEAR, code_size)
+    _, code_size = _lzw_block(writer, remaining)
+    writer.write(LZW_CLEAR + 1, code_size)
+    data = writer.getvalue()
+    sub_blocks = [
+        bytes((len(data[i : i + 255]),)) + data[i : i + 255]
+        for i in range(0, len(data), 255)
+    ]
+    parts += [bytes((LZW_MIN_CODE_SIZE,)), *sub_blocks, b"\x00\x3b"]
+    return b"".join(parts)
+
+
+def encode_webp(
+    size: tuple[int, int], color: Color, kw: dict[str, Any]
+) -> bytes | None:
+    """Lossless WebP, with a prefix code of one symbol for each channel.
+
+    Decoding a pixel then takes no bits at all, so the file is the same size
+    whatever the size of the image.
+    """
+    width, height = size
+    if width > WEBP_MAX_SIZE or height > WEBP_MAX_SIZE:
+        return None
+    r, g, b, a = color
+    writer = BitWriter()
+    writer.write(VP8L_SIGNATURE, 8)
+    writer.write(width - 1, 14)
+    writer.write(height - 1, 14)
+    writer.write(int(a != 0xFF), 1)
+    writer.write(0, 3)
+    # No transforms, no color cache and no meta prefix codes.
+    writer.write(0, 3)
+    for symbol in (g, r, b, a):
+        # A simple code with one 8 bit symbol.
+        writer.write(0b101, 3)
+        writer.write(symbol, 8)
+    # The distance code, which is never used: one 1 bit symbol.
+    writer.write(0b001, 3)
+    writer.write(0, 1)
+    data = writer.getvalue()
+    padding = b"\x00" * (len(data) & 1)
+    chunk = b"VP8L" + struct.pack("<I", len(data)) + data + padding
+    return b"RIFF" + struct.pack("<I", 4 + len(chunk)) + b"WEBP" + chunk
+
+
+def encode_jpeg(size: tuple[int, int], color: Color, kw: dict[str, Any]) -> bytes:
+    """JPEG is left to Pillow, but without an RGBA canvas to convert."""
+    buffer = BytesIO()
+    Image.new("RGB", size, color[:3]).save(buffer, format="jpeg", **kw)
+    return buffer.getvalue()
+
+
+Encoder = Callable[[tuple[int, int], Color, dict[str, Any]], "bytes | None"]
+
+ENCODERS: dict[str, Encoder] = {
+    "png": encode_png,
+    "gif": encode_gif,
+    "webp": encode_webp,
+    "jpeg": encode_jpeg,
+}
+
+
+@functools.lru_cache(maxsize=TINY_CACHE_SIZE)
+def _encode_tiny(
+    fmt: str, size: tuple[int, int], color: Color, kw: tuple[tuple[str, Any], ...]
+) -> bytes | None:
+    return ENCODERS[fmt](size, color, dict(kw))
+
+
+def encode_solid(
+    fmt: str, size: tuple[int, int], color: Color, kw: dict[str, Any]
+) -> bytes | None:
+    """Encode an image of ``size`` that's all ``color``.
+
+    Returns `None` if it should be left to Pillow. ``kw`` are the options the
+    image would've been saved with.
+    """
+    encoder = ENCODERS.get(fmt)
+    if encoder is None:
+        return None
+    if size[0] * size[1] <= TINY_PIXELS:
+        return _encode_tiny(fmt, size, color, tuple(sorted(kw.items())))
+    return encoder(size, color, kw)
+
+
+def parse_color(color: str) -> Color:
+    """Get the channels of a ``#rrggbbaa`` color."""
+    r, g, b, a = bytes.fromhex(color.lstrip("#"))
+    return r, g, b, a
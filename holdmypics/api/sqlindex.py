@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+from attrs import define, field
+
+from ..utils import natsize
+from .policy import EvictionPolicy, LRUPolicy
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    shard INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hit_count INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    priority REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_shard ON entries (shard, last_access);
+CREATE INDEX IF NOT EXISTS entries_priority ON entries (priority, last_access);
+
+CREATE TABLE IF NOT EXISTS shards (
+    shard INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value);
+
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO shards (shard, size, count) VALUES (new.shard, new.size, 1)
+    ON CONFLICT (shard) DO UPDATE SET size = size + new.size, count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE shards SET size = size - old.size, count = count - 1
+    WHERE shard = old.shard;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size, shard ON entries
+BEGIN
+    UPDATE shards SET size = size - old.size, count = count - 1
+    WHERE shard = old.shard;
+    INSERT INTO shards (shard, size, count) VALUES (new.shard, new.size, 1)
+    ON CONFLICT (shard) DO UPDATE SET size = size + new.size, count = count + 1;
+END;
+"""
+
+# Columns that were added after the first version of the schema.
+ADDED_COLUMNS = {
+    "cost": "REAL NOT NULL DEFAULT 0",
+    "priority": "REAL NOT NULL DEFAULT 0",
+}
+
+CLOCK = "(SELECT coalesce((SELECT value FROM meta WHERE name = 'clock'), 0))"
+
+# Without a cost, an existing entry keeps its cost and hit count.
+UPSERT = f"""
+INSERT INTO entries (
+    key, path, size, format, shard, created, last_access, cost, priority
+)
+VALUES (
+    :key, :path, :size, :format, :shard, :now, :atime, coalesce(:cost, 0),
+    hm_priority(:size, coalesce(:cost, 0), 0, :atime, {CLOCK})
+)
+ON CONFLICT (key) DO UPDATE SET
+    path = excluded.path,
+    size = excluded.size,
+    format = excluded.format,
+    shard = excluded.shard,
+    last_access = excluded.last_access,
+    cost = coalesce(:cost, cost),
+    hit_count = CASE WHEN :cost IS NULL THEN hit_count ELSE 0 END,
+    priority = hm_priority(
+        excluded.size,
+        coalesce(:cost, cost),
+        CASE WHEN :cost IS NULL THEN hit_count ELSE 0 END,
+        excluded.last_access,
+        {CLOCK}
+    )
+"""
+
+TOUCH = f"""
+UPDATE entries SET
+    last_access = :atime,
+    hit_count = hit_count + :hits,
+    priority = hm_priority(size, cost, hit_count + :hits, :atime, {CLOCK})
+WHERE key = :key
+"""
+
+ADVANCE_CLOCK = """
+INSERT INTO meta (name, value) VALUES ('clock', ?)
+ON CONFLICT (name) DO UPDATE SET value = max(value, excluded.value)
+"""
+
+TIMEOUT = 10.0
+
+
+@define(repr=False)
+class SQLiteIndex:
+    """An index of cached files that is persisted in a SQLite database.
+
+    The database is opened in WAL mode and shared by every worker, so a freshly
+    started worker can attach to it instead of scanning the cache folder. Sizes
+    are totalled per shard by triggers, and eviction candidates come from an
+    index on their priority under the eviction policy.
+    """
+
+    path: Path = field(converter=Path)
+    policy: EvictionPolicy = field(factory=LRUPolicy)
+    _local: threading.local = field(factory=threading.local, init=False)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        local, pid = self._local, os.getpid()
+        conn: sqlite3.Connection | None = getattr(local, "conn", None)
+        # Connections can't be shared across threads, or across a fork.
+        if conn is None or local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.create_function(
+                "hm_priority", 5, self.policy.priority, deterministic=True
+            )
+            self._add_columns(conn)
+            conn.executescript(SCHEMA)
+            local.conn, local.pid = conn, pid
+        return conn
+
+    @staticmethod
+    def _add_columns(conn: sqlite3.Connection) -> None:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+        if not columns:
+            return
+        for name, decl in ADDED_COLUMNS.items():
+            if name not in columns:
+                conn.execute(f"ALTER TABLE entries ADD COLUMN {name} {decl}")
+
+    def _scalar(self, sql: str, *params: object) -> int:
+        row = self.conn.execute(sql, params).fetchone()
+        return 0 if row is None or row[0] is None else row[0]
+
+    @property
+    def total_size(self) -> int:
+        return self._scalar("SELECT SUM(size) FROM shards")
+
+    @property
+    def clock(self) -> float:
+        return float(self.get_meta("clock") or 0)
+
+    def get_meta(self, name: str) -> str | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,))
+        return next((value for (value,) in row), None)
+
+    def set_meta(self, name: str, value: str | None) -> None:
+        if value is None:
+            self.conn.execute("DELETE FROM meta WHERE name = ?", (name,))
+        else:
+            sql = "REPLACE INTO meta (name, value) VALUES (?, ?)"
+            self.conn.execute(sql, (name, value))
+
+    def shard_size(self, shard: int) -> int:
+        return self._scalar("SELECT size FROM shards WHERE shard = ?", shard)
+
+    def largest_shards(self) -> list[int]:
+        sql = "SELECT shard FROM shards WHERE size > 0 ORDER BY size DESC"
+        return [row[0] for row in self.conn.execute(sql)]
+
+    def _params(
+        self,
+        key: str,
+        size: int,
+        atime: float | None,
+        shard: int,
+        path: str,
+        cost: float | None = None,
+    ) -> dict[str, object]:
+        now = time.time()
+        fmt = key.rpartition(".")[2]
+        atime = now if atime is None else atime
+        return {
+            "key": key,
+            "path": path,
+            "size": size,
+            "format": fmt,
+            "shard": shard,
+            "now": now,
+            "atime": atime,
+            "cost": cost,
+        }
+
+    def add(
+        self,
+        key: str,
+        size: int,
+        atime: float | None = None,
+        shard: int = 0,
+        path: str = "",
+        cost: float | None = None,
+    ) -> None:
+        params = self._params(key, size, atime, shard, path, cost)
+        self.conn.execute(UPSERT, params)
+
+    def touch(self, key: str, atime: float | None = None, hits: int = 1) -> bool:
+        atime = time.time() if atime is None else atime
+        params = {"atime": atime, "key": key, "hits": hits}
+        return self.conn.execute(TOUCH, params).rowcount > 0
+
+    def touch_many(self, accesses: Iterable[tuple[str, float, int]]) -> int:
+        """Record a batch of accesses in one transaction."""
+        params = [{"key": k, "atime": a, "hits": h} for k, a, h in accesses]
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            touched = conn.executemany(TOUCH, params).rowcount
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return touched
+
+    def get(self, key: str) -> tuple[int, float] | None:
+        sql = "SELECT size, last_access FROM entries WHERE key = ?"
+        return self.conn.execute(sql, (key,)).fetchone()
+
+    def priority(self, key: str) -> float | None:
+        sql = "SELECT priority FROM entries WHERE key = ?"
+        row = self.conn.execute(sql, (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def remove(self, key: str) -> int:
+        """Remove ``key``, moving the clock up to its priority."""
+        sql = "DELETE FROM entries WHERE key = ? RETURNING size, priority"
+        row = self.conn.execute(sql, (key,)).fetchone()
+        if row is None:
+            return 0
+        self.conn.execute(ADVANCE_CLOCK, (row[1],))
+        return row[0]
+
+    def replace(
+        self,
+        entries: Iterable[tuple[str, int, float, int, str]],
+        shard: int | None = None,
+    ) -> None:
+        """Replace every entry (or every entry in ``shard``) in one transaction.
+
+        Entries that are already known keep their cost and hit count.
+        """
+        params = [self._params(*e) for e in entries]
+        conn = self.conn
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM temp.seen")
+            conn.executemany(UPSERT, params)
+            keys = ((p["key"],) for p in params)
+            conn.executemany("INSERT OR IGNORE INTO temp.seen VALUES (?)", keys)
+            stale = "key NOT IN (SELECT key FROM temp.seen)"
+            if shard is None:
+                conn.execute(f"DELETE FROM entries WHERE {stale}")
+            else:
+                sql = f"DELETE FROM entries WHERE shard = ? AND {stale}"
+                conn.execute(sql, (shard,))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def lowest_priority(self, size: int) -> list[tuple[str, int, float]]:
+        """Get the files to evict first, which add up to at least ``size``."""
+        sql = (
+            "SELECT path, size, last_access FROM entries"
+            " ORDER BY priority, last_access"
+        )
+        files: list[tuple[str, int, float]] = []
+        total = 0
+        for row in self.conn.execute(sql):
+            if total >= size:
+                break
+            files.append(row)
+            total += row[1]
+        return files
+
+    def clear(self) -> None:
+        self.replace(())
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return self._scalar("SELECT SUM(count) FROM shards")
+
+    def __repr__(self) -> str:
+        size = natsize(self.total_size)
+        return f"SQLiteIndex(path={self.path}, entries={len(self)}, size={size})"
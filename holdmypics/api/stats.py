@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import atexit
+import enum
+import os
+import threading
+import time
+from collections import Counter
+from typing import Any
+
+from attrs import define, field
+
+from .. import redisw
+from ..utils import config_value
+
+KEY_PREFIX = "holdmypics:stats:"
+COUNTERS = ("hits", "misses", "coalesced", "bytes_served", "bytes_from_cache")
+
+
+class CacheStatus(str, enum.Enum):
+    """How an image response was produced, as sent in the ``X-Cache`` header."""
+
+    HIT = "HIT"
+    MISS = "MISS"
+    COALESCED = "COALESCED"
+
+
+def hit_ratio(hits: int, total: int) -> float:
+    return round(hits / total, 4) if total else 0.0
+
+
+@define(repr=False)
+class CacheStats:
+    """Counts cache hits and misses, in this worker and across all of them.
+
+    Every count is also added to a counter in Redis (or `FakeRedis`), which is
+    where the totals for every worker come from. Those are collected in memory
+    and added by the first response after `STATS_FLUSH_INTERVAL` seconds, in one
+    pipeline, so most responses never wait on Redis. Totals can be behind by an
+    idle worker's last few responses until it serves another or exits. Coalesced
+    responses waited for another request to render the image, so they count as
+    hits.
+    """
+
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    coalesced: int = field(default=0, init=False)
+    bytes_served: int = field(default=0, init=False)
+    bytes_from_cache: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+    _pending: Counter[str] = field(factory=Counter, init=False)
+    _flushed_at: float = field(factory=time.monotonic, init=False)
+    _interval: float | None = field(default=None, init=False)
+    _pid: int | None = field(default=None, init=False)
+
+    @property
+    def interval(self) -> float:
+        if self._interval is None:
+            self._interval = config_value("STATS_FLUSH_INTERVAL", 5.0, cast_as=float)
+        return self._interval
+
+    def flush(self) -> int:
+        """Add the pending counts to Redis, returning how many counters changed."""
+        with self._lock:
+            pending, self._pending = +self._pending, Counter()
+            self._flushed_at = time.monotonic()
+        if pending:
+            redisw.incr_many({KEY_PREFIX + name: n for name, n in pending.items()})
+        return len(pending)
+
+    def record(self, status: CacheStatus, size: int) -> None:
+        counter = {
+            CacheStatus.HIT: "hits",
+            CacheStatus.MISS: "misses",
+            CacheStatus.COALESCED: "coalesced",
+        }[status]
+        cached = size if status is not CacheStatus.MISS else 0
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                # Whatever was pending belongs to the parent, which will flush it.
+                if self._pid is None:
+                    atexit.register(self.flush)
+                self._pid, self._pending = pid, Counter()
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.bytes_served += size
+            self.bytes_from_cache += cached
+            self._pending.update({counter: 1, "bytes_served": size})
+            self._pending["bytes_from_cache"] += cached
+            due = time.monotonic() - self._flushed_at >= self.interval
+        if due:
+            self.flush()
+
+    def record_evictions(self, num: int) -> None:
+        with self._lock:
+            self.evictions += num
+        redisw.client.incrby(KEY_PREFIX + "evictions", num)
+
+    @staticmethod
+    def _summary(counts: dict[str, int]) -> dict[str, Any]:
+        hits = counts["hits"] + counts["coalesced"]
+        return {**counts, "hit_ratio": hit_ratio(hits, hits + counts["misses"])}
+
+    def worker(self) -> dict[str, Any]:
+        with self._lock:
+            counts = {name: getattr(self, name) for name in COUNTERS}
+            counts["evictions"] = self.evictions
+        return {"pid": os.getpid(), **self._summary(counts)}
+
+    def total(self) -> dict[str, Any]:
+        # Other workers' latest counts may not have been added yet, but this one's
+        # can be.
+        self.flush()
+        names = (*COUNTERS, "evictions")
+        return self._summary({n: redisw.get_int(KEY_PREFIX + n) for n in names})
+
+
+cache_stats = CacheStats()
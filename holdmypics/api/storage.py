@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from contextlib import closing
+from io import BytesIO
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from attrs import define, field
+from loguru import logger
+
+from ..exceptions import ImproperlyConfigured
+from ..utils import config_value
+from .files import GeneratedFiles, files
+from .locks import atomic_write
+
+CHUNK_SIZE = 1 << 16
+
+
+class Storage(ABC):
+    """Somewhere to keep saved images that outlives the local cache folder.
+
+    Images are stored under ``<namespace>/<name>``, see `GeneratedFiles.key_for`.
+    """
+
+    @abstractmethod
+    def put(self, key: str, fp: BinaryIO) -> None:
+        """Store what's left in ``fp`` under ``key``, reading it in chunks."""
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO | None:
+        """Get a stream of the image stored under ``key``, if there is one."""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool: ...
+
+    @abstractmethod
+    def delete(self, key: str) -> bool: ...
+
+    @abstractmethod
+    def list(self) -> Iterator[tuple[str, int]]:
+        """Get the key and size of everything that's stored."""
+
+
+@define(repr=False)
+class FileSystemStorage(Storage):
+    """Images in a folder, which could be a network mount."""
+
+    root: Path = field(converter=Path)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key
+
+    def put(self, key: str, fp: BinaryIO) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(str(path)) as tmp_path, open(tmp_path, "wb") as f:
+            shutil.copyfileobj(fp, f, CHUNK_SIZE)
+
+    def open(self, key: str) -> BinaryIO | None:
+        try:
+            return open(self._path(key), "rb")  # noqa: SIM115
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def delete(self, key: str) -> bool:
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def list(self) -> Iterator[tuple[str, int]]:
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = Path(dirpath, name)
+                try:
+                    size = path.stat().st_size
+                except FileNotFoundError:
+                    continue
+                yield path.relative_to(self.root).as_posix(), size
+
+
+@define(repr=False)
+class MemoryStorage(Storage):
+    """Images in a dict, which is only shared by the threads of one process."""
+
+    _data: dict[str, bytes] = field(factory=dict, init=False)
+    _lock: threading.Lock = field(factory=threading.Lock, init=False)
+
+    def put(self, key: str, fp: BinaryIO) -> None:
+        data = fp.read()
+        with self._lock:
+            self._data[key] = data
+
+    def open(self, key: str) -> BinaryIO | None:
+        data = self._data.get(key)
+        return BytesIO(data) if data is not None else None
+
+    def exists(self, key: str) -> bool:
+        return key in self._data
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def list(self) -> Iterator[tuple[str, int]]:
+        with self._lock:
+            items = list(self._data.items())
+        return ((key, len(data)) for key, data in items)
+
+
+@define(repr=False)
+class S3Storage(Storage):
+    """Images in an S3 compatible bucket, under ``prefix``.
+
+    Needs ``boto3`` (``pip install holdmypics[s3]``). Uploads and downloads are
+    streamed, with multipart uploads for large images. The bucket isn't bounded
+    by the eviction policy, so give it a lifecycle rule that expires old images.
+    """
+
+    bucket: str
+    prefix: str = ""
+    endpoint_url: str | None = None
+    _client: Any = field(default=None, kw_only=True)
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError as exc:
+                msg = "The s3 storage backend needs boto3 installed"
+                raise ImproperlyConfigured(msg) from exc
+            self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+        return self._client
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def _missing(self, exc: Exception) -> bool:
+        error = getattr(exc, "response", {}).get("Error", {})
+        return error.get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, key: str, fp: BinaryIO) -> None:
+        self.client.upload_fileobj(fp, self.bucket, self._key(key))
+
+    def open(self, key: str) -> BinaryIO | None:
+        try:
+            res = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except Exception as exc:
+            if self._missing(exc):
+                return None
+            raise
+        return res["Body"]
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except Exception as exc:
+            if self._missing(exc):
+                return False
+            raise
+        return True
+
+    def delete(self, key: str) -> bool:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        return True
+
+    def list(self) -> Iterator[tuple[str, int]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", ()):
+                yield obj["Key"][len(self.prefix) :], obj["Size"]
+
+
+def make_storage(kind: str) -> Storage | None:
+    if kind == "fs":
+        return FileSystemStorage(config_value("STORAGE_PATH", assert_is=Path))
+    if kind == "s3":
+        bucket = config_value("STORAGE_S3_BUCKET", "", cast_as=str)
+        if not bucket:
+            raise ImproperlyConfigured("STORAGE_S3_BUCKET is needed for s3 storage")
+        prefix = config_value("STORAGE_S3_PREFIX", "", cast_as=str)
+        endpoint_url = config_value("STORAGE_S3_ENDPOINT_URL", None)
+        return S3Storage(bucket, prefix, endpoint_url)
+    if kind == "memory":
+        return MemoryStorage()
+    return None
+
+
+@define(repr=False)
+class ImageStore:
+    """Keeps every rendered image in the configured `Storage` backend.
+
+    The local cache folder is still what images are sent from, and what's
+    evicted. When an image isn't there, it's streamed down from the backend
+    before rendering is considered, and new images are streamed up after
+    they're rendered. With a shared backend, a fleet (or a dyno that lost its
+    disk on restart) starts with a warm cache.
+    """
+
+    files: GeneratedFiles = field(default=files)
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    uploads: int = field(default=0, init=False)
+    errors: int = field(default=0, init=False)
+
+    _backend: Storage | None = field(default=None, init=False)
+    _kind: str | None = field(default=None, init=False)
+
+    @property
+    def kind(self) -> str:
+        if self._kind is None:
+            self._kind = config_value("STORAGE_BACKEND", "none", cast_as=str)
+        return self._kind
+
+    @property
+    def backend(self) -> Storage | None:
+        if self._backend is None and self.kind != "none":
+            self._backend = make_storage(self.kind)
+        return self._backend
+
+    @property
+    def enabled(self) -> bool:
+        return self.kind != "none"
+
+    def fetch(self, path: str) -> bool:
+        """Stream the stored copy of ``path`` into it, if there is one."""
+        backend = self.backend
+        if backend is None:
+            return False
+        try:
+            src = backend.open(self.files.key_for(path))
+            if src is None:
+                self.misses += 1
+                return False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with (
+                closing(src),
+                atomic_write(path) as tmp_path,
+                open(tmp_path, "wb") as f,
+            ):
+                shutil.copyfileobj(src, f, CHUNK_SIZE)
+        except Exception:
+            self.errors += 1
+            logger.exception("Reading {0!r} from storage failed", path)
+            return False
+        self.hits += 1
+        self.files.store(path, os.path.getsize(path))
+        logger.debug("Fetched {0!r} from storage", os.path.basename(path))
+        return True
+
+    def upload(self, path: str) -> bool:
+        backend = self.backend
+        if backend is None:
+            return False
+        try:
+            with open(path, "rb") as f:
+                backend.put(self.files.key_for(path), f)
+        except Exception:
+            self.errors += 1
+            logger.exception("Storing {0!r} failed", path)
+            return False
+        self.uploads += 1
+        return True
+
+    def prune(self, live: set[str]) -> tuple[int, int]:
+        """Delete stored images from namespaces that aren't live.
+
+        Returns how many were deleted, and their total size.
+        """
+        if self.backend is None:
+            return 0, 0
+        num_deleted = size_deleted = 0
+        for key, size in list(self.backend.list()):
+            if key.partition("/")[0] not in live and self.backend.delete(key):
+                num_deleted += 1
+                size_deleted += size
+        return num_deleted, size_deleted
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "backend": self.kind,
+            "hits": self.hits,
+            "misses": self.misses,
+            "uploads": self.uploads,
+            "errors": self.errors,
+        }
+
+
+image_store = ImageStore()
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from typing import Any
+
 from attrs import define
 from loguru import logger
 from PIL import Image, ImageDraw
@@ -8,6 +10,7 @@ from PIL.ImageFont import FreeTypeFont, ImageFont
 from ..fonts import fonts
 from .args import TextImageArgs
 from .base import BaseGeneratedImage
+from .solid import Color, parse_color
 from .utils import FontParams, TextArgs, px_to_pt
 
 MAX_TEXT_HEIGHT = 0.9
@@ -24,6 +27,26 @@ class GeneratedTextImage(BaseGeneratedImage[TextImageArgs]):
             im = draw_text(im, text_args)
         return im
 
+    def solid_color(self) -> Color | None:
+        return parse_color(self.bg_color) if self.args.text is None else None
+
+    @classmethod
+    def renderer_inputs(cls, fmt: str) -> dict[str, Any]:
+        return {**super().renderer_inputs(fmt), "fonts": fonts.fingerprint}
+
+    def get_cache_params(self) -> dict[str, Any]:
+        params = super().get_cache_params()
+        args = self.args
+        # Without text, only the background is drawn.
+        if args.text is not None:
+            params.update(
+                fg=self.fg_color.lstrip("#"),
+                text=args.text,
+                font=args.font_name,
+                debug=args.debug,
+            )
+        return params
+
 
 def _log_font(font_name: str, pt: int, idx: int):
     logger.opt(depth=1).debug("Returning {0} with size {1} ({2})", font_name, pt, idx)
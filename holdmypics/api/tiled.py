@@ -10,6 +10,7 @@ from PIL import Image, ImageDraw
 from ..constants import DEFAULT_COLORS
 from .args import TiledImageArgs
 from .base import BaseGeneratedImage
+from .solid import Color
 
 
 @define()
@@ -35,5 +36,18 @@ class GeneratedTiledImage(BaseGeneratedImage[TiledImageArgs]):
         base.alpha_composite(draw_im)
         return base
 
-    def get_file_name_extra(self) -> tuple[Any, ...]:
-        return (self.cols, self.rows)
+    def solid_color(self) -> Color | None:
+        # The tiles cover the whole image, so one color makes it solid.
+        if len(set(self.args.colors)) != 1:
+            return None
+        tile = Image.new(self.mode, (1, 1), self.args.colors[0])
+        pixel = Image.alpha_composite(self.new_image((1, 1)), tile).getpixel((0, 0))
+        return pixel  # type: ignore[return-value]
+
+    def get_cache_params(self) -> dict[str, Any]:
+        params = super().get_cache_params()
+        colors = [c.lstrip("#") for c in self.args.colors] or [
+            "".join(f"{c:02x}" for c in col) for col in DEFAULT_COLORS
+        ]
+        params.update(cols=self.cols, rows=self.rows, colors="-".join(colors))
+        return params
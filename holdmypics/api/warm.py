@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import re
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import urlsplit, urlunsplit
+
+from attrs import define
+from flask import Flask, current_app, request, url_for
+from loguru import logger
+
+from ..constants import RAND_COLOR
+from ..fonts import fonts
+from ..utils import get_size, natsize
+from .args import TextImageArgs, TiledImageArgs
+from .base import BaseGeneratedImage
+from .text import GeneratedTextImage
+from .tiled import GeneratedTiledImage
+
+LOG_REQUEST_RE = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[\d.]+"')
+
+# Set in the parent before forking, so that workers share its configuration.
+_app: Flask | None = None
+
+
+@define()
+class WarmResult:
+    rendered: int = 0
+    skipped: int = 0
+    unmatched: int = 0
+    failed: int = 0
+    size: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.rendered / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Rendered {self.rendered} ({natsize(self.size)}) in {self.elapsed:.2f}s"
+            f" ({self.throughput:.1f}/s), skipped {self.skipped},"
+            f" unmatched {self.unmatched}, failed {self.failed}"
+        )
+
+
+def parse_line(line: str) -> str | None:
+    """Get an image URL from a line of input.
+
+    A line can be a URL or path, an access log line, or a JSON object with an
+    ``endpoint`` and the arguments to pass to `url_for`. Must be called with a
+    request context.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        return url_for(**json.loads(line))
+    match = LOG_REQUEST_RE.search(line)
+    if match is not None:
+        return match.group(1)
+    parts = urlsplit(line)
+    return urlunsplit(("", "", parts.path, parts.query, ""))
+
+
+def read_urls(lines: Iterable[str], defaults: bool = False) -> list[str]:
+    """Parse image URLs, starting with the pages' default images if ``defaults``."""
+    from ..web.routes import get_default_img_urls
+
+    with current_app.test_request_context():
+        urls = get_default_img_urls() if defaults else []
+        urls.extend(url for url in map(parse_line, lines) if url)
+    return urls
+
+
+def image_for_request() -> BaseGeneratedImage | None:
+    """Build the image that the current request would be served.
+
+    Images that are random on every request can't be cached, so they're skipped.
+    """
+    endpoint, kw = request.endpoint, request.view_args or {}
+    if endpoint == "api.image_route":
+        colors = kw["bg_color"], kw["fg_color"]
+        args = TextImageArgs.from_request()
+        if args.random_text or args.font_name not in fonts.font_names:
+            return None
+        if RAND_COLOR in map(str.casefold, colors):
+            return None
+        fmt = kw["fmt"].lower()
+        return GeneratedTextImage(kw["size"], fmt, *colors, args)
+    elif endpoint == "api.tiled_route":
+        if RAND_COLOR in map(str.casefold, request.args.getlist("colors")):
+            return None
+        args = TiledImageArgs.from_request()
+        fmt = kw["fmt"].lower()
+        return GeneratedTiledImage(
+            kw["size"], fmt, "0000", "0000", args, kw["cols"], kw["rows"]
+        )
+    return None
+
+
+def _render(url: str) -> int:
+    app = _app or current_app
+    with app.test_request_context(url):
+        img = image_for_request()
+        return 0 if img is None else get_size(img.get_path(admit=True))
+
+
+def _pending(urls: Iterable[str], result: WarmResult) -> Iterator[str]:
+    seen: set[str] = set()
+    for url in urls:
+        with current_app.test_request_context(url):
+            img = image_for_request()
+            path = None if img is None else img.get_img_path()
+        if path is None:
+            result.unmatched += 1
+        elif path in seen or os.path.isfile(path):
+            result.skipped += 1
+        else:
+            seen.add(path)
+            yield url
+
+
+def warm_cache(urls: Iterable[str], jobs: int | None = None) -> WarmResult:
+    """Render the images for ``urls`` that aren't cached yet.
+
+    Images are rendered by a pool of ``jobs`` worker processes, or in this one if
+    ``jobs`` is 1. Must be called with an app context.
+    """
+    global _app
+
+    result = WarmResult()
+    start = time.perf_counter()
+    pending = list(_pending(urls, result))
+    if jobs == 1:
+        for url in pending:
+            try:
+                result.size += _render(url)
+            except Exception:
+                logger.exception("Failed to render {0}", url)
+                result.failed += 1
+            else:
+                result.rendered += 1
+    elif pending:
+        _app = current_app._get_current_object()  # type: ignore[attr-defined]
+        ctx = multiprocessing.get_context("fork")
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=ctx) as pool:
+                futures = {pool.submit(_render, url): url for url in pending}
+                for future in as_completed(futures):
+                    exc = future.exception()
+                    if exc is not None:
+                        logger.opt(exception=exc).error(
+                            "Failed to render {0}", futures[future]
+                        )
+                        result.failed += 1
+                    else:
+                        result.size += future.result()
+                        result.rendered += 1
+        finally:
+            _app = None
+    result.elapsed = time.perf_counter() - start
+    return result
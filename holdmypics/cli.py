@@ -2,8 +2,9 @@ from __future__ import annotations
 
 import json
 from collections.abc import Callable
+from itertools import chain
 from pathlib import Path
-from typing import Any
+from typing import Any, TextIO
 
 import click
 import semver
@@ -25,6 +26,7 @@ CATEGORIES = (MAIN, DEV)
 
 def register(app: Flask):
     cfg_path = config_value("BASE_PATH", app=app, assert_is=Path) / "config"
+    register_cache_commands(app)
 
     @app.cli.command(context_settings=CTX_SETTINGS)
     @click.option(
@@ -182,3 +184,51 @@ def register(app: Flask):
 
         gen = Generator(template, dev_output, prod_output)
         gen.generate(dry_run, verbose, yes, port)
+
+
+def register_cache_commands(app: Flask):
+    @app.cli.command(context_settings=CTX_SETTINGS)
+    def migrate_cache():
+        """Move saved images into the configured shard layout."""
+        from .api.files import files
+
+        moved = files.migrate()
+        logger.info("Moved {0} file{1}.", moved, "" if moved == 1 else "s")
+
+    @app.cli.command(context_settings=CTX_SETTINGS)
+    def prune_storage():
+        """Delete stored images that the current renderers can't use."""
+        from .api.base import live_namespaces
+        from .api.storage import image_store
+        from .utils import natsize
+
+        num, size = image_store.prune(live_namespaces())
+        logger.info(
+            "Deleted {0} image{1} ({2}).", num, "" if num == 1 else "s", natsize(size)
+        )
+
+    @app.cli.command(context_settings=CTX_SETTINGS)
+    @click.argument("sources", type=click.File("r"), nargs=-1)
+    @click.option(
+        "--jobs",
+        "-j",
+        type=click.IntRange(1),
+        default=None,
+        help="The number of worker processes. Defaults to the number of CPUs.",
+    )
+    @click.option(
+        "--defaults/--no-defaults",
+        default=True,
+        help="Include the images that the index and tiled pages start with.",
+        show_default=True,
+    )
+    def warm_cache(sources: tuple[TextIO, ...], jobs: int | None, defaults: bool):
+        """Render images ahead of time.
+
+        Each line of [SOURCES] (use - for stdin) can be an image URL, an access log
+        line, or a JSON object with an endpoint and its arguments.
+        """
+        from .api.warm import read_urls, warm_cache
+
+        urls = read_urls(chain.from_iterable(sources), defaults)
+        logger.info("{0}.", warm_cache(urls, jobs))
@@ -18,6 +18,7 @@ IMG_FORMATS_STR = ",".join(IMG_FORMATS)
 DEFAULT_FONT = "overpass"
 DEFAULT_DPI: Final[int] = 144
 NO_CACHE = "max-age=0, no-store, must-revalidate"
+CACHE_CONTROL_MAX = "max-age=315360000, public, immutable"
 COUNT_KEY = "image_count"
 SIZE_KEY = "image_size"
 
@@ -27,6 +28,26 @@ DEFAULT_COLORS = (
     (0xEE, 0x77, 0x33, 0xFF),
 )
 
+# What `rand` colors are picked from when snapping, as 6 digit hex.
+SNAP_PALETTE = (
+    "000000",
+    "ffffff",
+    "808080",
+    "c0c0c0",
+    "800000",
+    "ff0000",
+    "808000",
+    "ffff00",
+    "008000",
+    "00ff00",
+    "008080",
+    "00ffff",
+    "000080",
+    "0000ff",
+    "800080",
+    "ff00ff",
+)
+
 
 class Unset(enum.Enum):
     """Singleton type for situations where `None` may be a valid value.
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from collections.abc import Sequence
+from hashlib import blake2b
 from pathlib import Path
 
 from attrs import define, field
@@ -44,6 +45,7 @@ class Fonts:
     _fonts: dict[str, Font] = field(factory=dict, init=False, repr=False)
     _num_sizes: int | None = field(default=None, init=False, repr=False)
     _font_names: set[str] | None = field(default=None, init=False, repr=False)
+    _fingerprint: str | None = field(default=None, init=False, repr=False)
     _max_size: int | None = field(default=None, init=False, repr=False)
     _min_size: int | None = field(default=None, init=False, repr=False)
 
@@ -72,6 +74,17 @@ class Fonts:
             self._font_names = set(self.font_files)
         return self._font_names
 
+    @property
+    def fingerprint(self) -> str:
+        """A hash of every font file, which changes if any of them do."""
+        if self._fingerprint is None:
+            hasher = blake2b(digest_size=16)
+            for name, path in sorted(self.font_files.items()):
+                hasher.update(name.encode())
+                hasher.update(path.read_bytes())
+            self._fingerprint = hasher.hexdigest()
+        return self._fingerprint
+
     @property
     def max_size(self) -> int:
         if self._max_size is None:
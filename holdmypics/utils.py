@@ -3,7 +3,6 @@ from __future__ import annotations
 import math
 import os
 from collections.abc import Callable
-from functools import lru_cache
 from pathlib import Path
 from typing import Any, TypeVar, cast
 
@@ -74,7 +73,6 @@ def natsize(num: float | int, fmt: str = "{0:.2f}") -> str:
     return f"{fmt.format(num)} {UNITS[exp]}"
 
 
-@lru_cache(maxsize=128)
 def get_size(path: Path | str | bytes) -> int:
     return os.path.getsize(path)
 
@@ -173,18 +173,30 @@ def index() -> ResponseType:
         return render_template("index.jinja", **context)
 
 
+def get_default_colors() -> list[str]:
+    return ["".join(f"{c:02x}" for c in col) for col in DEFAULT_COLORS]
+
+
+def get_tiled_img_url(ctx: dict[str, Any]) -> str:
+    kw = {k: ctx[k] for k in ("cols", "rows", "fmt", "size")}
+    img_url = url_for("api.tiled_route", **kw)
+    return f"{img_url}?{urlencode({'colors': get_default_colors()}, doseq=True)}"
+
+
+def get_default_img_urls() -> list[str]:
+    """Get the image URLs that the index and tiled pages start out with."""
+    return [get_index_context()["img_url"], get_tiled_img_url(get_tiled_context())]
+
+
 @bp.route("/tiled/")
 def tiled() -> ResponseType:
     ctx = get_tiled_context()
-    colors = ["".join(f"{c:02x}" for c in col) for col in DEFAULT_COLORS]
-    kw = {k: ctx[k] for k in ("cols", "rows", "fmt", "size")}
-    img_url = url_for("api.tiled_route", **kw)
     context = {
         **ctx,
         **get_count_context(),
         "title": "Tiled",
-        "img_url": f"{img_url}?{urlencode({'colors': colors}, doseq=True)}",
-        "default_colors": colors,
+        "img_url": get_tiled_img_url(ctx),
+        "default_colors": get_default_colors(),
     }
     return render_template("tiled.jinja", **context)
 
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import threading
+import time
+from collections import OrderedDict
 from typing import Any
 
 from attrs import define, field
@@ -8,21 +11,104 @@ from flask_redis import FlaskRedis
 
 from .constants import COUNT_KEY, SIZE_KEY
 
+# Deletes a key only while it still holds the given value, in one step.
+DELETE_IF_EQUAL = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 
 @define()
 class FakeRedis:
-    _store: dict[str, Any] = field(factory=dict, init=False)
+    """An in-process stand-in for the parts of Redis that are used.
+
+    Keys can expire, and if ``max_memory`` is set, the least recently used keys
+    with an expiry are evicted to stay under it, like ``maxmemory-policy
+    volatile-lru``, so counters are never lost.
+    """
+
+    max_memory: int = 0
+    _store: OrderedDict[str, Any] = field(factory=OrderedDict, init=False)
+    _expires: dict[str, float] = field(factory=dict, init=False)
+    _memory: int = field(default=0, init=False)
+    _lock: threading.RLock = field(factory=threading.RLock, init=False)
+
+    def _expired(self, name: str) -> bool:
+        expires = self._expires.get(name)
+        if expires is not None and expires <= time.monotonic():
+            self._pop(name)
+            return True
+        return False
+
+    def _pop(self, name: str) -> Any:
+        self._expires.pop(name, None)
+        value = self._store.pop(name, None)
+        if isinstance(value, bytes):
+            self._memory -= len(value)
+        return value
 
     def get(self, name: str) -> bytes | None:
-        value = self._store.get(name)
-        if value is not None:
-            return str(value).encode("utf-8")
-        return value
+        with self._lock:
+            if self._expired(name) or name not in self._store:
+                return None
+            self._store.move_to_end(name)
+            value = self._store[name]
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode("utf-8")
+
+    def set(
+        self,
+        name: str,
+        value: bytes | str | int,
+        ex: float | None = None,
+        px: int | None = None,
+        nx: bool = False,
+    ) -> bool | None:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._lock:
+            if nx and not self._expired(name) and name in self._store:
+                return None
+            self._pop(name)
+            self._store[name] = value
+            if isinstance(value, bytes):
+                self._memory += len(value)
+            if px is not None:
+                ex = px / 1000
+            if ex is not None:
+                self._expires[name] = time.monotonic() + ex
+            while self.max_memory and self._memory > self.max_memory:
+                victim = next(
+                    (key for key in self._store if key in self._expires), None
+                )
+                if victim is None:
+                    break
+                self._pop(victim)
+        return True
+
+    def delete(self, *names: str) -> int:
+        with self._lock:
+            return sum(
+                self._pop(name) is not None for name in names if not self._expired(name)
+            )
+
+    def delete_if_equal(self, name: str, value: bytes | str) -> int:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._lock:
+            if self._expired(name) or self._store.get(name) != value:
+                return 0
+            self._pop(name)
+            return 1
 
     def incrby(self, name: str, amount: int = 1) -> int:
-        self._store.setdefault(name, 0)
-        self._store[name] += amount
-        return self._store[name]
+        with self._lock:
+            self._store.setdefault(name, 0)
+            self._store[name] += amount
+            return self._store[name]
 
     def incr(self, name: str) -> int:
         return self.incrby(name, 1)
@@ -32,6 +118,7 @@ class FakeRedis:
 class WrappedRedis:
     has_redis: bool = False
     client: FlaskRedis | FakeRedis = field(factory=FakeRedis, repr=False)
+    _delete_if_equal: Any = field(default=None, init=False, repr=False)
 
     def init_app(self, app: Flask) -> None:
         self.has_redis = bool(app.config.get("REDIS_URL"))
@@ -39,9 +126,10 @@ class WrappedRedis:
             self.client = FlaskRedis()
             self.client.init_app(app)
         else:
-            self.client = FakeRedis()
+            max_memory = app.config.get("SHARED_CACHE_MAX_SIZE", 0)
+            self.client = FakeRedis(max_memory=max_memory)
 
-    def _get_int(self, name: str, default: int = 0) -> int:
+    def get_int(self, name: str, default: int = 0) -> int:
         value = self.client.get(name)
         if value is not None:
             try:
@@ -50,6 +138,25 @@ class WrappedRedis:
                 return default
         return default
 
+    def incr_many(self, amounts: dict[str, int]) -> None:
+        """Add to several counters, in one round trip."""
+        if isinstance(self.client, FakeRedis):
+            for name, amount in amounts.items():
+                self.client.incrby(name, amount)
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for name, amount in amounts.items():
+            pipe.incrby(name, amount)
+        pipe.execute()
+
+    def delete_if_equal(self, name: str, value: str) -> bool:
+        """Delete ``name`` if it still holds ``value``, atomically."""
+        if isinstance(self.client, FakeRedis):
+            return bool(self.client.delete_if_equal(name, value))
+        if self._delete_if_equal is None:
+            self._delete_if_equal = self.client.register_script(DELETE_IF_EQUAL)
+        return bool(self._delete_if_equal(keys=[name], args=[value]))
+
     def incr_count(self) -> int:
         return self.client.incr(COUNT_KEY)
 
@@ -57,7 +164,7 @@ class WrappedRedis:
         return self.client.incrby(SIZE_KEY, size)
 
     def get_count(self) -> int:
-        return self._get_int(COUNT_KEY)
+        return self.get_int(COUNT_KEY)
 
     def get_size(self) -> int:
-        return self._get_int(SIZE_KEY)
+        return self.get_int(SIZE_KEY)
@@ -0,0 +1,1281 @@
+from __future__ import annotations
+
+import io
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pytest
+from flask.testing import FlaskClient
+
+from tests.utils import make_route
+
+if TYPE_CHECKING:
+    from holdmypics import Holdmypics
+    from tests.conftest import AppFactory
+
+
+def test_memory_cache_lru(app: Holdmypics):
+    from holdmypics.api.memory import CachedImage, MemoryCache
+
+    app.config.update(MEMORY_CACHE_MAX_SIZE=100, MEMORY_CACHE_MAX_ITEM_SIZE=60)
+    with app.app_context():
+        cache = MemoryCache()
+        for key in "abc":
+            assert cache.put(key, CachedImage(b"x" * 40, "image/png", 0.0))
+        assert cache.current_size == 80
+        assert cache.evictions == 1
+        assert "a" not in cache
+        assert cache.get("b") is not None
+        assert cache.put("d", CachedImage(b"x" * 40, "image/png", 0.0))
+        assert "c" not in cache
+        assert "b" in cache
+        assert cache.get("c") is None
+        assert not cache.put("e", CachedImage(b"x" * 61, "image/png", 0.0))
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 1,
+            "evictions": 2,
+            "entries": 2,
+            "size": 80,
+            "max_size": 100,
+        }
+
+
+def test_memory_cache_hit(client: FlaskClient):
+    from holdmypics.api.memory import memory_cache
+
+    path = make_route(
+        client,
+        "api.image_route",
+        size=(638, 328),
+        bg_color="cef",
+        fg_color="555",
+        fmt="png",
+        text="Memory Cache",
+    )
+    first = client.get(path)
+    assert first.status_code == 200
+    hits = memory_cache.hits
+    second = client.get(path)
+    assert second.status_code == 200
+    assert memory_cache.hits == hits + 1
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+    not_modified = client.get(path, headers={"If-None-Match": first.headers["ETag"]})
+    assert not_modified.status_code == 304
+
+
+def test_cache_index():
+    from holdmypics.api.index import INITIAL_CAPACITY, CacheIndex
+
+    index = CacheIndex()
+    n = INITIAL_CAPACITY * 3
+    names = [f"{i:05d}.png" for i in range(n)]
+    for i, name in enumerate(names):
+        index.add(name, i, atime=i)
+    assert len(index) == n
+    assert index.capacity > n
+    assert index.total_size == sum(range(n))
+    for name in names[::2]:
+        assert index.remove(name) == int(name[:5])
+    assert index.remove(names[0]) == 0
+    assert len(index) == n // 2
+    assert index.total_size == sum(range(1, n, 2))
+    for i, name in enumerate(names):
+        assert (name in index) == bool(i % 2)
+    index.add(names[1], 10)
+    assert index.total_size == sum(range(1, n, 2)) - 1 + 10
+    assert index.touch(names[1], atime=12345)
+    assert index.get(names[1]) == (10, 12345)
+    assert not index.touch(names[0])
+
+
+@pytest.mark.parametrize("index", ["memory", "sqlite"])
+def test_evictor(app: Holdmypics, tmp_path: Path, index: str):
+    from holdmypics.api.evict import Evictor
+    from holdmypics.api.files import GeneratedFiles
+
+    app.config.update(
+        SAVED_IMAGES_INDEX=index,
+        SAVED_IMAGES_CACHE_DIR=tmp_path,
+        SAVED_IMAGES_MAX_SIZE=1000,
+        SAVED_IMAGES_LOW_WATERMARK=0.5,
+        EVICTION_BATCH_SIZE=4,
+        EVICTION_MIN_AGE=60,
+    )
+    now = time.time()
+    with app.app_context():
+        files = GeneratedFiles()
+        files.setup()
+        paths = [files.path_for(f"{i:02d}.png") for i in range(20)]
+        for i, path in enumerate(paths):
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            Path(path).write_bytes(b"x" * 100)
+            files.add(path, 100, atime=now - 1000 + i)
+        files.touch(paths[0])
+        assert files.need_to_clean
+        evictor = Evictor(files)
+        assert evictor.run_once() == 15
+        assert not files.need_to_clean
+        assert files.index.total_size == 500
+        remaining = list(tmp_path.rglob("*.png"))
+        assert len(remaining) == 5
+        assert Path(paths[0]) in remaining
+
+
+@pytest.mark.parametrize("index", ["memory", "sqlite"])
+def test_sharded_layout(app: Holdmypics, tmp_path: Path, index: str):
+    from holdmypics.api.files import GeneratedFiles
+
+    app.config.update(
+        SAVED_IMAGES_INDEX=index,
+        SAVED_IMAGES_CACHE_DIR=tmp_path,
+        SAVED_IMAGES_SHARD_DEPTH=0,
+    )
+    hashed = f"{'ab' * 16}.png"
+    names = [hashed, "640x480-cef-555.png"]
+    for name in names:
+        (tmp_path / name).write_bytes(b"x" * 10)
+    with app.app_context():
+        flat = GeneratedFiles()
+        flat.setup()
+        assert flat.index.total_size == 20
+        assert all(flat.path_for(n) == str(tmp_path / n) for n in names)
+
+    app.config.update(SAVED_IMAGES_SHARD_DEPTH=2)
+    with app.app_context():
+        files = GeneratedFiles()
+        assert files.path_for(hashed) == str(tmp_path / "ab" / "ab" / hashed)
+        files.setup()
+        assert not list(tmp_path.glob("*.png"))
+        for name in names:
+            path = Path(files.path_for(name))
+            assert path.is_file()
+            assert path.relative_to(tmp_path).parts[:-1] == files.shard_parts(name)
+        assert files.index.total_size == 20
+        shard = files.shard_of(hashed)
+        assert shard == 0xAB
+        assert files.index.shard_size(shard) >= 10
+        files.sync(files.scan(shard), shard)
+        assert files.index.total_size == 20
+
+
+def test_sqlite_index_attach(app: Holdmypics, tmp_path: Path):
+    from holdmypics.api.files import GeneratedFiles
+    from holdmypics.api.sqlindex import SQLiteIndex
+
+    app.config.update(SAVED_IMAGES_INDEX="sqlite", SAVED_IMAGES_CACHE_DIR=tmp_path)
+    with app.app_context():
+        files = GeneratedFiles()
+        files.setup()
+        path = files.path_for(f"{'cd' * 16}.png")
+        Path(path).parent.mkdir(parents=True)
+        Path(path).write_bytes(b"x" * 10)
+        files.add(path, 10)
+        files.touch(path)
+        # Written behind the index's back, so only a scan would find it.
+        (tmp_path / "ab").mkdir()
+        (tmp_path / "ab" / f"{'ab' * 16}.png").write_bytes(b"x" * 5)
+
+        worker = GeneratedFiles()
+        worker.setup()
+        assert isinstance(worker.index, SQLiteIndex)
+        assert worker.index is not files.index
+        assert len(worker.index) == 1
+        assert worker.index.total_size == 10
+        atime = worker.index.get(Path(path).name)[1]
+        assert worker.index.lowest_priority(1) == [(path, 10, atime)]
+
+
+def test_canonical_cache_keys(app: Holdmypics):
+    from holdmypics.api.args import TextImageArgs, TiledImageArgs
+    from holdmypics.api.text import GeneratedTextImage
+    from holdmypics.api.tiled import GeneratedTiledImage
+
+    def text_path(fmt: str, bg: str, fg: str, **kwargs: object) -> str:
+        args = TextImageArgs(**kwargs)  # type: ignore
+        return GeneratedTextImage((320, 240), fmt, bg, fg, args).get_img_path()
+
+    with app.test_request_context():
+        path = text_path("webp", "AAA", "fff")
+        assert text_path("webp", "aaaaaaff", "000", dpi=72) == path
+        assert text_path("webp", "aaa", "fff", font_name="roboto", debug=True) == path
+        assert text_path("webp", "aaa", "fff", seed="abc", alpha=0.5) == path
+        assert text_path("webp", "aaa", "fff", text="Text") != path
+        assert text_path("jpg", "aaa", "fff") == text_path("jpeg", "AAAAAA", "000")
+        assert text_path("png", "aaa", "fff") != text_path("png", "aaa", "fff", dpi=72)
+        with_text = text_path("png", "aaa", "fff", text="Text")
+        assert with_text == text_path("png", "AAAF", "FFFFFF", text="Text")
+        assert with_text != text_path("png", "aaa", "000", text="Text")
+
+        args = TiledImageArgs(colors=["ABC", "0f0f"])
+        img = GeneratedTiledImage((320, 240), "gif", "0000", "0000", args, 4, 3)
+        other_args = TiledImageArgs(colors=["aabbccff", "00ff00ff"], col_major=True)
+        other = GeneratedTiledImage((320, 240), "gif", "0000", "0000", other_args, 4, 3)
+        assert img.get_img_path() == other.get_img_path()
+
+
+def test_memory_index_single_worker(monkeypatch: pytest.MonkeyPatch):
+    import importlib.util
+    from types import SimpleNamespace
+    from unittest import mock
+
+    import config
+
+    root = Path(__file__).parent.parent
+    spec = importlib.util.spec_from_file_location(
+        "gunicorn_conf", root / "gunicorn.conf.py"
+    )
+    assert spec is not None
+    assert spec.loader is not None
+    conf = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(conf)
+
+    monkeypatch.setattr(config, "SHM_CACHE_SIZE", 0)
+    for workers, expected in [(1, "memory"), (4, "sqlite")]:
+        monkeypatch.setattr(config, "SAVED_IMAGES_INDEX", "memory")
+        server = SimpleNamespace(cfg=SimpleNamespace(workers=workers), log=mock.Mock())
+        conf.on_starting(server)
+        assert config.SAVED_IMAGES_INDEX == expected
+        assert server.log.warning.called == (workers > 1)
+
+
+def test_fake_redis_lru():
+    from holdmypics.wrapped_redis import FakeRedis
+
+    redis = FakeRedis(max_memory=100)
+    assert redis.set("counter", b"x" * 10)
+    for key in "abc":
+        assert redis.set(key, b"x" * 40, ex=60)
+    assert redis.get("a") is None
+    assert redis.get("b") is not None
+    assert redis.set("d", b"x" * 40, ex=60)
+    assert redis.get("c") is None
+    assert redis.get("counter") is not None
+    assert redis.set("lock", "token", px=1, nx=True)
+    assert redis.set("lock", "other", nx=True) is None
+    time.sleep(0.01)
+    assert redis.get("lock") is None
+    assert redis.set("lock", "other", nx=True)
+    assert redis.delete_if_equal("lock", "token") == 0
+    assert redis.delete_if_equal("lock", "other") == 1
+    assert redis.set("lock", "other")
+    assert redis.delete("lock", "missing") == 1
+
+
+def test_shared_cache(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics import redisw
+    from holdmypics.api.args import TextImageArgs
+    from holdmypics.api.shared import LOCK_PREFIX, shared_cache
+    from holdmypics.api.text import GeneratedTextImage
+
+    monkeypatch.setattr(shared_cache, "_enabled", True)
+    with app.test_request_context():
+        args = TextImageArgs(text="Shared Cache")
+        img = GeneratedTextImage((321, 123), "png", "123", "fed", args)
+        Path(img.get_img_path()).unlink(missing_ok=True)
+        path = Path(img.get_path())
+        data = path.read_bytes()
+        name = path.name
+        # Another node, with an empty cache folder.
+        path.unlink()
+        monkeypatch.setattr(GeneratedTextImage, "make", pytest.fail)
+        hits = shared_cache.hits
+        assert img.get_path() == str(path)
+        assert shared_cache.hits == hits + 1
+        assert path.read_bytes() == data
+
+        with shared_cache.render_lock(name) as owner:
+            assert owner
+            with shared_cache.render_lock(name) as other:
+                assert not other
+        with shared_cache.render_lock(name) as owner:
+            assert owner
+            # The lock expired and another node took it.
+            redisw.client.set(LOCK_PREFIX + name, "other")
+        assert redisw.client.get(LOCK_PREFIX + name) == b"other"
+
+
+def test_single_flight(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from holdmypics.api.args import TextImageArgs
+    from holdmypics.api.files import files
+    from holdmypics.api.text import GeneratedTextImage
+
+    renders: list[str] = []
+    make = GeneratedTextImage.make
+
+    def slow_make(self: GeneratedTextImage):
+        renders.append(self.get_img_path())
+        time.sleep(0.1)
+        return make(self)
+
+    monkeypatch.setattr(GeneratedTextImage, "make", slow_make)
+
+    def get_path(_: int) -> tuple[str, str | None]:
+        with app.test_request_context():
+            args = TextImageArgs(text="Single Flight")
+            img = GeneratedTextImage((432, 234), "png", "0f0", "f0f", args)
+            return img.get_path(), img.cache_status
+
+    with app.test_request_context():
+        args = TextImageArgs(text="Single Flight")
+        img = GeneratedTextImage((432, 234), "png", "0f0", "f0f", args)
+        Path(img.get_img_path()).unlink(missing_ok=True)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(get_path, range(8)))
+    paths = {path for path, _ in results}
+    statuses = sorted(status for _, status in results)
+    assert statuses == ["COALESCED"] * 7 + ["MISS"]
+    assert len(paths) == 1
+    assert renders == list(paths)
+    path = Path(paths.pop())
+    assert not list(path.parent.glob("*.tmp"))
+    assert len(files._flights) == 0
+
+
+def test_warm_cache(app: Holdmypics):
+    from holdmypics.api.warm import image_for_request, read_urls, warm_cache
+
+    image_url = make_route(
+        app, "api.image_route", size=(345, 456), bg_color="abc", fg_color="def"
+    )
+    tiled_url = make_route(
+        app, "api.tiled_route", size=(345, 456), cols=3, rows=4, fmt="webp"
+    )
+    lines = [
+        f"http://localhost{image_url}?text=Warm",
+        f'127.0.0.1 - - [18/Oct/2026:10:00:00] "GET {tiled_url} HTTP/1.1" 200 123',
+        '{"endpoint": "api.image_route", "size": [345, 456], "bg_color": "ABC",'
+        ' "fg_color": "def", "fmt": "jpg", "text": "Warm"}',
+        f"{image_url}?text=Warm&seed=123",
+        image_url.replace("/abc/", "/rand/"),
+        "# A comment",
+        "/robots.txt",
+    ]
+    with app.app_context():
+        urls = read_urls(lines)
+        assert len(urls) == 6
+        for url in urls:
+            with app.test_request_context(url):
+                img = image_for_request()
+                if img is not None:
+                    Path(img.get_img_path()).unlink(missing_ok=True)
+        result = warm_cache(urls, jobs=2)
+        assert (result.rendered, result.skipped, result.unmatched) == (3, 1, 2)
+        assert result.failed == 0
+        assert result.size > 0
+        again = warm_cache(urls, jobs=1)
+        assert (again.rendered, again.skipped, again.unmatched) == (0, 4, 2)
+
+    runner = app.test_cli_runner()
+    res = runner.invoke(args=["warm-cache", "-", "--jobs", "1"], input="\n".join(lines))
+    assert res.exit_code == 0, res.output
+
+
+@pytest.mark.parametrize("index", ["memory", "sqlite"])
+def test_lfu_ties(tmp_path: Path, index: str):
+    from holdmypics.api.index import CacheIndex
+    from holdmypics.api.policy import LFUPolicy
+    from holdmypics.api.sqlindex import SQLiteIndex
+
+    policy = LFUPolicy()
+    idx = (
+        CacheIndex(policy) if index == "memory" else SQLiteIndex(tmp_path / "i", policy)
+    )
+    now = time.time()
+    for key, atime, hits in [("new", now, 2), ("old", now - 60, 2), ("rare", now, 1)]:
+        idx.add(key, 10, atime, cost=0.1)
+        idx.touch(key, atime, hits)
+    priorities = {key: idx.priority(key) for key in ("new", "old", "rare")}
+    assert sorted(priorities, key=priorities.__getitem__) == ["rare", "old", "new"]
+
+
+@pytest.mark.parametrize("index", ["memory", "sqlite"])
+@pytest.mark.parametrize("policy", ["lru", "lfu", "gdsf"])
+def test_eviction_policies(app: Holdmypics, tmp_path: Path, index: str, policy: str):
+    from holdmypics.api.evict import Evictor
+    from holdmypics.api.files import GeneratedFiles
+
+    app.config.update(
+        SAVED_IMAGES_INDEX=index,
+        SAVED_IMAGES_EVICTION_POLICY=policy,
+        SAVED_IMAGES_CACHE_DIR=tmp_path,
+        SAVED_IMAGES_SHARD_DEPTH=0,
+        SAVED_IMAGES_MAX_SIZE=1000,
+        SAVED_IMAGES_LOW_WATERMARK=0.5,
+        EVICTION_MIN_AGE=0,
+    )
+    now = time.time()
+    with app.app_context():
+        files = GeneratedFiles()
+        files.setup()
+        paths = [files.path_for(f"{i:02d}.png") for i in range(10)]
+        for i, path in enumerate(paths):
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            Path(path).write_bytes(b"x" * 110)
+            # The oldest half took much longer to render than the newest half.
+            files.add(path, 110, atime=now - 1000 + i, cost=1.0 if i < 5 else 0.001)
+        if policy == "lfu":
+            for path in paths[:5]:
+                files.touch(path)
+        assert Evictor(files).run_once() == 6
+        remaining = {p.name for p in tmp_path.rglob("*.png")}
+        assert len(remaining) == 4
+        kept = paths[6:] if policy == "lru" else paths[:5]
+        assert remaining <= {Path(p).name for p in kept}
+        if policy == "gdsf":
+            assert files.index.priority(Path(paths[4]).name) >= files.index.clock > 0
+
+
+def test_sqlite_index_upgrade(tmp_path: Path):
+    import sqlite3
+
+    from holdmypics.api.sqlindex import SQLiteIndex
+
+    path = tmp_path / "index.sqlite3"
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE entries (key TEXT PRIMARY KEY, path TEXT NOT NULL,"
+            " size INTEGER NOT NULL, format TEXT NOT NULL,"
+            " shard INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL,"
+            " last_access REAL NOT NULL, hit_count INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.execute(
+            "INSERT INTO entries VALUES ('a.png', '/a.png', 10, 'png', 0, 1, 1, 3)"
+        )
+    conn.close()
+    index = SQLiteIndex(path)
+    index.add("b.png", 5, atime=2, cost=0.5)
+    assert index.lowest_priority(15) == [("/a.png", 10, 1), ("", 5, 2)]
+
+
+def test_cache_headers(client: FlaskClient):
+    path = make_route(
+        client,
+        "api.image_route",
+        size=(543, 345),
+        bg_color="fed",
+        fg_color="def",
+        fmt="webp",
+        text="Cache Headers",
+    )
+    before = client.get("/api/stats/").json["cache"]
+    first = client.get(path)
+    assert first.headers["X-Cache"] in {"MISS", "HIT"}
+    if first.headers["X-Cache"] == "MISS":
+        assert first.headers["Age"] == "0"
+    second = client.get(path)
+    assert second.headers["X-Cache"] == "HIT"
+    assert int(second.headers["Age"]) >= 0
+    after = client.get("/api/stats/").json["cache"]
+    for scope in ("worker", "total"):
+        old, new = before[scope], after[scope]
+        assert new["hits"] + new["misses"] == old["hits"] + old["misses"] + 2
+        assert new["bytes_served"] == old["bytes_served"] + 2 * len(second.data)
+        assert new["bytes_from_cache"] >= old["bytes_from_cache"] + len(second.data)
+        assert 0 < new["hit_ratio"] <= 1
+    assert after["size"] > 0
+
+
+def test_batched_stats(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics import redisw
+    from holdmypics.api.stats import KEY_PREFIX, cache_stats
+
+    path = make_route(client, "api.image_route", size=(123, 45), fmt="png")
+    client.get(path)
+    cache_stats.flush()
+    before = redisw.get_int(KEY_PREFIX + "hits")
+    # Responses only count in memory.
+    for name in ("incr", "incrby"):
+        monkeypatch.setattr(type(redisw.client), name, pytest.fail)
+    for _ in range(3):
+        assert client.get(path).headers["X-Cache"] == "HIT"
+    assert redisw.get_int(KEY_PREFIX + "hits") == before
+    monkeypatch.undo()
+    # One pipeline, for hits, bytes_served and bytes_from_cache.
+    assert cache_stats.flush() == 3
+    assert redisw.get_int(KEY_PREFIX + "hits") == before + 3
+    # Once the interval is up, the next response adds them.
+    monkeypatch.setattr(cache_stats, "_interval", 0.0)
+    client.get(path)
+    assert redisw.get_int(KEY_PREFIX + "hits") == before + 4
+
+
+def test_early_not_modified(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics.api.memory import memory_cache
+    from holdmypics.api.tiled import GeneratedTiledImage
+    from holdmypics.constants import CACHE_CONTROL_MAX, NO_CACHE
+
+    path = make_route(
+        client, "api.tiled_route", size=(456, 654), cols=5, rows=7, fmt="png"
+    )
+    first = client.get(path)
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == CACHE_CONTROL_MAX
+    etag = first.headers["ETag"]
+
+    memory_cache.clear()
+    for image in client.application.config["SAVED_IMAGES_CACHE_DIR"].rglob("*.png"):
+        image.unlink()
+    monkeypatch.setattr(GeneratedTiledImage, "make", pytest.fail)
+    res = client.get(path, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.headers["ETag"] == etag
+    assert res.headers["Cache-Control"] == CACHE_CONTROL_MAX
+
+    monkeypatch.undo()
+    monkeypatch.setattr(GeneratedTiledImage, "renderer_version", 2)
+    res = client.get(path, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+
+    rand = client.get(f"{path}?colors=rand&colors=fff")
+    assert rand.headers["Cache-Control"] == NO_CACHE
+
+
+def test_raster_cache(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics.api.args import TextImageArgs
+    from holdmypics.api.raster import raster_cache
+    from holdmypics.api.text import GeneratedTextImage
+
+    def make_img(fmt: str, dpi: int = 72) -> GeneratedTextImage:
+        args = TextImageArgs(text="Raster Cache", dpi=dpi)
+        img = GeneratedTextImage((234, 123), fmt, "abc", "123", args)
+        Path(img.get_img_path()).unlink(missing_ok=True)
+        return img
+
+    monkeypatch.setattr(raster_cache, "_max_size", int(64e6))
+    with app.test_request_context():
+        assert raster_cache.enabled
+        png = make_img("png")
+        png_path = png.get_path()
+        assert png.get_raster_key() in raster_cache
+        monkeypatch.setattr(GeneratedTextImage, "make", pytest.fail)
+        hits = raster_cache.hits
+        for img in (make_img("webp"), make_img("jpeg"), make_img("png", 144)):
+            path = img.get_path()
+            assert path != png_path
+            assert img.cache_status == "MISS"
+        assert raster_cache.hits == hits + 3
+
+
+@pytest.mark.parametrize("mode", ["x-accel-redirect", "x-sendfile"])
+def test_send_file_offload(app: Holdmypics, mode: str):
+    from holdmypics.api.offload import OFFLOAD_HEADERS, OffloadProxy
+
+    folder = app.config["SAVED_IMAGES_CACHE_DIR"]
+    app.config.update(SEND_FILE_OFFLOAD=mode)
+    path = make_route(
+        app,
+        "api.image_route",
+        size=(567, 765),
+        bg_color="0ff",
+        fg_color="f00",
+        fmt="gif",
+        text="Offload",
+    )
+    with app.test_client() as client:
+        res = client.get(path)
+        assert res.status_code == 200
+        assert res.data == b""
+        assert res.mimetype == "image/gif"
+        assert res.headers["Cache-Control"]
+        assert res.headers["ETag"]
+        offloaded = res.headers[OFFLOAD_HEADERS[mode]]
+        if mode == "x-accel-redirect":
+            assert offloaded.startswith("/_cached-images/")
+        else:
+            assert Path(offloaded).is_relative_to(folder)
+
+    app.wsgi_app = OffloadProxy(app.wsgi_app, folder)  # type: ignore
+    with app.test_client() as client:
+        res = client.get(path)
+        assert res.status_code == 200
+        assert OFFLOAD_HEADERS[mode] not in res.headers
+        assert res.data.startswith(b"GIF")
+        assert int(res.headers["Content-Length"]) == len(res.data)
+        assert res.headers["X-Cache"] == "HIT"
+        etag = res.headers["ETag"]
+        assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_shm_cache(app: Holdmypics, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics.api.shm import (
+        OverwrittenError,
+        SharedMemoryCache,
+        create_arena,
+        shm_cache,
+    )
+
+    arena_path = tmp_path / "holdmypics.cache"
+    create_arena(arena_path, 1 << 20, 64)
+    for name, value in [("_size", 1 << 20), ("_path", str(arena_path))]:
+        monkeypatch.setattr(shm_cache, name, value)
+    monkeypatch.setattr(shm_cache, "_arena", None)
+    path = make_route(
+        app,
+        "api.image_route",
+        size=(345, 543),
+        bg_color="fed",
+        fg_color="123",
+        fmt="png",
+        text="Shared Memory",
+    )
+    with app.test_client() as client:
+        first = client.get(path)
+        assert first.status_code == 200
+        second = client.get(path)
+        assert second.headers["X-Cache"] == "HIT"
+        assert second.data == first.data
+        assert int(second.headers["Content-Length"]) == len(second.data)
+        etag = second.headers["ETag"]
+        assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+
+    # Another worker attaches to the same arena and sees the same bytes.
+    other = SharedMemoryCache()
+    for name, value in [("_size", 1 << 20), ("_path", str(arena_path))]:
+        setattr(other, name, value)
+    with app.app_context():
+        folder = Path(app.config["SAVED_IMAGES_CACHE_DIR"])
+        keys = [str(p) for p in folder.rglob("*.png")]
+        key = next(k for k in keys if other.lookup(k) is not None)
+        entry = other.lookup(key)
+        assert entry is not None
+        assert other.open(entry).read() == first.data
+        body = other.open(entry)
+        assert not hasattr(body, "fileno")
+        chunk = body.read(100)
+        assert chunk == first.data[:100]
+
+        # Older entries stop being served once newer ones are about to wrap over them.
+        assert other.put("oldest", b"x" * 1000, 0.0)
+        for i in range(1, 2000):
+            assert other.put(f"item-{i}", bytes(1000), 0.0)
+            if other.lookup("oldest") is None:
+                break
+        else:
+            pytest.fail("The oldest entry was never retired.")
+        assert other.lookup(key) is None
+        assert other.lookup(f"item-{i}") is not None
+        # A slow reader that's still sending it can't be sent what replaced it.
+        while other.intact(entry):
+            other.put(f"item-{i}", bytes(1000), 0.0)
+        with pytest.raises(OverwrittenError):
+            body.read(100)
+
+
+def test_batched_access_tracking(
+    app: Holdmypics, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    import os
+    from unittest import mock
+
+    from holdmypics.api.args import TextImageArgs
+    from holdmypics.api.files import GeneratedFiles
+    from holdmypics.api.text import GeneratedTextImage
+
+    app.config.update(
+        SAVED_IMAGES_INDEX="sqlite",
+        SAVED_IMAGES_CACHE_DIR=tmp_path,
+        SAVED_IMAGES_DEDUPE=True,
+    )
+    with app.test_request_context():
+        files = GeneratedFiles()
+        files.setup()
+        monkeypatch.setattr("holdmypics.api.base.files", files)
+        args = TextImageArgs(text="Access Tracking")
+        path = GeneratedTextImage((222, 111), "png", "abc", "def", args).get_path()
+        assert os.path.islink(path)
+        name = files.entry_name(path)
+        old = time.time() - 1000
+        os.utime(path, (old, old))
+        files.index.touch(name, atime=old, hits=0)
+
+        monkeypatch.setattr(os, "utime", pytest.fail)
+        # Dedupe links are followed when the hits are written, not on each hit.
+        with mock.patch.object(os, "readlink", side_effect=pytest.fail):
+            for _ in range(3):
+                img = GeneratedTextImage((222, 111), "png", "abc", "def", args)
+                assert img.get_path() == path
+                assert img.cache_status == "HIT"
+        assert os.stat(path).st_mtime == old
+        assert files.index.get(name) == (os.path.getsize(path), old)
+        assert len(files.accesses) == 1
+
+        assert files.flush_accesses() == 1
+        size, atime = files.index.get(name)  # type: ignore[misc]
+        assert atime > old
+        row = "SELECT hit_count FROM entries WHERE key = ?"
+        assert files.index.conn.execute(row, (name,)).fetchone() == (3,)  # type: ignore[attr-defined]
+        assert files.flush_accesses() == 0
+
+
+@pytest.mark.parametrize("index", ["memory", "sqlite"])
+def test_dedupe(app: Holdmypics, tmp_path: Path, index: str):
+    import os
+
+    from holdmypics.api.files import GeneratedFiles
+
+    app.config.update(
+        SAVED_IMAGES_INDEX=index,
+        SAVED_IMAGES_CACHE_DIR=tmp_path,
+        SAVED_IMAGES_DEDUPE=True,
+    )
+    with app.app_context():
+        files = GeneratedFiles()
+        files.setup()
+        paths = [files.path_for(f"{c * 32}.png") for c in "abc"]
+        for path, data in zip(paths, [b"same" * 25, b"same" * 25, b"other" * 20]):
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            Path(path).write_bytes(data)
+            files.store(path, len(data), cost=0.1)
+        assert all(Path(p).is_symlink() and Path(p).is_file() for p in paths)
+        assert files.entry_name(paths[0]) == files.entry_name(paths[1])
+        assert files.entry_name(paths[0]) != files.entry_name(paths[2])
+        assert files.index.total_size == 200
+        files.sync(files.scan())
+        assert files.index.total_size == 200
+
+        # Evicting the shared bytes makes every path that used them a miss.
+        blob = os.path.realpath(paths[0])
+        assert files.evict(blob) == 100
+        assert not any(os.path.isfile(p) for p in paths[:2])
+        assert os.path.isfile(paths[2])
+        files.sync(files.scan())
+        assert not any(os.path.lexists(p) for p in paths[:2])
+        assert files.index.total_size == 100
+
+
+def test_evicted_before_send(
+    app: Holdmypics, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    from holdmypics.api.base import BaseGeneratedImage
+    from holdmypics.api.files import TRASH_DIR, files
+
+    path = make_route(
+        app,
+        "api.image_route",
+        size=(321, 123),
+        bg_color="0f0",
+        fg_color="00f",
+        fmt="png",
+        text="Evicted",
+    )
+    with app.test_client() as client:
+        first = client.get(path)
+        assert first.status_code == 200
+
+        get_path = BaseGeneratedImage.get_path
+        evicted: list[str] = []
+
+        def get_path_then_evict(self: BaseGeneratedImage) -> str:
+            found = get_path(self)
+            if not evicted:
+                # Another worker evicts the file before this one can open it.
+                files.evict(found)
+                evicted.append(found)
+            return found
+
+        monkeypatch.setattr(BaseGeneratedImage, "get_path", get_path_then_evict)
+        monkeypatch.setattr("holdmypics.api.routes.memory_cache._max_size", 0)
+        res = client.get(path)
+        assert res.status_code == 200
+        assert evicted
+        assert res.data == first.data
+        assert int(res.headers["Content-Length"]) == len(res.data)
+
+    trash = files.images_folder / TRASH_DIR
+    assert any(trash.iterdir())
+    with app.app_context():
+        assert files.reclaim_trash(3600) == 0
+        assert files.reclaim_trash(0) >= 1
+    assert not any(trash.iterdir())
+
+
+def test_renderer_namespaces(
+    app: Holdmypics, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    from holdmypics.api.args import TextImageArgs, TiledImageArgs
+    from holdmypics.api.base import live_namespaces
+    from holdmypics.api.evict import Evictor
+    from holdmypics.api.files import GeneratedFiles
+    from holdmypics.api.text import GeneratedTextImage
+    from holdmypics.api.tiled import GeneratedTiledImage
+
+    app.config.update(SAVED_IMAGES_CACHE_DIR=tmp_path)
+    with app.test_request_context():
+        files = GeneratedFiles()
+        monkeypatch.setattr("holdmypics.api.base.files", files)
+        text = GeneratedTextImage((100, 50), "png", "abc", "def", TextImageArgs())
+        tiled_args = TiledImageArgs(colors=["fff", "000"])
+        tiled = GeneratedTiledImage((100, 50), "png", "0000", "0000", tiled_args, 2, 2)
+        text_path, tiled_path = text.get_path(), tiled.get_path()
+        assert files.namespace_of(text_path) != files.namespace_of(tiled_path)
+        legacy = tmp_path / f"{'ef' * 16}.png"
+        legacy.write_bytes(b"x" * 10)
+
+        # A new tiled renderer only moves tiled images to a new namespace.
+        monkeypatch.setattr(GeneratedTiledImage, "renderer_version", 2)
+        text = GeneratedTextImage((100, 50), "png", "abc", "def", TextImageArgs())
+        tiled = GeneratedTiledImage((100, 50), "png", "0000", "0000", tiled_args, 2, 2)
+        assert text.get_img_path() == text_path
+        assert tiled.get_img_path() != tiled_path
+
+        evictor = Evictor(files)
+        monkeypatch.setattr(evictor, "_live", live_namespaces())
+        stale = set(files.stale_files(live_namespaces()))
+        assert stale == {tiled_path, str(legacy)}
+        assert evictor.collect_stale() == 2
+        assert Path(text_path).is_file()
+        assert not Path(tiled_path).exists()
+        assert not legacy.exists()
+        assert files.namespace_of(tiled_path) not in files.namespaces()
+        assert evictor.collect_stale() == 0
+
+
+def test_admission(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics.api.admission import FrequencySketch, admission
+    from holdmypics.api.files import BLOBS_DIR, SCRATCH_DIR
+    from holdmypics.api.memory import memory_cache
+    from holdmypics.api.shared import shared_cache
+    from holdmypics.api.text import GeneratedTextImage
+
+    for name, value in [("_policy", "tinylfu"), ("_min_pixels", 10_000)]:
+        monkeypatch.setattr(admission, name, value)
+    folder = app.config["SAVED_IMAGES_CACHE_DIR"]
+
+    def get(size: tuple[int, int]):
+        url = make_route(
+            app,
+            "api.image_route",
+            size=size,
+            bg_color="123",
+            fg_color="456",
+            fmt="webp",
+            text="Admission",
+        )
+        with app.test_client() as client:
+            return client.get(url)
+
+    def saved() -> set[Path]:
+        paths = folder.rglob("*.webp")
+        return {p for p in paths if not {SCRATCH_DIR, BLOBS_DIR} & set(p.parts)}
+
+    before, rejected = saved(), admission.rejected
+    first = get((797, 461))
+    assert first.status_code == 200
+    assert first.headers["X-Cache"] == "MISS"
+    assert admission.rejected == rejected + 1
+    assert saved() == before
+    assert not list((folder / SCRATCH_DIR).iterdir())
+
+    second = get((797, 461))
+    assert second.headers["X-Cache"] == "MISS"
+    assert second.data == first.data
+    assert len(saved()) == len(before) + 1
+    assert get((797, 461)).headers["X-Cache"] == "HIT"
+
+    # Small images are always kept.
+    get((64, 64))
+    assert len(saved()) == len(before) + 2
+    with app.test_client() as client:
+        assert client.get("/api/stats/").json["admission"]["rejected"] >= 1
+
+    # An image that's saved elsewhere is copied, not rendered, even if rejected.
+    monkeypatch.setattr(shared_cache, "_enabled", True)
+    monkeypatch.setattr(admission, "_policy", "always")
+    kept = saved()
+    assert get((799, 463)).headers["X-Cache"] == "MISS"
+    for path in saved() - kept:
+        path.unlink()
+    memory_cache.clear()
+    monkeypatch.setattr(admission, "_policy", "tinylfu")
+    monkeypatch.setattr(GeneratedTextImage, "make", pytest.fail)
+    rejected = admission.rejected
+    assert get((799, 463)).headers["X-Cache"] == "HIT"
+    assert admission.rejected == rejected
+
+    sketch = FrequencySketch(width=16)
+    for _ in range(20):
+        sketch.increment("popular")
+    assert sketch.estimate("popular") == 15
+    for i in range(200):
+        sketch.increment(f"other-{i}")
+    assert sketch.estimate("popular") < 15
+
+
+def test_snap(app: Holdmypics):
+    from PIL import Image
+
+    from holdmypics.api.snap import Snap
+    from holdmypics.constants import SNAP_PALETTE
+
+    def get(size: tuple[int, int], bg_color: str = "123", **kwargs):
+        url = make_route(
+            app,
+            "api.image_route",
+            size=size,
+            bg_color=bg_color,
+            fg_color="456",
+            fmt="png",
+            **kwargs,
+        )
+        with app.test_client() as client:
+            return client.get(url)
+
+    res = get((637, 479), snap="1")
+    assert res.status_code == 200
+    assert res.headers["X-Image-Size"] == "640x480"
+    with Image.open(io.BytesIO(res.data)) as im:
+        assert im.size == (640, 480)
+    nearby = get((642, 483), snap="1")
+    assert nearby.headers["X-Cache"] == "HIT"
+    assert nearby.data == res.data
+
+    exact = get((637, 479))
+    assert "X-Image-Size" not in exact.headers
+    with Image.open(io.BytesIO(exact.data)) as im:
+        assert im.size == (637, 479)
+    assert get((637, 479), snap="0").headers["X-Cache"] == "HIT"
+
+    # Halfway sizes round up, whichever way `round` would go.
+    snap = Snap(10, [])
+    assert snap.size((25, 35)) == (30, 40)
+    assert snap.size((24, 3)) == (20, 10)
+
+    res = get((64, 64), bg_color="rand", text="", snap="1")
+    with Image.open(io.BytesIO(res.data)) as im:
+        r, g, b = im.convert("RGB").getpixel((0, 0))
+    assert f"{r:02x}{g:02x}{b:02x}" in SNAP_PALETTE
+
+
+def test_canonical_redirects(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(app.config, "CANONICAL_REDIRECTS", True)
+    canonical = "/api/640x480/112233/aabbcc88/jpeg/?font=roboto&text=Hi"
+    requests = [
+        "/api/640x480/123/ABC8/jpg/?text=Hi&font=Roboto&alpha=0.5&seed=1",
+        "/api/640x480/112233FF/aabbcc88/jpeg/?text=Hi&font=roboto&dpi=144&x=y",
+    ]
+    with app.test_client() as client:
+        for url in requests:
+            res = client.get(url)
+            assert res.status_code == 301
+            assert res.location == canonical
+            assert res.headers["Cache-Control"] == "max-age=86400, public"
+        res = client.get(canonical)
+        assert res.status_code == 200
+
+        # Without text, or anything random, none of these change the image.
+        res = client.get("/api/640/png/?font=Roboto&seed=a&debug=1&dpi=0144")
+        assert res.location == "/api/640x640/000000/aaaaaa/png/"
+        assert client.get(res.location).status_code == 200
+
+        url = "/api/tiled/64x64/2/2/png/?colors=F00&colors=Rand&seed=1&dpi=72"
+        res = client.get(url)
+        expected = "/api/tiled/64x64/2/2/png/?colors=ff0000&colors=rand&dpi=72&seed=1"
+        assert res.location == expected
+        assert client.get(expected).status_code == 200
+
+        monkeypatch.setitem(app.config, "CANONICAL_REDIRECTS", False)
+        assert client.get(requests[1]).status_code == 200
+
+
+def test_peer_cache(app_factory: AppFactory, tmp_path: Path):
+    from unittest import mock
+
+    from PIL import Image, PngImagePlugin
+
+    from holdmypics.api import routes
+    from holdmypics.api.files import GeneratedFiles
+    from holdmypics.api.peers import PEER_PATH, PeerCache
+
+    urls = [f"http://node{i}" for i in range(3)]
+    down: set[str] = set()
+    calls: list[tuple[str, str]] = []
+
+    def transport(method: str, url: str, headers: dict[str, str], data, timeout):
+        base, _, key = url.partition(PEER_PATH)
+        calls.append((method, base))
+        if base in down:
+            raise ConnectionRefusedError(f"{base} is down")
+        node_app, node_peers = nodes[base]
+        patch = mock.patch.object(routes, "peer_cache", node_peers)
+        with patch, node_app.test_client() as client:
+            res = client.open(
+                PEER_PATH + key, method=method, headers=headers, data=data
+            )
+        return res.status_code, res.get_data()
+
+    nodes: dict[str, tuple[Holdmypics, PeerCache]] = {}
+    for i, url in enumerate(urls):
+        node_app = app_factory()
+        node_app.config.update(
+            PEERS=urls,
+            PEER_SELF=url,
+            PEER_SECRET="secret",
+            SAVED_IMAGES_CACHE_DIR=tmp_path / f"node{i}",
+        )
+        nodes[url] = (node_app, PeerCache(GeneratedFiles(), transport))
+
+    renders = 0
+
+    def render(text: str) -> bytes:
+        info = PngImagePlugin.PngInfo()
+        info.add_text("text", text)
+        buffer = io.BytesIO()
+        Image.new("RGB", (10, 10)).save(buffer, format="png", pnginfo=info)
+        return buffer.getvalue()
+
+    def get(url: str, text: str) -> bytes:
+        nonlocal renders
+        node_app, peers = nodes[url]
+        with node_app.app_context():
+            params = {"size": "10x10", "fmt": "png", "text": text}
+            path = Path(peers.files.get_file_name(params, "r0123456789ab"))
+            if path.is_file():
+                return path.read_bytes()
+            data = peers.get(str(path))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if data is None:
+                renders += 1
+                data = render(text)
+                path.write_bytes(data)
+                peers.files.store(str(path), len(data))
+                peers.put_file(str(path))
+            else:
+                path.write_bytes(data)
+            return data
+
+    texts = [f"peer-{i}" for i in range(30)]
+    for j in range(len(urls)):
+        for i, text in enumerate(texts):
+            assert get(urls[(i + j) % len(urls)], text) == render(text)
+    # Every image was rendered once, and then found on its owner.
+    assert renders == len(texts)
+    stats = [peers.stats() for _, peers in nodes.values()]
+    assert all(s["enabled"] for s in stats)
+    hits = sum(s["hits"] for s in stats)
+    assert hits == sum(s["served"] for s in stats)
+    assert hits >= len(texts)
+    assert sum(s["filled"] for s in stats) == sum(s["misses"] for s in stats)
+
+    # A peer that's down is skipped, and its images are rendered locally.
+    down.add(urls[2])
+    calls.clear()
+    texts = [f"down-{i}" for i in range(20)]
+    for text in texts:
+        assert get(urls[0], text) == render(text)
+    assert renders == 30 + len(texts)
+    assert sum(base == urls[2] for _, base in calls) == 1
+    assert nodes[urls[0]][1].errors == 1
+
+    node_app, peers = nodes[urls[1]]
+    patch = mock.patch.object(routes, "peer_cache", peers)
+    with patch, node_app.test_client() as client:
+        assert client.get(f"{PEER_PATH}r0123456789ab/x.png").status_code == 403
+        headers = {"X-Holdmypics-Peer": "secret"}
+        res = client.get(f"{PEER_PATH}r0123456789ab/..png", headers=headers)
+        assert res.status_code == 400
+
+
+def test_peer_fill_checks(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from PIL import Image
+
+    from holdmypics.api.peers import PEER_PATH, HashRing, peer_cache
+
+    def encode(fmt: str) -> bytes:
+        buffer = io.BytesIO()
+        Image.new("RGB", (10, 10)).save(buffer, format=fmt)
+        return buffer.getvalue()
+
+    monkeypatch.setattr(peer_cache, "_ring", HashRing(["http://self", "http://o"]))
+    monkeypatch.setattr(peer_cache, "_self_url", "http://self")
+    url = f"{PEER_PATH}r0123456789ab/{'a' * 32}.png"
+    with app.test_client() as client:
+        # PEER_SECRET is empty by default, which leaves peers off.
+        with app.app_context():
+            assert peer_cache.configured
+            assert not peer_cache.enabled
+        assert client.put(url, data=encode("png")).status_code == 403
+        assert client.get(url).status_code == 403
+
+        monkeypatch.setattr(peer_cache, "_secret", "secret")
+        headers = {"X-Holdmypics-Peer": "secret"}
+        # Only images in the format their name is for are saved.
+        for data in (b"EVIL", encode("png")[:-20], encode("gif")):
+            assert client.put(url, headers=headers, data=data).status_code == 400
+        assert client.get(url, headers=headers).status_code == 404
+        assert client.put(url, headers=headers, data=encode("png")).status_code == 204
+        assert client.get(url, headers=headers).data == encode("png")
+
+
+def test_peer_cache_routes(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics.api.args import TextImageArgs
+    from holdmypics.api.memory import memory_cache
+    from holdmypics.api.peers import HashRing, peer_cache
+    from holdmypics.api.text import GeneratedTextImage
+
+    sent: dict[str, bytes] = {}
+
+    def owner_transport(method: str, url: str, headers, data, timeout):
+        if method == "PUT":
+            sent[url] = data
+            return 204, b""
+        return (200, sent[url]) if url in sent else (404, b"")
+
+    monkeypatch.setattr(peer_cache, "_ring", HashRing(["http://self", "http://o"]))
+    monkeypatch.setattr(peer_cache, "_self_url", "http://self")
+    monkeypatch.setattr(peer_cache, "_secret", "secret")
+    monkeypatch.setattr(peer_cache, "transport", owner_transport)
+    with app.test_client() as client:
+        for i in range(20):
+            url = make_route(
+                app, "api.image_route", size=(90, 30), fmt="png", text=f"Owned {i}"
+            )
+            first = client.get(url)
+            if sent:
+                break
+        assert first.headers["X-Cache"] == "MISS"
+        assert list(sent.values()) == [first.data]
+        # Another node, without the image.
+        with app.test_request_context():
+            args = TextImageArgs(text=f"Owned {i}")
+            img = GeneratedTextImage((90, 30), "png", "000", "aaa", args)
+            Path(img.get_img_path()).unlink()
+        memory_cache.clear()
+        monkeypatch.setattr(GeneratedTextImage, "make", pytest.fail)
+        res = client.get(url)
+        assert res.headers["X-Cache"] == "HIT"
+        assert res.data == first.data
+
+
+@pytest.mark.parametrize("kind", ["fs", "memory", "s3"])
+def test_storage_backends(tmp_path: Path, kind: str):
+    from contextlib import ExitStack, closing
+
+    from holdmypics.api.storage import FileSystemStorage, MemoryStorage, S3Storage
+
+    with ExitStack() as stack:
+        storage: FileSystemStorage | MemoryStorage | S3Storage
+        if kind == "s3":
+            moto = pytest.importorskip("moto")
+            boto3 = pytest.importorskip("boto3")
+            stack.enter_context(moto.mock_aws())
+            client = boto3.client("s3", region_name="us-east-1")
+            client.create_bucket(Bucket="images")
+            storage = S3Storage("images", "cache/", client=client)
+        elif kind == "fs":
+            storage = FileSystemStorage(tmp_path)
+        else:
+            storage = MemoryStorage()
+
+        key, data = "r0123456789ab/image.png", b"x" * 100_000
+        assert storage.open(key) is None
+        assert not storage.exists(key)
+        storage.put(key, io.BytesIO(data))
+        assert storage.exists(key)
+        stream = storage.open(key)
+        assert stream is not None
+        with closing(stream):
+            assert stream.read() == data
+        assert list(storage.list()) == [(key, len(data))]
+        assert storage.delete(key)
+        assert not storage.exists(key)
+        assert list(storage.list()) == []
+
+
+def test_storage_fill(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from holdmypics.api.args import TextImageArgs
+    from holdmypics.api.memory import memory_cache
+    from holdmypics.api.storage import MemoryStorage, image_store
+    from holdmypics.api.text import GeneratedTextImage
+
+    backend = MemoryStorage()
+    monkeypatch.setattr(image_store, "_kind", "memory")
+    monkeypatch.setattr(image_store, "_backend", backend)
+    url = make_route(app, "api.image_route", size=(150, 50), fmt="png", text="Stored")
+    with app.test_client() as client:
+        first = client.get(url)
+        assert first.headers["X-Cache"] == "MISS"
+        ((key, size),) = backend.list()
+        assert size == len(first.data)
+
+        # A restart, with an empty cache folder.
+        with app.test_request_context():
+            args = TextImageArgs(text="Stored")
+            img = GeneratedTextImage((150, 50), "png", "000", "aaa", args)
+            Path(img.get_img_path()).unlink()
+        memory_cache.clear()
+        monkeypatch.setattr(GeneratedTextImage, "make", pytest.fail)
+        res = client.get(url)
+        assert res.headers["X-Cache"] == "HIT"
+        assert res.data == first.data
+        assert client.get("/api/stats/").json["storage"]["hits"] >= 1
+
+    assert image_store.prune({key.partition("/")[0]}) == (0, 0)
+    assert image_store.prune(set()) == (1, size)
+
+
+@pytest.mark.parametrize("fmt", ["png", "gif", "webp"])
+def test_solid_encoders(fmt: str):
+    from PIL import Image
+
+    from holdmypics.api.solid import encode_solid
+
+    sizes = [(1, 1), (7, 3), (1, 300), (640, 480), (4000, 3000)]
+    colors = [(18, 52, 86, 255), (0, 0, 0, 0), (255, 128, 0, 64)]
+    kw = {"dpi": (144, 144), "compress_level": 6}
+    for size in sizes:
+        for color in colors:
+            data = encode_solid(fmt, size, color, kw)
+            if data is None:
+                # GIF can't have partly transparent pixels.
+                assert fmt == "gif"
+                assert color[3] not in (0, 255)
+                continue
+            with Image.open(io.BytesIO(data)) as im:
+                assert im.size == size
+                extrema = im.convert("RGBA").getextrema()
+            if color[3] == 0:
+                assert extrema[3] == (0, 0)
+            else:
+                assert extrema == tuple((c, c) for c in color)
+
+
+def test_solid_fast_path(app: Holdmypics, monkeypatch: pytest.MonkeyPatch):
+    from PIL import Image
+
+    from holdmypics.api.text import GeneratedTextImage
+    from holdmypics.api.tiled import GeneratedTiledImage
+
+    monkeypatch.setattr(GeneratedTextImage, "make", pytest.fail)
+    monkeypatch.setattr(GeneratedTiledImage, "make", pytest.fail)
+    size = (321, 123)
+    urls = {
+        make_route(app, "api.image_route", size=size, bg_color=bg, fmt=fmt): color
+        for fmt, bg, color in [
+            ("png", "1234", (17, 34, 51, 68)),
+            ("gif", "123", (17, 34, 51, 255)),
+            ("webp", "1234", (17, 34, 51, 68)),
+            ("jpeg", "123", (17, 34, 51, 255)),
+        ]
+    }
+    tiled_url = make_route(
+        app, "api.tiled_route", size=size, cols=3, rows=2, fmt="png", colors="00f8"
+    )
+    urls[tiled_url] = (0, 0, 255, 136)
+    with app.test_client() as client:
+        for url, color in urls.items():
+            res = client.get(url)
+            assert res.status_code == 200
+            with Image.open(io.BytesIO(res.data)) as im:
+                assert im.size == size
+                extrema = im.convert("RGBA").getextrema()
+            # JPEG is lossy, even for a single color.
+            tolerance = 1 if "/jpeg/" in url else 0
+            for (lo, hi), c in zip(extrema, color):
+                assert lo == hi
+                assert abs(lo - c) <= tolerance